@@ -0,0 +1,319 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scaling benchmarks of the CAClient hook paths.
+
+A unit requests N server and N client certificates, one application and one
+legacy certificate from a CA answering with synthetic data, using
+ops.testing.Harness. Each phase records its wall time, the relation-get and
+relation-set calls made by the charm and, unless --no-memory is given, the
+peak memory allocated during the phase; the ca_relation_data row records the
+size of the CA's relation data. Accessor phases start from a cold parse cache
+and relation snapshot, as a new hook would. With --store issued material is
+kept in a DirectoryStore rather than in StoredState, which mostly shows in the
+commit phase. --key-type sets the type of the keys
+issued, e.g. P-256, to compare relation data size and parse time with RSA
+keys. Run with::
+
+    python -m benchmarks.bench_ca_client [--sizes 1 10 100 1000 5000]
+        [--store] [--key-type RSA-2048] [--output results.json]
+
+Results are written as JSON so that runs of different versions can be
+compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import ops
+from ops import framework, testing
+from ops.charm import CharmBase
+
+import interface_tls_certificates.ca_client as ca_client
+import interface_tls_certificates.keys as keys
+import interface_tls_certificates.store as store
+
+from benchmarks import synthetic
+
+META = '''
+name: myserver
+peers:
+  ca-client:
+    interface: tls-certificates
+'''
+
+UNIT_NAME = 'myserver/0'
+CA_UNIT_NAME = 'easyrsa/0'
+
+
+class ReadyHandlers(framework.Object):
+    """Ready event handlers writing the issued material to disk."""
+
+    def __init__(self, parent, key, ca_client, directory):
+        super().__init__(parent, key)
+        self.ca_client = ca_client
+        self.directory = directory
+        self.wall_s = 0.0
+        for request_type, event in ca_client.ready_events.items():
+            self.framework.observe(
+                event,
+                getattr(self, '_on_{}_ready'.format(request_type)))
+
+    def _write(self, request_type):
+        start = time.perf_counter()
+        self.ca_client.write_certificates(
+            self.directory, request_type, fsync=False)
+        self.wall_s += time.perf_counter() - start
+
+    def _on_legacy_ready(self, event):
+        self._write('legacy')
+
+    def _on_server_ready(self, event):
+        self._write('server')
+
+    def _on_client_ready(self, event):
+        self._write('client')
+
+    def _on_application_ready(self, event):
+        self._write('application')
+
+
+class Bench:
+    """A CAClient in a Harness, related to one CA unit."""
+
+    def __init__(self, size, measure_memory=True, store_directory=None):
+        self.size = size
+        self.measure_memory = measure_memory
+        self.results = []
+        self.harness = testing.Harness(CharmBase, meta=META)
+        self.harness.begin()
+        material_store = None
+        if store_directory is not None:
+            material_store = store.DirectoryStore(
+                store_directory, fsync=False)
+        self.ca_client = ca_client.CAClient(
+            self.harness.charm, 'ca-client', store=material_store)
+        self.relation_id = self.harness.add_relation('ca-client', 'easyrsa')
+        self.harness.add_relation_unit(self.relation_id, CA_UNIT_NAME)
+        backend = self.harness._backend
+        self.relation_get = mock.patch.object(
+            backend, 'relation_get', wraps=backend.relation_get).start()
+        self.relation_set = mock.patch.object(
+            backend, 'update_relation_data',
+            wraps=backend.update_relation_data).start()
+
+    def close(self):
+        mock.patch.stopall()
+
+    def new_hook(self):
+        """Drop per-process state, as the start of a new hook would."""
+        self.harness.framework.commit()
+        self.ca_client._parsed.clear()
+        self.ca_client._loaded.clear()
+        self.harness.charm.model.relations._invalidate('ca-client')
+
+    def measure(self, phase, func):
+        """Run func and record its cost under phase.
+
+        :param phase: Name of the phase
+        :type phase: str
+        :param func: Callable to measure
+        :type func: Callable[[], Any]
+        :returns: The value returned by func
+        :rtype: Any
+        """
+        self.relation_get.reset_mock()
+        self.relation_set.reset_mock()
+        if self.measure_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            value = func()
+        finally:
+            wall_s = time.perf_counter() - start
+            peak_bytes = None
+            if self.measure_memory:
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        self.results.append({
+            'size': self.size,
+            'phase': phase,
+            'wall_s': wall_s,
+            'relation_get': self.relation_get.call_count,
+            'relation_set': self.relation_set.call_count,
+            'peak_bytes': peak_bytes})
+        return value
+
+
+def _request_one_by_one(bench, server_requests):
+    for cn, sans in server_requests:
+        bench.ca_client.request_server_certificate(cn, sans)
+
+
+def run_size(ca, size, measure_memory=True, max_sequential=1000,
+             store_directory=None):
+    """Run all phases for size server and size client certificates.
+
+    :param ca: CA issuing the certificates
+    :type ca: synthetic.SyntheticCA
+    :param size: Number of server and of client certificates
+    :type size: int
+    :param measure_memory: Whether to record peak memory
+    :type measure_memory: bool
+    :param max_sequential: Largest size for which certificates are also
+                           requested one call at a time
+    :type max_sequential: int
+    :param store_directory: Directory of a DirectoryStore to keep issued
+                            material in, None to keep it in StoredState
+    :type store_directory: Optional[str]
+    :returns: Results of every phase
+    :rtype: List[Dict[str, Any]]
+    """
+    unit_data, ca_data = synthetic.relation_data(ca, UNIT_NAME, size)
+    server_requests = synthetic.requests('server', size)
+    client_requests = synthetic.requests('client', size)
+    results = [{
+        'size': size,
+        'phase': 'ca_relation_data',
+        'data_bytes': sum(len(value) for value in ca_data.values())}]
+
+    if size <= max_sequential:
+        bench = Bench(size, measure_memory, store_directory)
+        bench.measure(
+            'request_certificate',
+            lambda: _request_one_by_one(bench, server_requests))
+        bench.close()
+        results.extend(bench.results)
+
+    bench = Bench(size, measure_memory, store_directory)
+    client = bench.ca_client
+    bench.measure(
+        'request_certificates',
+        lambda: (
+            client.request_server_certificates(server_requests),
+            client.request_client_certificates(client_requests),
+            client.request_application_certificate(
+                'app.example.com', ['app.example.com', '10.1.0.1'])))
+    # Replace the requests with exactly what the CA answered.
+    bench.harness.update_relation_data(
+        bench.relation_id, UNIT_NAME, unit_data)
+    bench.new_hook()
+
+    with tempfile.TemporaryDirectory() as directory:
+        handlers = ReadyHandlers(
+            bench.harness.framework, 'handlers', client, directory)
+        bench.measure(
+            'relation_changed',
+            lambda: bench.harness.update_relation_data(
+                bench.relation_id, CA_UNIT_NAME, ca_data))
+        bench.results.append({
+            'size': size,
+            'phase': 'ready_handlers',
+            'wall_s': handlers.wall_s,
+            'relation_get': None,
+            'relation_set': None,
+            'peak_bytes': None})
+        bench.measure('commit', bench.harness.framework.commit)
+        bench.new_hook()
+        bench.measure(
+            'relation_changed_unrelated_field',
+            lambda: bench.harness.update_relation_data(
+                bench.relation_id, CA_UNIT_NAME,
+                {'ingress-address': '192.0.2.3'}))
+
+        middle_cn = server_requests[size // 2][0]
+        accessors = [
+            ('is_server_cert_ready', lambda: client.is_server_cert_ready),
+            ('ca_certificate', lambda: client.ca_certificate),
+            ('root_ca_chain', lambda: client.root_ca_chain),
+            ('certificate', lambda: client.certificate),
+            ('key', lambda: client.key),
+            ('server_certificate', lambda: client.server_certificate),
+            ('server_key', lambda: client.server_key),
+            ('server_certificate_and_key', lambda: (
+                client.server_certificate, client.server_key)),
+            ('client_certificate', lambda: client.client_certificate),
+            ('client_key', lambda: client.client_key),
+            ('application_certificate',
+             lambda: client.application_certificate),
+            ('application_key', lambda: client.application_key),
+            ('server_certs_names', lambda: list(client.server_certs)),
+            ('server_certs_one_cn', lambda: (
+                client.server_certs[middle_cn]['cert'],
+                client.server_certs[middle_cn]['key'])),
+            ('server_certs_all', lambda: [
+                (entry['cert'], entry['key'])
+                for entry in client.server_certs.values()]),
+            ('client_certs_all', lambda: [
+                (entry['cert'], entry['key'])
+                for entry in client.client_certs.values()]),
+            ('application_certs_all', lambda: [
+                (entry['cert'], entry['key'])
+                for entry in client.application_certs.values()]),
+            ('server_certificate_bytes_der', lambda: client.certificate_bytes(
+                'server', middle_cn, client.ENCODING_DER)),
+            ('write_certificates_unchanged',
+             lambda: client.write_certificates(directory, fsync=False)),
+        ]
+        for phase, accessor in accessors:
+            bench.new_hook()
+            bench.measure(phase, accessor)
+    bench.close()
+    results.extend(bench.results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 5000])
+    parser.add_argument('--max-sequential', type=int, default=1000)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--store', action='store_true',
+                        help='keep issued material in a DirectoryStore')
+    parser.add_argument('--key-type', default=keys.DEFAULT_KEY_TYPE,
+                        help='type of the keys issued')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+    ca = synthetic.SyntheticCA(key_type=args.key_type)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            store_directory = None
+            if args.store:
+                store_directory = os.path.join(tmp_dir, str(size))
+            results.extend(run_size(
+                ca, size,
+                measure_memory=not args.no_memory,
+                max_sequential=args.max_sequential,
+                store_directory=store_directory))
+    json.dump({
+        'python': platform.python_version(),
+        'ops': getattr(ops, '__version__', None),
+        'store': args.store,
+        'key_type': args.key_type,
+        'results': results}, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of certificate metadata extraction.
+
+Compares reading the serial, validity, subject CN and SANs of certificates
+through full cryptography objects, with and without also loading the private
+key as accessors of CAClient do, against der.certificate_metadata. Runs on
+the certificates of the test fixtures and on a synthetic set. Loading keys is
+slow enough that it is only timed on a sample of each set. Run with::
+
+    python -m benchmarks.bench_der [--count 5000] [--key-sample 50]
+        [--output results.json]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.x509.oid import NameOID
+
+import interface_tls_certificates.ca_client as ca_client
+import interface_tls_certificates.der as der
+
+from benchmarks import synthetic
+from test.ca_client_test_data import get_multi_rq_relation_data_server
+
+
+def _full_metadata(pem):
+    cert = x509.load_pem_x509_certificate(pem['cert'], default_backend())
+    try:
+        sans = cert.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName).value
+        names = (sans.get_values_for_type(x509.DNSName),
+                 sans.get_values_for_type(x509.IPAddress))
+    except x509.ExtensionNotFound:
+        names = None
+    return (
+        cert.serial_number,
+        cert.not_valid_before,
+        cert.not_valid_after,
+        cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME),
+        names)
+
+
+def _full_metadata_and_key(pem):
+    load_pem_private_key(pem['key'], None, default_backend())
+    return _full_metadata(pem)
+
+
+def _der_metadata(pem):
+    return der.certificate_metadata(ca_client._pem_to_der(pem['cert']))
+
+
+# (name, function, whether it loads keys)
+METHODS = [
+    ('cryptography', _full_metadata, False),
+    ('cryptography_with_key', _full_metadata_and_key, True),
+    ('der', _der_metadata, False),
+]
+
+
+def fixture_pems():
+    """Return the certificates and keys of the test fixtures.
+
+    :returns: PEM data keyed on 'cert' and 'key'
+    :rtype: List[Dict[str, bytes]]
+    """
+    pems = []
+    for field, value in get_multi_rq_relation_data_server().items():
+        if 'processed' in field:
+            pems.extend(
+                {'cert': data['cert'].encode('utf-8'),
+                 'key': data['key'].encode('utf-8')}
+                for data in json.loads(value).values())
+    return pems
+
+
+def synthetic_pems(count):
+    """Return count synthetic certificates and keys.
+
+    :param count: Number of certificates
+    :type count: int
+    :returns: PEM data keyed on 'cert' and 'key'
+    :rtype: List[Dict[str, bytes]]
+    """
+    ca = synthetic.SyntheticCA()
+    return [
+        {name: value.encode('utf-8')
+         for name, value in ca.issue(cn, sans).items()}
+        for cn, sans in synthetic.requests('server', count)]
+
+
+def run(name, pems, repeat, key_sample):
+    """Time every method on pems.
+
+    :param name: Name of the set of certificates
+    :type name: str
+    :param pems: PEM data keyed on 'cert' and 'key'
+    :type pems: List[Dict[str, bytes]]
+    :param repeat: Number of times to go through pems
+    :type repeat: int
+    :param key_sample: Number of certificates methods loading keys are
+                       timed on
+    :type key_sample: int
+    :returns: Results of every method
+    :rtype: List[Dict[str, Any]]
+    """
+    results = []
+    for method, func, loads_keys in METHODS:
+        sample = pems
+        if loads_keys:
+            sample = (pems * repeat)[:key_sample]
+        count = len(sample) * (1 if loads_keys else repeat)
+        start = time.perf_counter()
+        for _ in range(count // len(sample)):
+            for pem in sample:
+                func(pem)
+        wall_s = time.perf_counter() - start
+        results.append({
+            'set': name,
+            'method': method,
+            'certificates': count,
+            'wall_s': wall_s,
+            'per_certificate_us': wall_s * 1e6 / count})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=5000,
+                        help='number of synthetic certificates')
+    parser.add_argument('--fixture-repeat', type=int, default=500,
+                        help='times to go through the fixture certificates')
+    parser.add_argument('--key-sample', type=int, default=50,
+                        help='number of certificates to also load keys of')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+    results = run('fixtures', fixture_pems(), args.fixture_repeat,
+                  args.key_sample)
+    results.extend(run(
+        'synthetic', synthetic_pems(args.count), 1, args.key_sample))
+    json.dump({
+        'python': platform.python_version(),
+        'results': results}, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
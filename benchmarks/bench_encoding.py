@@ -0,0 +1,117 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the plain and compressed encodings of relation data.
+
+For a unit requesting N server and N client certificates, records the size
+of each request and response field, and the time taken to encode and decode
+it, as plain JSON and compressed. Issued certificates share --key-pool-size
+keys, which compress better than as many distinct keys would; use a pool as
+large as the largest size, with --key-type P-256 to keep it quick, for
+figures closer to a real deployment. Run with::
+
+    python -m benchmarks.bench_encoding [--sizes 10 100 1000]
+        [--key-type RSA-2048] [--key-pool-size 4] [--output results.json]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import interface_tls_certificates.compression as compression
+import interface_tls_certificates.keys as keys
+
+from benchmarks import synthetic
+
+UNIT_NAME = 'myserver/0'
+
+# Fields of the requests and responses of UNIT_NAME
+FIELDS = (
+    'cert_requests',
+    'client_cert_requests',
+    'myserver_0.processed_requests',
+    'myserver_0.processed_client_requests')
+
+
+def _timed(func, repeat):
+    """Return the result of func and the best time of repeat calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run_size(ca, size, repeat):
+    """Measure both encodings of the fields for size certificates.
+
+    :param ca: CA issuing the certificates
+    :type ca: synthetic.SyntheticCA
+    :param size: Number of server and of client certificates
+    :type size: int
+    :param repeat: Number of runs to keep the best time of
+    :type repeat: int
+    :returns: Results of every field and encoding
+    :rtype: List[Dict[str, Any]]
+    """
+    unit_data, ca_data = synthetic.relation_data(ca, UNIT_NAME, size)
+    data = dict(unit_data, **ca_data)
+    results = []
+    for field in FIELDS:
+        value = json.loads(data[field])
+        for encoding, compress in (('json', False), (compression.ZLIB, True)):
+            text, encode_s = _timed(
+                lambda: compression.encode(value, compress), repeat)
+            _, decode_s = _timed(lambda: compression.decode(text), repeat)
+            results.append({
+                'size': size,
+                'field': field,
+                'encoding': encoding,
+                'bytes': len(text),
+                'encode_s': encode_s,
+                'decode_s': decode_s})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--key-type', default=keys.DEFAULT_KEY_TYPE,
+                        help='type of the keys issued')
+    parser.add_argument('--key-pool-size', type=int, default=4,
+                        help='number of keys shared by the certificates')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+    ca = synthetic.SyntheticCA(
+        key_pool_size=args.key_pool_size, key_type=args.key_type)
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(ca, size, args.repeat))
+    json.dump({
+        'python': platform.python_version(),
+        'key_type': args.key_type,
+        'key_pool_size': args.key_pool_size,
+        'results': results}, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cost of importing ca_client in a fresh interpreter.
+
+Each sample runs a new Python process, as every hook dispatch does, and
+records the time taken to import the given statement. Run with::
+
+    python -m benchmarks.bench_import [--samples N]
+
+A JSON document is printed with the median and minimum import time of each
+case in seconds and whether cryptography was loaded by the import.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CASES = {
+    'ops': 'import ops.framework',
+    'ca_client': 'import interface_tls_certificates.ca_client',
+    # What importing ca_client cost while it imported cryptography eagerly.
+    'ca_client_eager': (
+        'import interface_tls_certificates.ca_client; '
+        'import cryptography.hazmat.backends; '
+        'import cryptography.hazmat.primitives.serialization; '
+        'import cryptography.x509'),
+    'cryptography': 'import cryptography.x509',
+}
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start, 'cryptography' in sys.modules)
+'''
+
+
+def sample(statement):
+    """Return the import time of statement and whether it loaded cryptography.
+
+    :param statement: Python statement to time
+    :type statement: str
+    :returns: Seconds taken and whether cryptography was imported
+    :rtype: Tuple[float, bool]
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(statement=statement)],
+        universal_newlines=True)
+    seconds, loaded = output.split()
+    return float(seconds), loaded == 'True'
+
+
+def run(samples):
+    """Run all cases.
+
+    :param samples: Number of processes to start per case
+    :type samples: int
+    :returns: Results keyed on case name
+    :rtype: Dict[str, Dict[str, Union[float, bool]]]
+    """
+    results = {}
+    for name, statement in CASES.items():
+        timings = [sample(statement) for _ in range(samples)]
+        seconds = [t for t, _ in timings]
+        results[name] = {
+            'median_s': statistics.median(seconds),
+            'min_s': min(seconds),
+            'loads_cryptography': any(loaded for _, loaded in timings)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+    json.dump(run(args.samples), sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of key generation when issuing certificates.
+
+Times generating keys, and keys with their CSRs as CAClient(csr=True) does,
+one after the other and with a pool of processes, then a CAProvider answering
+one unit requesting --count server certificates with a local CA: generating
+each key in the signing function, taking all keys from an empty KeyPool,
+which generates them in parallel, and from a KeyPool filled beforehand. Run
+with::
+
+    python -m benchmarks.bench_keys [--count 100] [--key-type RSA-2048]
+        [--processes N] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from ops import testing
+from ops.charm import CharmBase
+
+import interface_tls_certificates.ca_provider as ca_provider
+import interface_tls_certificates.keys as keys
+
+from benchmarks import synthetic
+
+META = '''
+name: easyrsa
+provides:
+  certificates:
+    interface: tls-certificates
+'''
+
+
+class Bench:
+    """A CAProvider in a Harness, answering one unit."""
+
+    def __init__(self, ca, count, key_type, processes, pool_size=None):
+        self.ca = ca
+        self.key_type = key_type
+        self.harness = testing.Harness(CharmBase, meta=META)
+        self.harness.begin()
+        self.key_pool = None
+        if pool_size is not None:
+            self.key_pool = keys.KeyPool(
+                self.harness.charm, 'key-pool', size=pool_size,
+                key_type=key_type, processes=processes)
+            self.key_pool.refill()
+        self.ca_provider = ca_provider.CAProvider(
+            self.harness.charm, 'certificates', self.sign,
+            key_pool=self.key_pool)
+        relation_id = self.harness.add_relation('certificates', 'myserver')
+        self.harness.add_relation_unit(relation_id, 'myserver/0')
+        self.harness.update_relation_data(relation_id, 'myserver/0', {
+            'unit_name': 'myserver/0',
+            'cert_requests': json.dumps({
+                cn: {'sans': sans}
+                for cn, sans in synthetic.requests('server', count)})})
+
+    def sign(self, requests):
+        issued = []
+        for request in requests:
+            key = request.key or keys.generate_key(self.key_type)
+            issued.append({
+                'cert': self.ca.sign(
+                    request.common_name, request.sans, key),
+                'key': key})
+        return issued
+
+    def run(self):
+        return self.ca_provider.set_ca_certificate(self.ca.ca_certificate)
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=100,
+                        help='number of keys and certificates')
+    parser.add_argument('--key-type', default=keys.DEFAULT_KEY_TYPE)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes generating keys, default one per '
+                             'core')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+    ca = synthetic.SyntheticCA()
+    results = []
+
+    def record(phase, wall_s):
+        results.append({
+            'phase': phase,
+            'count': args.count,
+            'wall_s': wall_s,
+            'per_certificate_ms': wall_s * 1e3 / args.count})
+
+    record('generate_sequential', _timed(
+        lambda: keys.generate_keys(args.count, args.key_type, processes=1)))
+    record('generate_process_pool', _timed(
+        lambda: keys.generate_keys(
+            args.count, args.key_type, args.processes)))
+    csr_requests = synthetic.requests('server', args.count)
+    record('csr_sequential', _timed(
+        lambda: keys.generate_csrs(csr_requests, args.key_type, processes=1)))
+    record('csr_process_pool', _timed(
+        lambda: keys.generate_csrs(
+            csr_requests, args.key_type, args.processes)))
+    for phase, pool_size in (('provider_no_pool', None),
+                             ('provider_key_pool_empty', 0),
+                             ('provider_key_pool_full', args.count)):
+        bench = Bench(ca, args.count, args.key_type, args.processes,
+                      pool_size)
+        record(phase, _timed(bench.run))
+    json.dump({
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'key_type': args.key_type,
+        'results': results}, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic tls-certificates relation data for benchmarks.
+
+Generating an RSA key per CN would dominate the time taken to build large
+data sets, so a small pool of keys, of any type keys.generate_key supports,
+is shared between CNs. Every CN still gets its own certificate, signed by a
+throwaway RSA CA.
+"""
+
+import datetime
+import ipaddress
+import json
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from interface_tls_certificates import keys
+
+
+def _key_pem(key):
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+
+def _cert_pem(cert):
+    return cert.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+
+def _san(name):
+    try:
+        return x509.IPAddress(ipaddress.ip_address(name))
+    except ValueError:
+        return x509.DNSName(name)
+
+
+class SyntheticCA:
+    """A throwaway CA issuing certificates for benchmarks."""
+
+    def __init__(self, key_pool_size=4, key_size=2048, key_type=None):
+        """
+        :param key_pool_size: Number of keys shared by issued certificates
+        :type key_pool_size: int
+        :param key_size: RSA key size of the CA, and of issued certificates
+                         unless key_type is given
+        :type key_size: int
+        :param key_type: Type of the keys of issued certificates, see
+                         keys.check_key_type
+        :type key_type: Optional[str]
+        """
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        ca_key = rsa.generate_private_key(65537, key_size, default_backend())
+        self._keys = [ca_key] + [
+            serialization.load_pem_private_key(
+                keys.generate_key(
+                    key_type or 'RSA-{}'.format(key_size)).encode('utf-8'),
+                None, default_backend())
+            for _ in range(key_pool_size)]
+        self._key_pems = [_key_pem(key) for key in self._keys]
+        self._serial = 1
+        name = x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, 'Synthetic CA')])
+        self._ca_name = name
+        self._ca_key = ca_key
+        self.ca_certificate = _cert_pem(
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(ca_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(self.now - datetime.timedelta(days=1))
+            .not_valid_after(self.now + datetime.timedelta(days=3650))
+            .add_extension(
+                x509.BasicConstraints(ca=True, path_length=None),
+                critical=True)
+            .sign(ca_key, hashes.SHA256(), default_backend()))
+
+    def issue(self, common_name, sans, valid_days=365):
+        """Issue a certificate.
+
+        :param common_name: Subject CN
+        :type common_name: str
+        :param sans: DNS names and IP addresses
+        :type sans: List[str]
+        :param valid_days: Days until the certificate expires
+        :type valid_days: int
+        :returns: PEM text keyed on 'key' and 'cert'
+        :rtype: Dict[str, str]
+        """
+        index = 1 + self._serial % (len(self._keys) - 1)
+        return {
+            'key': self._key_pems[index],
+            'cert': self._sign(
+                common_name, sans, self._keys[index].public_key(),
+                valid_days)}
+
+    def sign(self, common_name, sans, key, valid_days=365):
+        """Issue a certificate for a given private key.
+
+        :param common_name: Subject CN
+        :type common_name: str
+        :param sans: DNS names and IP addresses
+        :type sans: List[str]
+        :param key: PEM text of the private key
+        :type key: str
+        :param valid_days: Days until the certificate expires
+        :type valid_days: int
+        :returns: PEM text of the certificate
+        :rtype: str
+        """
+        # The keys are generated locally, checking them would cost more
+        # than signing.
+        private_key = serialization.load_pem_private_key(
+            key.encode('utf-8'), None, default_backend(),
+            unsafe_skip_rsa_key_validation=True)
+        return self._sign(
+            common_name, sans, private_key.public_key(), valid_days)
+
+    def _sign(self, common_name, sans, public_key, valid_days):
+        self._serial += 1
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([
+                x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+            .issuer_name(self._ca_name)
+            .public_key(public_key)
+            .serial_number(self._serial)
+            .not_valid_before(self.now - datetime.timedelta(days=1))
+            .not_valid_after(
+                self.now + datetime.timedelta(days=valid_days)))
+        if sans:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName([_san(san) for san in sans]),
+                critical=False)
+        cert = builder.sign(self._ca_key, hashes.SHA256(), default_backend())
+        return _cert_pem(cert)
+
+
+def requests(prefix, count):
+    """Return synthetic (CN, SANs) requests.
+
+    :param prefix: Prefix of the CNs
+    :type prefix: str
+    :param count: Number of requests
+    :type count: int
+    :returns: Requests
+    :rtype: List[Tuple[str, List[str]]]
+    """
+    return [
+        ('{}{}.example.com'.format(prefix, i),
+         ['{}{}.example.com'.format(prefix, i),
+          '*.{}{}.example.com'.format(prefix, i),
+          str(ipaddress.ip_address('10.0.0.0') + i)])
+        for i in range(count)]
+
+
+def relation_data(ca, unit_name, count):
+    """Return relation data of a unit and of a CA which answered it.
+
+    The unit requests count server and count client certificates, one
+    application certificate and one legacy certificate.
+
+    :param ca: CA issuing the certificates
+    :type ca: SyntheticCA
+    :param unit_name: Name of the requesting unit
+    :type unit_name: str
+    :param count: Number of server and of client certificates
+    :type count: int
+    :returns: Relation data of the unit and of the CA unit
+    :rtype: Tuple[Dict[str, str], Dict[str, str]]
+    """
+    munged_name = unit_name.replace('/', '_')
+    server_requests = requests('server', count)
+    client_requests = requests('client', count)
+    app_sans = ['app.example.com', '10.1.0.1']
+    unit_data = {
+        'cert_requests': json.dumps(
+            {cn: {'sans': sans} for cn, sans in server_requests},
+            sort_keys=True),
+        'client_cert_requests': json.dumps(
+            {cn: {'sans': sans} for cn, sans in client_requests},
+            sort_keys=True),
+        'application_cert_requests': json.dumps(
+            {'app.example.com': {'sans': app_sans}}),
+        'common_name': server_requests[-1][0],
+        'sans': json.dumps(server_requests[-1][1]),
+        'unit_name': unit_name}
+    processed_server = {
+        cn: ca.issue(cn, sans, 30 + i % 365)
+        for i, (cn, sans) in enumerate(server_requests)}
+    legacy = processed_server[server_requests[-1][0]]
+    ca_data = {
+        'ca': ca.ca_certificate,
+        'chain': ca.ca_certificate,
+        '{}.processed_requests'.format(munged_name): json.dumps(
+            processed_server),
+        '{}.processed_client_requests'.format(munged_name): json.dumps({
+            cn: ca.issue(cn, sans, 30 + i % 365)
+            for i, (cn, sans) in enumerate(client_requests)}),
+        '{}.processed_application_requests'.format(munged_name): json.dumps({
+            'app_data': ca.issue('app.example.com', app_sans)}),
+        '{}.server.cert'.format(munged_name): legacy['cert'],
+        '{}.server.key'.format(munged_name): legacy['key']}
+    return unit_data, ca_data
@@ -55,7 +55,7 @@ The simplest request is one server certificate::
             # written to the target files and used by the target application.
             self.TLS_KEY_PATH.write_bytes(self.ca_client.key.private_bytes(
                 encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption(),
             ))
             self.TLS_CERT_PATH.write_bytes(
@@ -64,14 +64,104 @@ The simplest request is one server certificate::
                 self.ca_client.ca_certificate.public_bytes(encoding=serialization.Encoding.PEM))
             # Reconfigure and reload your application after writing to files.
 
+Alternatively `self.ca_client.write_certificates(directory)` writes the CA
+certificate, chain, keys and certificates atomically and returns the paths
+whose content changed, so the application only needs reloading when that list
+is not empty.
 
 To request an additional server certificate
-`self.ca_client.request_server_certificate` can be called again.
+`self.ca_client.request_server_certificate` can be called again. Many
+certificates are best requested at once with
+`self.ca_client.request_server_certificates`, which takes (common name, sans)
+pairs and updates the relation only once.
 
 To request a client certificate
 `self.ca_client.request_client_certificate` should be used and the charm should
 obsever the `tls_client_config_ready` event.
 
+Requests take an optional `key_type`, for example
+`self.ca_client.request_server_certificates(requests, key_type='P-256')`, to
+ask for elliptic curve or Ed25519 keys rather than the CA's default, usually
+RSA-2048; see `interface_tls_certificates.keys` for the supported types.
+Elliptic curve keys make handshakes and parsing cheaper and relation data
+smaller. Key objects returned are then of the matching cryptography type and
+`certificate_metadata` gives the key type of each certificate. The legacy
+`common_name` and `sans` fields cannot carry a key type and are not sent with
+such requests.
+
+Ready events carry `added`, `changed` and `removed` lists of CNs relative to
+the previous ready event of the same type, so handlers managing many
+certificates only need to rewrite the files of those CNs.
+
+While a CA works through many requests of one type, the
+`tls_certificates_issued` event announces the CNs issued so far so they can be
+used before the `tls_*_config_ready` event for the whole type.
+
+At the end of every hook `certificate_expiring` is emitted once for each
+issued certificate which expires within `expiry_threshold` seconds, 30 days by
+default. `self.ca_client.next_expiry` gives the certificate expiring first.
+
+Certificates can also be renewed automatically by passing `renew_before`, in
+seconds, to CAClient. Each unit renews up to `renewal_jitter` seconds earlier
+still, by an amount derived from its name, and at most `renewals_per_hook`
+certificates are requested again per hook, so that many units do not all ask
+the CA for new certificates at once.
+
+`self.ca_client.certificate_metadata(request_type, common_name)` returns the
+serial, validity, subject CN, SANs and key type of an issued certificate, read
+straight from its DER encoding without loading the key or OpenSSL, which is
+enough for inventories and expiry checks. The metadata is kept in StoredState
+so each certificate is only decoded once, when it is received.
+
+A TLS proxy serving many names can pick the certificate to present for the
+hostname a client asked for with
+`self.ca_client.certificate_for_hostname(hostname)`, which looks the name up
+in an index of the SANs of the issued certificates.
+
+The endpoint may be related to several CAs, for example one for internal and
+one for external traffic. Requests, issued material and events are then kept
+per relation: every event carries a `relation_id` and `request_certificate`,
+`certs`, `certificate_bytes`, `write_certificates` and the other methods take
+a `relation_id` argument. Properties such as `server_certs` use the only
+relation of the endpoint and raise `TooManyRelatedAppsError` when there are
+several.
+
+Request and response fields holding many certificates are large. Both sides
+advertise in the `encodings` field of their relation data that they read
+zlib compressed values, see `interface_tls_certificates.compression`, and
+CAClient compresses its requests once all the CA units advertise it, falling
+back to plain JSON as soon as one does not. CAClient always reads both. Pass
+`compress=False` to neither advertise nor compress.
+
+To find out where a slow hook spends its time, create the client with
+`CAClient(self, 'ca-client', instrument=True)`. The time spent parsing PEM,
+decoding JSON and reading relation data is then available from
+`self.ca_client.instrumentation.as_dict()` and logged at the end of the
+dispatch.
+
+A unit holding many certificates can keep the issued certificates and keys out
+of the charm's stored state, which is written at the end of every hook, with
+`CAClient(self, 'ca-client', store=store.DirectoryStore(path))`, store being
+`interface_tls_certificates.store`. They are then kept
+in files named after their digest in a directory only the charm can read, and
+only the digests are kept in the stored state. Each CAClient needs a directory
+of its own, which must be kept for the lifetime of the unit. The texts of a
+CN are only read from the store when the CN is looked up. The stored state
+still keeps a few small records per certificate: its digests, its metadata,
+the CA unit it came from, its place in the expiry and SNI indexes and what
+was last announced. It therefore still grows with the number of
+certificates, at about 40% of its size without a store, and is written in
+the hooks which change it.
+
+With `CAClient(self, 'ca-client', csr=True)` private keys of server and client
+certificates never travel in relation data: the unit generates each key
+itself, in parallel when many certificates are requested at once, and sends a
+certificate signing request in the 'csr' field of the request instead. The
+CA answers with the certificate only, which is paired with the key kept by
+the unit, in the store if there is one. The legacy `common_name` and `sans`
+fields are not sent in that mode, and application certificates, which are
+shared by all the units, are still generated with their key by the CA.
+
 Finally to request an application certificate (certificate which works on all
 units of an application by combining all the sans) the use
 `self.ca_client.request_application_certificate` and observer
@@ -79,13 +169,15 @@ units of an application by combining all the sans) the use
 """
 
 
+import base64
+import collections.abc
 import functools
+import hashlib
+import heapq
 import json
 import logging
-
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from cryptography.x509 import load_pem_x509_certificate
+import os
+import time
 
 from ops.framework import (
     Object,
@@ -94,10 +186,129 @@ from ops.framework import (
     EventSource,
     StoredState
 )
-from ops.model import ModelError, BlockedStatus, WaitingStatus
+from ops.model import (
+    ModelError,
+    BlockedStatus,
+    TooManyRelatedAppsError,
+    WaitingStatus
+)
+
+from . import compression, der, keys, sni
+from .files import write_files
+from .hashing import fingerprint
 logger = logging.getLogger(__name__)
 
 
+def _now():
+    """Return the current time.
+
+    :returns: Seconds since the epoch
+    :rtype: float
+    """
+    return time.time()
+
+
+def _certificate_names(metadata):
+    """Return the DNS names and IP addresses a certificate is for.
+
+    The subject CN is used when the certificate has no SAN extension.
+
+    :param metadata: Metadata of the certificate
+    :type metadata: Mapping[str, Any]
+    :returns: DNS names and IP addresses
+    :rtype: List[str]
+    """
+    if metadata['dns_names'] is None:
+        return [metadata['common_name']] if metadata['common_name'] else []
+    return list(metadata['dns_names']) + list(metadata['ip_addresses'])
+
+
+def _pem_digest(txt_pem):
+    """Return a digest identifying the given PEM text.
+
+    :param txt_pem: PEM text
+    :type txt_pem: str
+    :returns: Hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(txt_pem.encode('utf-8')).hexdigest()
+
+
+def _load_pem_private_key(data):
+    """Return the private key object for PEM data.
+
+    cryptography is imported on first use rather than with this module, so
+    hooks that never parse keys or certificates do not load OpenSSL.
+
+    :param data: PEM data
+    :type data: bytes
+    :returns: Key
+    :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
+    """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.serialization import (
+        load_pem_private_key)
+    return load_pem_private_key(
+        data,
+        password=None,
+        backend=default_backend())
+
+
+def _load_pem_x509_certificate(data):
+    """Return the certificate object for PEM data.
+
+    cryptography is imported on first use, see _load_pem_private_key.
+
+    :param data: PEM data
+    :type data: bytes
+    :returns: Certificate
+    :rtype: default_backend.openssl.x509._Certificate
+    """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.x509 import load_pem_x509_certificate
+    return load_pem_x509_certificate(
+        data,
+        backend=default_backend())
+
+
+def _load_pem_metadata(data):
+    """Return the metadata of the certificate in PEM data.
+
+    :param data: PEM data
+    :type data: bytes
+    :returns: Metadata, see der.certificate_metadata
+    :rtype: Dict[str, Any]
+    :raises: ValueError
+    """
+    return der.certificate_metadata(_pem_to_der(data))
+
+
+def _pem_to_der(data):
+    """Return the DER encoding held in the first block of PEM data.
+
+    :param data: PEM data
+    :type data: bytes
+    :returns: DER data
+    :rtype: bytes
+    :raises: ValueError
+    """
+    lines = data.splitlines()
+    try:
+        start = next(
+            i for i, line in enumerate(lines)
+            if line.startswith(b'-----BEGIN'))
+        end = next(
+            i for i, line in enumerate(lines[start:], start)
+            if line.startswith(b'-----END'))
+    except StopIteration:
+        raise ValueError('No PEM block found')
+    # Skip RFC 1421 headers, which are separated from the body by a blank line
+    body = lines[start + 1:end]
+    if b'' in body:
+        body = body[body.index(b'') + 1:]
+    return base64.b64decode(b''.join(body))
+
+
 class TLSCertificatesError(ModelError):
     """A base class for all errors raised by interface-tls-certificates.
 
@@ -124,9 +335,20 @@ class CAAvailable(EventBase):
     multiple events will be triggered.
 
     The expected response from a handler of that event is to request a
-    certificate from the CA via the API provided by CAClient.
+    certificate from the CA via the API provided by CAClient, passing on
+    the relation_id of the event.
     """
 
+    def __init__(self, handle, relation_id=None):
+        super().__init__(handle)
+        self.relation_id = relation_id
+
+    def snapshot(self):
+        return {'relation_id': self.relation_id}
+
+    def restore(self, snapshot):
+        self.relation_id = snapshot['relation_id']
+
 
 class TLSConfigReady(EventBase):
     """Event emitted by CAClient.on.tls_config_ready.
@@ -135,8 +357,95 @@ class TLSConfigReady(EventBase):
 
     The expected response from a handler of that event is to request a
     certificate from the CA via the API provided by CAClient.
+
+    The event carries the CNs whose certificates were added, re-issued
+    (changed) or removed since the previous event of the same type and
+    relation, so a handler only needs to update the material of those CNs.
+    """
+
+    def __init__(self, handle, added=None, changed=None, removed=None,
+                 relation_id=None):
+        super().__init__(handle)
+        self.added = list(added or [])
+        self.changed = list(changed or [])
+        self.removed = list(removed or [])
+        self.relation_id = relation_id
+
+    def snapshot(self):
+        return {
+            'added': self.added,
+            'changed': self.changed,
+            'removed': self.removed,
+            'relation_id': self.relation_id}
+
+    def restore(self, snapshot):
+        self.added = snapshot['added']
+        self.changed = snapshot['changed']
+        self.removed = snapshot['removed']
+        self.relation_id = snapshot['relation_id']
+
+
+class TLSCertificatesIssued(EventBase):
+    """Event emitted by CAClient.on.tls_certificates_issued.
+
+    This event will be emitted by CAClient when a remote CA unit has issued
+    some of the requested certificates of a type, even if other requests of
+    that type are still pending. It carries the request type and only the
+    CNs that became ready, so those can be used straight away.
+    """
+
+    def __init__(self, handle, request_type=None, common_names=None,
+                 relation_id=None):
+        super().__init__(handle)
+        self.request_type = request_type
+        self.common_names = list(common_names or [])
+        self.relation_id = relation_id
+
+    def snapshot(self):
+        return {
+            'request_type': self.request_type,
+            'common_names': self.common_names,
+            'relation_id': self.relation_id}
+
+    def restore(self, snapshot):
+        self.request_type = snapshot['request_type']
+        self.common_names = snapshot['common_names']
+        self.relation_id = snapshot['relation_id']
+
+
+class CertificateExpiring(EventBase):
+    """Event emitted by CAClient.on.certificate_expiring.
+
+    This event will be emitted by CAClient, at the end of any hook, once per
+    issued certificate whose expiry is closer than the expiry threshold of
+    the CAClient. It is emitted again if a certificate with the same CN
+    is issued and in turn comes close to expiry.
+
+    The expected response from a handler of that event is to request a new
+    certificate or alert an operator.
     """
 
+    def __init__(self, handle, request_type=None, common_name=None,
+                 expiry=None, relation_id=None):
+        super().__init__(handle)
+        self.request_type = request_type
+        self.common_name = common_name
+        self.expiry = expiry
+        self.relation_id = relation_id
+
+    def snapshot(self):
+        return {
+            'request_type': self.request_type,
+            'common_name': self.common_name,
+            'expiry': self.expiry,
+            'relation_id': self.relation_id}
+
+    def restore(self, snapshot):
+        self.request_type = snapshot['request_type']
+        self.common_name = snapshot['common_name']
+        self.expiry = snapshot['expiry']
+        self.relation_id = snapshot['relation_id']
+
 
 class CAClientEvents(ObjectEvents):
     """Events emitted by the CAClient class."""
@@ -146,6 +455,318 @@ class CAClientEvents(ObjectEvents):
     tls_app_config_ready = EventSource(TLSConfigReady)
     tls_server_config_ready = EventSource(TLSConfigReady)
     tls_client_config_ready = EventSource(TLSConfigReady)
+    tls_certificates_issued = EventSource(TLSCertificatesIssued)
+    certificate_expiring = EventSource(CertificateExpiring)
+
+
+class _Measurement:
+    """Context manager adding its duration to an Instrumentation."""
+
+    def __init__(self, instrumentation, phase, request_type):
+        self._instrumentation = instrumentation
+        self._key = (phase, request_type or 'all')
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._instrumentation.record(
+            self._key, time.perf_counter() - self._start)
+        return False
+
+
+class _NoMeasurement:
+    """Context manager used when instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+
+class Instrumentation:
+    """Counters and cumulative timers of the costly phases of CAClient.
+
+    Phases are PARSE (building key and certificate objects from PEM), JSON
+    (decoding relation data) and RELATION_READ (reading relation data from
+    the Juju agent). Each is broken down by request type, 'ca' for CA
+    certificates and 'all' when the work is shared by all request types.
+    Only work actually done is counted, cache hits are not.
+    """
+
+    PARSE = 'parse'
+    JSON = 'json'
+    RELATION_READ = 'relation_read'
+
+    def __init__(self, enabled=False):
+        """
+        :param enabled: Whether to record anything
+        :type enabled: bool
+        """
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self._counts = collections.defaultdict(int)
+        self._seconds = collections.defaultdict(float)
+
+    def measure(self, phase, request_type=None):
+        """Return a context manager recording the duration of a phase.
+
+        :param phase: PARSE, JSON or RELATION_READ
+        :type phase: str
+        :param request_type: Certificate type the work is done for
+        :type request_type: Optional[str]
+        :returns: Context manager
+        :rtype: ContextManager
+        """
+        if not self.enabled:
+            return _NO_MEASUREMENT
+        return _Measurement(self, phase, request_type)
+
+    def record(self, key, seconds):
+        """Record one occurrence of a phase.
+
+        :param key: Phase and request type
+        :type key: Tuple[str, str]
+        :param seconds: Time taken
+        :type seconds: float
+        """
+        self._counts[key] += 1
+        self._seconds[key] += seconds
+
+    def as_dict(self):
+        """Return what was recorded so far.
+
+        :returns: Count and seconds keyed on phase then request type
+        :rtype: Dict[str, Dict[str, Dict[str, Union[int, float]]]]
+        """
+        stats = {}
+        for (phase, request_type), count in sorted(self._counts.items()):
+            stats.setdefault(phase, {})[request_type] = {
+                'count': count,
+                'seconds': self._seconds[(phase, request_type)]}
+        return stats
+
+
+class CertificateEntry(collections.abc.Mapping):
+    """Read-only view of the 'key' and 'cert' issued for one CN.
+
+    The key and certificate are parsed on first access, via the parse cache
+    of the owning CAClient.
+    """
+
+    _LOADERS = {
+        'key': '_load_key',
+        'cert': '_load_cert'}
+
+    def __init__(self, ca_client, data, request_type=None):
+        """
+        :param ca_client: CAClient owning the parse cache
+        :type ca_client: CAClient
+        :param data: PEM text keyed on 'key' and 'cert'
+        :type data: Dict[str, str]
+        :param request_type: Certificate type of the entry
+        :type request_type: Optional[str]
+        """
+        self._ca_client = ca_client
+        self._data = data
+        self._request_type = request_type
+
+    def __getitem__(self, name):
+        loader = getattr(self._ca_client, self._LOADERS[name])
+        return loader(self._data[name], self._request_type)
+
+    def __iter__(self):
+        return iter(self._LOADERS)
+
+    def __len__(self):
+        return len(self._LOADERS)
+
+
+class CertificateMapping(collections.abc.Mapping):
+    """Read-only mapping of CN to `CertificateEntry`_.
+
+    Nothing is parsed until an entry's key or certificate is accessed. The
+    extra 'default' entry is an alias for the lowest sorting CN.
+    """
+
+    DEFAULT = 'default'
+
+    def __init__(self, ca_client, crypto_data, request_type=None):
+        """
+        :param ca_client: CAClient owning the parse cache
+        :type ca_client: CAClient
+        :param crypto_data: PEM text keyed on CN then 'key' and 'cert'
+        :type crypto_data: Dict[str, Dict[str, str]]
+        :param request_type: Certificate type of the entries
+        :type request_type: Optional[str]
+        """
+        self._ca_client = ca_client
+        self._crypto_data = crypto_data
+        self._request_type = request_type
+
+    def __getitem__(self, cn):
+        if cn == self.DEFAULT and self._crypto_data:
+            cn = min(self._crypto_data)
+        return CertificateEntry(
+            self._ca_client, self._crypto_data[cn], self._request_type)
+
+    def __iter__(self):
+        yield from self._crypto_data
+        if self._crypto_data and self.DEFAULT not in self._crypto_data:
+            yield self.DEFAULT
+
+    def __len__(self):
+        if self._crypto_data and self.DEFAULT not in self._crypto_data:
+            return len(self._crypto_data) + 1
+        return len(self._crypto_data)
+
+
+class _StoredMaterial(collections.abc.Mapping):
+    """Read-only mapping of CN to the certificate and key kept in a store.
+
+    The texts of a CN are loaded from the store when it is first looked up,
+    so reading one certificate does not load those of every other CN.
+    """
+
+    def __init__(self, refs, resolve):
+        """
+        :param refs: Digests of the texts keyed on CN then 'key' and 'cert'
+        :type refs: Mapping[str, Mapping[str, str]]
+        :param resolve: Callable returning the text of a digest
+        :type resolve: Callable[[str], str]
+        """
+        self._refs = refs
+        self._resolve = resolve
+        self._texts = {}
+
+    def __getitem__(self, cn):
+        try:
+            return self._texts[cn]
+        except KeyError:
+            data = self._texts[cn] = {
+                name: self._resolve(ref)
+                for name, ref in self._refs[cn].items()}
+            return data
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+
+class _RelationSnapshot:
+    """Relation data of this unit and remote units, read and decoded once.
+
+    A snapshot is reused for the rest of a dispatch and must be discarded
+    once relation data is written or a relation event is observed.
+    """
+
+    def __init__(self, relation, unit, instrumentation):
+        """
+        :param relation: The relation or None if there is no relation
+        :type relation: Optional[ops.model.Relation]
+        :param unit: This unit
+        :type unit: ops.model.Unit
+        :param instrumentation: Where to record the cost of reads
+        :type instrumentation: Instrumentation
+        """
+        self.relation = relation
+        self._instrumentation = instrumentation
+        self.local = {}
+        if relation:
+            with instrumentation.measure(Instrumentation.RELATION_READ):
+                self.local = dict(relation.data[unit])
+        self._remote = {}
+        self._decoded = {}
+        self._requests = None
+
+    def remote(self, unit):
+        """Return the relation data of a remote unit.
+
+        :param unit: Remote unit
+        :type unit: ops.model.Unit
+        :returns: Relation data of the unit
+        :rtype: Dict[str, str]
+        """
+        try:
+            return self._remote[unit.name]
+        except KeyError:
+            with self._instrumentation.measure(Instrumentation.RELATION_READ):
+                data = self._remote[unit.name] = dict(
+                    self.relation.data[unit])
+            return data
+
+    def decode(self, data, field, default, request_type=None):
+        """Return the JSON decoded value of field in data.
+
+        Values may be compressed, see compression.decode. Callers must not
+        modify the returned value.
+
+        :param data: Data returned by self.local or self.remote
+        :type data: Dict[str, str]
+        :param field: Key in data
+        :type field: str
+        :param default: Value to decode when field is absent or empty
+        :type default: str
+        :param request_type: Certificate type the field is decoded for
+        :type request_type: Optional[str]
+        :returns: Decoded value
+        :rtype: Any
+        """
+        cache_key = (id(data), field)
+        try:
+            return self._decoded[cache_key]
+        except KeyError:
+            with self._instrumentation.measure(
+                    Instrumentation.JSON, request_type):
+                value = self._decoded[cache_key] = compression.decode(
+                    data.get(field) or default)
+            return value
+
+    @property
+    def legacy_request_cn(self):
+        """The common name requested using legacy method, if any.
+
+        :returns: Common name
+        :rtype: Optional[str]
+        """
+        return self.local.get('common_name')
+
+    def requests(self, request_keys):
+        """Return all the certificate requests this unit has made.
+
+        :param request_keys: Relation data key of each request type
+        :type request_keys: Dict[str, str]
+        :returns: Dict keyed on request type
+        :rtype: Dict[str, Dict[str, Dict[str, List[str]]]]
+        """
+        if self._requests is not None:
+            return self._requests
+        requests = {}
+        if self.relation is not None:
+            for request_type, request_key in request_keys.items():
+                if request_type == 'legacy':
+                    cn = self.legacy_request_cn
+                    if cn:
+                        requests[request_type] = {
+                            cn: {
+                                'sans': self.decode(
+                                    self.local, 'sans', '[]',
+                                    request_type)}}
+                else:
+                    requests[request_type] = self.decode(
+                        self.local, request_key, '{}', request_type)
+        self._requests = requests
+        return requests
 
 
 class CAClient(Object):
@@ -171,22 +792,102 @@ class CAClient(Object):
         'client': 'client_cert_requests',
         'application': 'application_cert_requests'}
 
+    ENCODING_PEM = 'pem'
+    ENCODING_DER = 'der'
+
     PROCESSED_KEYS = {
         'legacy': '',
         'server': 'processed_requests',
         'client': 'processed_client_requests',
         'application': 'processed_application_requests'}
 
-    def __init__(self, charm, relation_name):
+    # Emit certificate_expiring 30 days before a certificate expires
+    EXPIRY_THRESHOLD = 30 * 24 * 60 * 60
+
+    # Spread renewals of different units over up to 7 days
+    RENEWAL_JITTER = 7 * 24 * 60 * 60
+
+    # Re-request at most this many certificates in one hook
+    RENEWALS_PER_HOOK = 20
+
+    # Certificate types certificate_for_hostname picks from, by preference
+    SNI_TYPES = ('server', 'application', 'legacy')
+
+    # Certificate types whose keys are generated locally with csr
+    CSR_TYPES = ('server', 'client')
+
+    def __init__(self, charm, relation_name, instrument=False,
+                 expiry_threshold=EXPIRY_THRESHOLD, renew_before=None,
+                 renewal_jitter=RENEWAL_JITTER,
+                 renewals_per_hook=RENEWALS_PER_HOOK, store=None, csr=False,
+                 key_type=keys.DEFAULT_KEY_TYPE, processes=None,
+                 compress=True):
         """
         :param charm: the charm object to be used as a parent object.
         :type charm: :class: `ops.charm.CharmBase`
+        :param relation_name: the name of the relation with the CA.
+        :type relation_name: str
+        :param instrument: whether to record the cost of parsing, JSON
+            decoding and relation reads in self.instrumentation and log it
+            at the end of the dispatch.
+        :type instrument: bool
+        :param expiry_threshold: how many seconds before a certificate
+            expires to emit certificate_expiring.
+        :type expiry_threshold: int
+        :param renew_before: how many seconds before a certificate expires
+            to request it again, None to never renew automatically.
+        :type renew_before: Optional[int]
+        :param renewal_jitter: up to how many seconds earlier still a unit
+            renews its certificates. Each unit has its own fixed share of it.
+        :type renewal_jitter: int
+        :param renewals_per_hook: how many certificates to request again
+            in one hook at most.
+        :type renewals_per_hook: int
+        :param store: where to keep issued certificates and keys, None to
+            keep them in the stored state. Once material has been saved to a
+            store, the same store must be passed on every later hook.
+        :type store: Optional[store.MaterialStore]
+        :param csr: whether to generate the keys of server and client
+            certificates locally and send CSRs rather than let the CA
+            generate them.
+        :type csr: bool
+        :param key_type: type of the keys generated with csr, see
+            keys.generate_key.
+        :type key_type: str
+        :param processes: number of processes generating keys with csr, None
+            for one per core.
+        :type processes: Optional[int]
+        :param compress: whether to advertise that compressed responses are
+            read, and to compress requests when all the CA units do.
+        :type compress: bool
         """
         super().__init__(charm, relation_name)
         self._relation_name = self.relation_name = relation_name
         self._common_name = None
         self._sans = None
         self._munged_name = self.model.unit.name.replace("/", "_")
+        # Parsed key and certificate objects keyed on the digest of their PEM
+        # text, shared by all request types.
+        self._parsed = {}
+        # Relation data snapshots keyed on relation id and the relations of
+        # the endpoint keyed on relation id, both read once per dispatch.
+        self._snapshots = {}
+        self._relations = None
+        # Material loaded from the store keyed on relation id and request type
+        self._store = store
+        self._loaded = {}
+        self.instrumentation = Instrumentation(enabled=instrument)
+        self.expiry_threshold = expiry_threshold
+        self.renew_before = renew_before
+        self.renewal_jitter = renewal_jitter
+        self.renewals_per_hook = renewals_per_hook
+        self.csr = csr
+        self.key_type = key_type
+        self.processes = processes
+        self.compress = compress
+        # Material is stored per relation in relations, keyed on the relation
+        # id. The top level ca_certificate, root_ca_chain and certificate
+        # type fields are only read to migrate what earlier versions stored.
         self._stored.set_default(
             ca_certificate=None,
             key=None,
@@ -195,45 +896,273 @@ class CAClient(Object):
             legacy=None,
             client=None,
             server=None,
-            application=None)
+            application=None,
+            relations={},
+            expiry=[],
+            metadata={})
         self.framework.observe(charm.on[relation_name].relation_joined,
                                self._on_relation_joined)
         self.framework.observe(charm.on[relation_name].relation_changed,
                                self._on_relation_changed)
+        self.framework.observe(charm.on[relation_name].relation_created,
+                               self._invalidate_snapshot)
+        self.framework.observe(charm.on[relation_name].relation_departed,
+                               self._on_relation_departed)
+        self.framework.observe(charm.on[relation_name].relation_broken,
+                               self._on_relation_broken)
+        self.framework.observe(self.framework.on.pre_commit,
+                               self._on_pre_commit)
+        self.framework.observe(self.framework.on.commit,
+                               self._on_commit)
         self.ready_events = {
             'legacy': self.on.tls_config_ready,
             'server': self.on.tls_server_config_ready,
             'client': self.on.tls_client_config_ready,
             'application': self.on.tls_app_config_ready}
+        self._migrate_stored()
+
+    def _migrate_stored(self):
+        """Move the material stored by earlier versions under its relation.
+
+        Earlier versions supported a single relation and stored its material
+        at the top level of the stored state. It is moved to the state of
+        the relation, or dropped if the relation is gone.
+        """
+        names = ['ca_certificate', 'root_ca_chain'] + list(self.REQUEST_KEYS)
+        if not any(getattr(self._stored, name) for name in names):
+            return
+        relations = self._get_relations()
+        if len(relations) == 1:
+            relation_id = next(iter(relations))
+            state = self._state(relation_id)
+            state['ca_certificate'] = self._stored.ca_certificate
+            state['root_ca_chain'] = self._stored.root_ca_chain
+            for request_type in self.REQUEST_KEYS:
+                crypto_data = getattr(self._stored, request_type)
+                if crypto_data:
+                    self._store_certificates(
+                        request_type,
+                        {cn: dict(data) for cn, data in crypto_data.items()},
+                        relation_id)
+        for name in names:
+            setattr(self._stored, name, None)
+
+    def _state(self, relation_id):
+        """Return what is stored about a relation, creating it if needed.
+
+        Most fields hold a record per CN, with a store too; the fields of
+        the certificate types then only hold the digests of the texts.
+
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Stored state of the relation
+        :rtype: ops.framework.StoredDict
+        """
+        key = str(relation_id)
+        if key not in self._stored.relations:
+            self._stored.relations[key] = {
+                'ca_certificate': None,
+                'root_ca_chain': None,
+                'legacy': None,
+                'server': None,
+                'client': None,
+                'application': None,
+                'fingerprints': {},
+                'announced': {},
+                'expiry_notified': {},
+                'unit_index': {},
+                'owners': {},
+                'digests': {},
+                'csr_keys': {},
+                'sni': None}
+        return self._stored.relations[key]
+
+    def _stored_value(self, relation_id, name):
+        """Return a value stored about a relation without creating its state.
+
+        :param relation_id: Relation id or None if there is no relation
+        :type relation_id: Optional[int]
+        :param name: Name of the value, e.g. 'ca_certificate' or 'server'
+        :type name: str
+        :returns: Stored value or None
+        :rtype: Any
+        """
+        state = self._stored.relations.get(str(relation_id))
+        if state is None:
+            return None
+        return state[name]
+
+    def _get_relations(self):
+        """Return the relations of the endpoint keyed on relation id.
+
+        The index is built once per dispatch so that looking up one relation
+        does not scan all the relations of the endpoint.
+
+        :returns: Relations keyed on relation id
+        :rtype: Dict[int, ops.model.Relation]
+        """
+        if self._relations is None:
+            self._relations = {
+                relation.id: relation
+                for relation in self.framework.model.relations[
+                    self._relation_name]}
+        return self._relations
+
+    @property
+    def relation_ids(self):
+        """Ids of the relations of the endpoint.
+
+        :returns: Sorted relation ids
+        :rtype: List[int]
+        """
+        return sorted(self._get_relations())
+
+    def _resolve_relation_id(self, relation_id=None):
+        """Return relation_id or the id of the only relation of the endpoint.
+
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Relation id or None if there is no relation
+        :rtype: Optional[int]
+        :raises: TooManyRelatedAppsError
+        """
+        if relation_id is not None:
+            return relation_id
+        relations = self._get_relations()
+        if len(relations) > 1:
+            raise TooManyRelatedAppsError(
+                self._relation_name, len(relations), 1)
+        return next(iter(relations), None)
 
     def _on_relation_joined(self, event):
-        self.on.ca_available.emit()
+        self._invalidate_snapshot()
+        self.on.ca_available.emit(event.relation.id)
+
+    def _on_relation_broken(self, event):
+        """Forget the material issued over a relation which is removed."""
+        self._invalidate_snapshot()
+        relation_id = event.relation.id
+        if self._stored.relations.pop(str(relation_id), None) is None:
+            return
+        logger.info('Dropping certificates of relation %s', relation_id)
+        heap = [
+            list(entry) for entry in self._stored.expiry
+            if entry[3] != relation_id]
+        heapq.heapify(heap)
+        self._stored.expiry = heap
+        self._parsed.clear()
+        self._loaded.clear()
+        self._prune_metadata()
+        self._prune_material()
+
+    def _on_pre_commit(self, event):
+        self.check_expiry()
+        self.renew_certificates()
+
+    def _on_commit(self, event):
+        """Log instrumentation and drop relation data at the end of a dispatch.
+        """
+        if self.instrumentation.enabled:
+            logger.info(
+                'CAClient %s costs: %s',
+                self._relation_name,
+                json.dumps(self.instrumentation.as_dict(), sort_keys=True))
+            self.instrumentation.reset()
+        self._invalidate_snapshot()
+
+    def _invalidate_snapshot(self, event=None):
+        """Discard the relations and relation data read so far.
+
+        :param event: Event triggering the invalidation, if any
+        :type event: Optional[ops.framework.EventBase]
+        """
+        self._snapshots.clear()
+        self._relations = None
+
+    def _get_snapshot(self, relation_id=None):
+        """Return relation data, reading it only once per dispatch.
+
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Snapshot of the relation data
+        :rtype: _RelationSnapshot
+        :raises: TooManyRelatedAppsError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        try:
+            return self._snapshots[relation_id]
+        except KeyError:
+            snapshot = self._snapshots[relation_id] = _RelationSnapshot(
+                self._get_relations().get(relation_id),
+                self.framework.model.unit,
+                self.instrumentation)
+            return snapshot
 
     @property
     def is_joined(self):
         """Whether this charm has joined the relation."""
-        rel = self.framework.model.get_relation(self._relation_name)
-        return rel is not None
+        return bool(self._get_relations())
 
     @property
     def is_ready(self):
         """Whether this charm has fulfilled the legacy certificate requests."""
-        return self._is_cert_ready('legacy')
+        return self.is_cert_ready('legacy')
 
-    def _is_cert_ready(self, cert_type):
-        """Check whether there is a response for the cert_type.
+    def is_cert_ready(self, request_type, relation_id=None):
+        """Check whether there is a response for the request_type.
 
-        :param cert_type: Certificate type
-        :type cert_type: str
-        :returns: Whether there is a response for the cert_type
+        :param request_type: Certificate type
+        :type request_type: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Whether there is a response for the request_type
         :rtype: bool
+        :raises: TooManyRelatedAppsError
         """
+        relation_id = self._resolve_relation_id(relation_id)
         try:
-            return all([
-                self.ca_certificate,
-                getattr(self._stored, cert_type)])
+            self._check_certificate(
+                self._stored_value(relation_id, 'ca_certificate'),
+                relation_id)
         except CAClientError:
             return False
+        if not self._stored_value(relation_id, request_type):
+            return False
+        return not self.pending_requests(request_type, relation_id)
+
+    def pending_requests(self, request_type, relation_id=None):
+        """Return the CNs requested for request_type not yet issued by a CA.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Sorted CNs, 'app_data' stands for an application request
+        :rtype: List[str]
+        :raises: TooManyRelatedAppsError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        request = self._get_all_requests(relation_id).get(request_type) or {}
+        # Only CNs are needed, which are also the keys of the stored digests.
+        crypto_data = self._stored_value(relation_id, request_type) or {}
+        return sorted(
+            key for key in self._request_keys(request_type, request)
+            if key not in crypto_data)
+
+    def _request_keys(self, request_type, request):
+        """Return the keys a response to request is expected to contain.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param request: Requests of request_type keyed on CN
+        :type request: Dict[str, Dict[str, List[str]]]
+        :returns: Keys of the response
+        :rtype: List[str]
+        """
+        if request_type == 'application':
+            # All application requests are combined into one certificate.
+            return ['app_data'] if request else []
+        return list(request)
 
     @property
     def is_application_cert_ready(self):
@@ -242,7 +1171,7 @@ class CAClient(Object):
         :returns: Whether requests have been fulfilled
         :rtype: bool
         """
-        return self._is_cert_ready('application')
+        return self.is_cert_ready('application')
 
     @property
     def is_server_cert_ready(self):
@@ -251,7 +1180,7 @@ class CAClient(Object):
         :returns: Whether requests have been fulfilled
         :rtype: bool
         """
-        return self._is_cert_ready('server')
+        return self.is_cert_ready('server')
 
     @property
     def is_client_cert_ready(self):
@@ -260,54 +1189,294 @@ class CAClient(Object):
         :returns: Whether requests have been fulfilled
         :rtype: bool
         """
-        return self._is_cert_ready('client')
+        return self.is_cert_ready('client')
 
-    def _get_certs_and_keys(self, request_type):
-        """For the given request_type return the certs and keys from the CA.
+    def _get_crypto_data(self, request_type, relation_id=None):
+        """For the given request_type return the stored PEM text from the CA.
 
         :param request_type: Certificate type
         :type request_type: str
-        :returns: Dictionary keyed on CN of certs and keys
-        :rtype: Dict[str, Union[
-            default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey,
-            default_backend.openssl.openssl.x509._Certificate]]
-        :raises: CAClientError
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: PEM text keyed on CN then 'key' and 'cert'
+        :rtype: Dict[str, Dict[str, str]]
+        :raises: CAClientError, TooManyRelatedAppsError
         """
-        if not self._is_certificate_requested(request_type):
+        relation_id = self._resolve_relation_id(relation_id)
+        if not self._is_certificate_requested(request_type, relation_id):
             raise CAClientError(BlockedStatus,
                                 'a certificate request has not been sent',
                                 self._relation_name)
-        crypto_data = getattr(self._stored, request_type)
+        crypto_data = self._material(relation_id, request_type)
         if not crypto_data:
             raise CAClientError(
                 WaitingStatus,
                 'a {} has not been obtained yet.'.format(request_type),
                 self._relation_name)
-        pem_data = {}
-        for cn, data in crypto_data.items():
-            pem_data[cn] = {
-                'key': load_pem_private_key(
-                    data['key'].encode('utf-8'),
-                    password=None,
-                    backend=default_backend()),
-                'cert': load_pem_x509_certificate(
-                    data['cert'].encode('utf-8'),
-                    backend=default_backend())}
-        if pem_data:
-            default_entry = sorted(pem_data.keys())[0]
-            pem_data['default'] = pem_data[default_entry]
-        return pem_data
-
-    def _get_certificate(self, txt_cert):
+        return crypto_data
+
+    def _get_certs_and_keys(self, request_type, relation_id=None):
+        """For the given request_type return the certs and keys from the CA.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Mapping keyed on CN of certs and keys
+        :rtype: CertificateMapping
+        :raises: CAClientError, TooManyRelatedAppsError
+        """
+        return CertificateMapping(
+            self,
+            self._get_crypto_data(request_type, relation_id),
+            request_type)
+
+    def certs(self, request_type, relation_id=None):
+        """Certificates and keys of a type returned by the CA of a relation.
+
+        This is what server_certs, client_certs and application_certs return
+        for the only relation, for use when there are several relations.
+
+        :param request_type: Certificate type, one of REQUEST_KEYS
+        :type request_type: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Read-only mapping keyed on CN of certs and keys
+        :rtype: CertificateMapping
+        :raises: CAClientError, TooManyRelatedAppsError
+        """
+        return self._get_certs_and_keys(request_type, relation_id)
+
+    def _encode(self, txt_pem, encoding, request_type=None):
+        """Return txt_pem in the given encoding without parsing it.
+
+        :param txt_pem: PEM text
+        :type txt_pem: str
+        :param encoding: ENCODING_PEM or ENCODING_DER
+        :type encoding: str
+        :param request_type: Certificate type txt_pem was issued for
+        :type request_type: Optional[str]
+        :returns: Encoded data
+        :rtype: bytes
+        :raises: ValueError
+        """
+        if encoding == self.ENCODING_PEM:
+            return txt_pem.encode('utf-8')
+        if encoding == self.ENCODING_DER:
+            return self._load_pem('der', txt_pem, _pem_to_der, request_type)
+        raise ValueError('Unknown encoding: {}'.format(encoding))
+
+    def _get_entry_bytes(self, request_type, common_name, name, encoding,
+                         relation_id=None):
+        """Return the stored key or cert of a CN in the given encoding.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param common_name: CN or 'default'
+        :type common_name: str
+        :param name: 'key' or 'cert'
+        :type name: str
+        :param encoding: ENCODING_PEM or ENCODING_DER
+        :type encoding: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Encoded data
+        :rtype: bytes
+        :raises: CAClientError, KeyError, ValueError
+        """
+        crypto_data = self._get_crypto_data(request_type, relation_id)
+        if common_name == CertificateMapping.DEFAULT:
+            common_name = min(crypto_data)
+        return self._encode(
+            crypto_data[common_name][name], encoding, request_type)
+
+    def certificate_bytes(self, request_type, common_name='default',
+                          encoding='pem', relation_id=None):
+        """Return an issued certificate as bytes, without parsing it.
+
+        :param request_type: Certificate type, one of REQUEST_KEYS
+        :type request_type: str
+        :param common_name: CN of the certificate, 'default' for the lowest
+                            sorting CN
+        :type common_name: str
+        :param encoding: ENCODING_PEM or ENCODING_DER
+        :type encoding: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Certificate
+        :rtype: bytes
+        :raises: CAClientError, KeyError, ValueError
+        """
+        return self._get_entry_bytes(
+            request_type, common_name, 'cert', encoding, relation_id)
+
+    def key_bytes(self, request_type, common_name='default', encoding='pem',
+                  relation_id=None):
+        """Return an issued private key as bytes, without parsing it.
+
+        The DER encoding is the one held in the PEM text, PKCS#1 or PKCS#8
+        depending on what the CA sent.
+
+        :param request_type: Certificate type, one of REQUEST_KEYS
+        :type request_type: str
+        :param common_name: CN of the key, 'default' for the lowest sorting CN
+        :type common_name: str
+        :param encoding: ENCODING_PEM or ENCODING_DER
+        :type encoding: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Key
+        :rtype: bytes
+        :raises: CAClientError, KeyError, ValueError
+        """
+        return self._get_entry_bytes(
+            request_type, common_name, 'key', encoding, relation_id)
+
+    def ca_certificate_bytes(self, encoding='pem', relation_id=None):
+        """Return the CA certificate as bytes, without parsing it.
+
+        :param encoding: ENCODING_PEM or ENCODING_DER
+        :type encoding: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Certificate
+        :rtype: bytes
+        :raises: CAClientError, ValueError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        txt_cert = self._stored_value(relation_id, 'ca_certificate')
+        self._check_certificate(txt_cert, relation_id)
+        return self._encode(txt_cert, encoding, 'ca')
+
+    def root_ca_chain_bytes(self, relation_id=None):
+        """Return the PEM encoded CA chain, without parsing it.
+
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Certificates
+        :rtype: bytes
+        :raises: CAClientError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        txt_cert = self._stored_value(relation_id, 'root_ca_chain')
+        self._check_certificate(txt_cert, relation_id)
+        return self._encode(txt_cert, self.ENCODING_PEM)
+
+    def _load_pem(self, kind, txt_pem, loader, request_type=None):
+        """Return the parsed object for txt_pem, parsing it at most once.
+
+        :param kind: Kind of object made from txt_pem, 'key', 'cert', 'der'
+                     or 'metadata'
+        :type kind: str
+        :param txt_pem: PEM text
+        :type txt_pem: str
+        :param loader: Callable taking PEM bytes and returning the object
+        :type loader: Callable[[bytes], object]
+        :param request_type: Certificate type txt_pem was issued for
+        :type request_type: Optional[str]
+        :returns: Parsed object
+        :rtype: object
+        """
+        digest = (kind, _pem_digest(txt_pem))
+        try:
+            return self._parsed[digest]
+        except KeyError:
+            with self.instrumentation.measure(
+                    Instrumentation.PARSE, request_type):
+                obj = self._parsed[digest] = loader(txt_pem.encode('utf-8'))
+            return obj
+
+    def _load_key(self, txt_key, request_type=None):
+        """Return the private key object for the given string.
+
+        :param txt_key: Text of private key.
+        :type txt_key: str
+        :param request_type: Certificate type the key was issued for
+        :type request_type: Optional[str]
+        :returns: Key
+        :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
+        """
+        return self._load_pem(
+            'key', txt_key, _load_pem_private_key, request_type)
+
+    def _load_cert(self, txt_cert, request_type=None):
+        """Return the certificate object for the given string.
+
+        :param txt_cert: Text of certificate.
+        :type txt_cert: str
+        :param request_type: Certificate type the certificate was issued for
+        :type request_type: Optional[str]
+        :returns: Certificate
+        :rtype: default_backend.openssl.x509._Certificate
+        """
+        return self._load_pem(
+            'cert', txt_cert, _load_pem_x509_certificate, request_type)
+
+    def _load_metadata(self, txt_cert, request_type=None):
+        """Return the metadata of the certificate in the given string.
+
+        Only the fields needed are decoded, cryptography is not used.
+
+        :param txt_cert: Text of certificate.
+        :type txt_cert: str
+        :param request_type: Certificate type the certificate was issued for
+        :type request_type: Optional[str]
+        :returns: Metadata, see der.certificate_metadata
+        :rtype: Dict[str, Any]
+        """
+        return self._load_pem(
+            'metadata', txt_cert, _load_pem_metadata, request_type)
+
+    def certificate_metadata(self, request_type, common_name='default',
+                             relation_id=None):
+        """Return the serial, validity, subject CN, SANs and key type of an
+        issued certificate, without parsing the certificate or its key.
+
+        :param request_type: Certificate type, one of REQUEST_KEYS
+        :type request_type: str
+        :param common_name: CN of the certificate, 'default' for the lowest
+                            sorting CN
+        :type common_name: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Metadata, see der.certificate_metadata
+        :rtype: Dict[str, Any]
+        :raises: CAClientError, KeyError, TooManyRelatedAppsError
+        """
+        crypto_data = self._get_crypto_data(request_type, relation_id)
+        if common_name == CertificateMapping.DEFAULT:
+            common_name = min(crypto_data)
+        record = dict(self._get_metadata(
+            crypto_data[common_name]['cert'], request_type))
+        for name in ('dns_names', 'ip_addresses'):
+            if record[name] is not None:
+                record[name] = list(record[name])
+        return record
+
+    def _get_certificate(self, txt_cert, relation_id=None):
         """Return the certificate object for the given string.
 
         :param txt_cert: Text of certificate.
         :type txt_cert: str
+        :param relation_id: Relation the certificate was obtained over
+        :type relation_id: Optional[int]
         :returns: Certificate
         :rtype: default_backend.openssl.x509._Certificate
         :raises: CAClientError
         """
-        if not self._any_certificate_requested():
+        self._check_certificate(txt_cert, relation_id)
+        return self._load_cert(txt_cert, 'ca')
+
+    def _check_certificate(self, txt_cert, relation_id=None):
+        """Check a CA certificate can be returned.
+
+        :param txt_cert: Text of certificate.
+        :type txt_cert: str
+        :param relation_id: Relation the certificate was obtained over
+        :type relation_id: Optional[int]
+        :raises: CAClientError
+        """
+        if not self._any_certificate_requested(relation_id):
             raise CAClientError(BlockedStatus,
                                 'a certificate request has not been sent',
                                 self._relation_name)
@@ -315,9 +1484,6 @@ class CAClient(Object):
             raise CAClientError(WaitingStatus,
                                 'certificate has not been obtained yet.',
                                 self._relation_name)
-        return load_pem_x509_certificate(
-            txt_cert.encode('utf-8'),
-            backend=default_backend())
 
     @property
     def ca_certificate(self):
@@ -325,9 +1491,11 @@ class CAClient(Object):
 
         :returns: Certificate
         :rtype: default_backend.openssl.x509._Certificate
-        :raises: CAClientError
+        :raises: CAClientError, TooManyRelatedAppsError
         """
-        return self._get_certificate(self._stored.ca_certificate)
+        relation_id = self._resolve_relation_id()
+        return self._get_certificate(
+            self._stored_value(relation_id, 'ca_certificate'), relation_id)
 
     @property
     def root_ca_chain(self):
@@ -335,9 +1503,11 @@ class CAClient(Object):
 
         :returns: Certificate
         :rtype: default_backend.openssl.x509._Certificate
-        :raises: CAClientError
+        :raises: CAClientError, TooManyRelatedAppsError
         """
-        return self._get_certificate(self._stored.root_ca_chain)
+        relation_id = self._resolve_relation_id()
+        return self._get_certificate(
+            self._stored_value(relation_id, 'root_ca_chain'), relation_id)
 
     @property
     def certificate(self):
@@ -394,7 +1564,7 @@ class CAClient(Object):
         """Key from CA for certificate request using legacy method.
 
         :returns: Key
-        :rtype: default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey
+        :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
         :raises: CAClientError
         """
         return self._get_certs_and_keys(
@@ -408,7 +1578,7 @@ class CAClient(Object):
         Instead use self.server_certs()
 
         :returns: Key
-        :rtype: default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey
+        :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
         :raises: CAClientError
         """
         return self._get_certs_and_keys('server')['default']['key']
@@ -421,7 +1591,7 @@ class CAClient(Object):
         Instead use self.client_certs()
 
         :returns: Key
-        :rtype: default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey
+        :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
         :raises: CAClientError
         """
         return self._get_certs_and_keys('client')['default']['key']
@@ -434,7 +1604,7 @@ class CAClient(Object):
         Instead use self.application_certs()
 
         :returns: Key
-        :rtype: default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey
+        :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
         :raises: CAClientError
         """
         return self._get_certs_and_keys('application')['default']['key']
@@ -443,10 +1613,10 @@ class CAClient(Object):
     def application_certs(self):
         """Application Certificates and keys returned by CA
 
-        :returns: Dictionary keyed on CN of certs and keys
-        :rtype: Dict[str, Union[
-            default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey,
-            default_backend.openssl.openssl.x509._Certificate]]
+        Keys and certificates are only parsed when an entry is accessed.
+
+        :returns: Read-only mapping keyed on CN of certs and keys
+        :rtype: CertificateMapping
         :raises: CAClientError
         """
         return self._get_certs_and_keys('application')
@@ -455,10 +1625,10 @@ class CAClient(Object):
     def server_certs(self):
         """Server Certificates and keys returned by CA
 
-        :returns: Dictionary keyed on CN of certs and keys
-        :rtype: Dict[str, Union[
-            default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey,
-            default_backend.openssl.openssl.x509._Certificate]]
+        Keys and certificates are only parsed when an entry is accessed.
+
+        :returns: Read-only mapping keyed on CN of certs and keys
+        :rtype: CertificateMapping
         :raises: CAClientError
         """
         return self._get_certs_and_keys('server')
@@ -467,14 +1637,63 @@ class CAClient(Object):
     def client_certs(self):
         """Client Certificates and keys returned by CA
 
-        :returns: Dictionary keyed on CN of certs and keys
-        :rtype: Dict[str, Union[
-            default_backend.openssl.rsa.openssl.rsa._RSAPrivateKey,
-            default_backend.openssl.openssl.x509._Certificate]]
+        Keys and certificates are only parsed when an entry is accessed.
+
+        :returns: Read-only mapping keyed on CN of certs and keys
+        :rtype: CertificateMapping
         :raises: CAClientError
         """
         return self._get_certs_and_keys('client')
 
+    def write_certificates(self, directory, request_type=None,
+                           key_mode=0o600, cert_mode=0o644, fsync=True,
+                           relation_id=None):
+        """Write the CA certificate, chain, keys and certificates to disk.
+
+        The CA certificate and chain are written to ca.crt and chain.crt in
+        directory, keys and certificates to <request_type>/<cn>.key and
+        <request_type>/<cn>.crt. Files are replaced atomically and only
+        when their content differs from what is on disk.
+
+        :param directory: Directory to write files to
+        :type directory: str
+        :param request_type: Certificate type, all types if None
+        :type request_type: Optional[str]
+        :param key_mode: Permissions of key files
+        :type key_mode: int
+        :param cert_mode: Permissions of certificate files
+        :type cert_mode: int
+        :param fsync: Whether to flush written files to disk
+        :type fsync: bool
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Sorted paths that were written
+        :rtype: List[str]
+        :raises: TooManyRelatedAppsError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        files = {}
+        for name, field in (('ca', 'ca_certificate'),
+                            ('chain', 'root_ca_chain')):
+            txt_cert = self._stored_value(relation_id, field)
+            if txt_cert:
+                path = os.path.join(directory, '{}.crt'.format(name))
+                files[path] = (txt_cert.encode('utf-8'), cert_mode)
+        if request_type is None:
+            request_types = self.REQUEST_KEYS.keys()
+        else:
+            request_types = [request_type]
+        for rq_type in request_types:
+            crypto_data = self._material(relation_id, rq_type) or {}
+            for cn, data in crypto_data.items():
+                prefix = os.path.join(
+                    directory, rq_type, cn.replace(os.sep, '_'))
+                files[prefix + '.key'] = (
+                    data['key'].encode('utf-8'), key_mode)
+                files[prefix + '.crt'] = (
+                    data['cert'].encode('utf-8'), cert_mode)
+        return write_files(files, fsync=fsync)
+
     @property
     def _legacy_request_cn(self):
         """The common name used for a certificate request using legacy method.
@@ -482,13 +1701,10 @@ class CAClient(Object):
         :param common_name: Common name
         :type common_name: str
         """
-        cn = None
-        rel = self.framework.model.get_relation(self._relation_name)
-        if rel:
-            cn = rel.data[self.framework.model.unit].get('common_name')
-        return cn
+        return self._get_snapshot().legacy_request_cn
 
-    def request_certificate(self, common_name, sans, certificate_type=None):
+    def request_certificate(self, common_name, sans, certificate_type=None,
+                            relation_id=None, key_type=None):
         """Request a new server certificate.
 
         If arguments have not changed from a previous request, then a different
@@ -501,30 +1717,208 @@ class CAClient(Object):
         :param sans: a list of Subject Alternative Names to use in a
             certificate.
         :type common_name: list(str)
+        :param relation_id: the relation to send the request over, None for
+            the only relation.
+        :type relation_id: Optional[int]
+        :param key_type: type of the key of the certificate, e.g. 'P-256',
+            see keys.check_key_type. None for the default of the CA, or
+            key_type of the CAClient with csr.
+        :type key_type: Optional[str]
         """
-        key = self.REQUEST_KEYS[certificate_type]
-        rel = self.framework.model.get_relation(self._relation_name)
-        if rel is None:
-            raise CAClientError(BlockedStatus, 'missing relation',
-                                self._relation_name)
         logger.info(
             'Requesting a CA certificate. Common name: %s, SANS: %s',
             common_name,
             sans)
-        requests = rel.data[self.model.unit].get(key, '{}')
-        requests = json.loads(requests)
-        requests[common_name] = {'sans': sans}
-        rel.data[self.model.unit][key] = json.dumps(
-            requests,
-            sort_keys=True)
-        rel_data = rel.data[self.model.unit]
-        if certificate_type == 'server':
-            # for backwards compatibility, request goes in its own fields
-            rel_data['common_name'] = common_name
-            rel_data['sans'] = json.dumps(sans)
+        self.request_certificates(
+            [(common_name, sans)],
+            certificate_type=certificate_type,
+            relation_id=relation_id,
+            key_type=key_type)
+
+    def request_certificates(self, requests, certificate_type=None,
+                             relation_id=None, key_type=None):
+        """Request several new certificates with a single relation update.
+
+        All the requests are merged into the existing requests of
+        certificate_type and each relation field is written at most once.
+        Fields whose value would not change are not written at all.
+
+        :param requests: (common name, list of SANs) pairs, for example
+                         the items() of a dict keyed on common name.
+        :type requests: Iterable[Tuple[str, List[str]]]
+        :param certificate_type: Certificate type
+        :type certificate_type: str
+        :param relation_id: Relation to send the requests over, None for the
+                            only relation
+        :type relation_id: Optional[int]
+        :param key_type: Type of the keys of the certificates, None for the
+                         default of the CA, or key_type with csr
+        :type key_type: Optional[str]
+        :raises: CAClientError, TooManyRelatedAppsError, ValueError
+        """
+        key = self.REQUEST_KEYS[certificate_type]
+        if key_type is not None:
+            keys.check_key_type(key_type)
+        relation_id = self._resolve_relation_id(relation_id)
+        snapshot = self._get_snapshot(relation_id)
+        rel = snapshot.relation
+        if rel is None:
+            raise CAClientError(BlockedStatus, 'missing relation',
+                                self._relation_name)
+        # SANs are compared with, and stored as, the lists read back from
+        # relation data.
+        requests = [
+            (common_name, list(sans)) for common_name, sans in requests]
+        if not requests:
+            return
+        logger.debug(
+            'Requesting %d CA certificates of type %s',
+            len(requests),
+            certificate_type)
+        current_requests = snapshot.decode(
+            snapshot.local, key, '{}', certificate_type)
+        new_requests = dict(current_requests)
+        csr = self.csr and certificate_type in self.CSR_TYPES
+        for common_name, sans in requests:
+            request = current_requests.get(common_name)
+            if not request or request.get('sans') != sans or (
+                    request.get('key_type') != key_type):
+                request = {'sans': sans}
+                if key_type is not None:
+                    request['key_type'] = key_type
+            elif csr and 'csr' not in request:
+                request = dict(request)
+            # Otherwise keep the request as it is, including any renewal
+            # marker and CSR, so that repeating a request does not cause a
+            # new certificate to be issued.
+            new_requests[common_name] = request
+        if csr:
+            self._add_csrs(certificate_type, new_requests, relation_id)
+        fields = {
+            key: compression.encode(
+                new_requests, self._compress_requests(relation_id))}
+        if certificate_type == 'server' and not csr and key_type is None:
+            # for backwards compatibility, the last request goes in its own
+            # fields
+            common_name, sans = requests[-1]
+            fields['common_name'] = common_name
+            fields['sans'] = json.dumps(sans)
+        elif certificate_type == 'server':
+            # The CA would generate a key of its default type for the legacy
+            # request, which would be stored as the server certificate of its
+            # CN, drop it.
+            fields.update(
+                (field, '') for field in ('common_name', 'sans')
+                if field in snapshot.local)
+        self._set_local_fields(fields, relation_id)
+
+    def _add_csrs(self, request_type, requests, relation_id):
+        """Generate keys and CSRs for the requests which have none.
+
+        The keys are generated in one batch per key type and kept, with the
+        digest of their public key, until a certificate for them is received.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param requests: Requests keyed on CN, updated in place
+        :type requests: Dict[str, Dict[str, Any]]
+        :param relation_id: Relation id
+        :type relation_id: int
+        :raises: ValueError
+        """
+        missing = sorted(
+            cn for cn, request in requests.items() if 'csr' not in request)
+        if not missing:
+            return
+        logger.debug('Generating %d %s keys and CSRs',
+                     len(missing), request_type)
+        by_key_type = collections.defaultdict(list)
+        for cn in missing:
+            by_key_type[requests[cn].get('key_type') or self.key_type].append(
+                cn)
+        missing = []
+        generated = []
+        for key_type, common_names in sorted(by_key_type.items()):
+            missing.extend(common_names)
+            generated.extend(keys.generate_csrs(
+                [(cn, requests[cn].get('sans') or []) for cn in common_names],
+                key_type, self.processes))
+        stored = self._save_material(
+            {cn: {'key': data['key']} for cn, data in zip(missing, generated)})
+        state = self._state(relation_id)
+        if request_type not in state['csr_keys']:
+            state['csr_keys'][request_type] = {}
+        pending = state['csr_keys'][request_type]
+        for cn, data in zip(missing, generated):
+            requests[cn]['csr'] = data['csr']
+            pending[cn] = {
+                'key': stored[cn]['key'],
+                'public_key': data['public_key']}
+        self._prune_material()
+
+    def _compress_requests(self, relation_id):
+        """Return whether to compress the requests sent over a relation.
+
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Whether there are CA units and they all read compressed
+                  values
+        :rtype: bool
+        """
+        snapshot = self._get_snapshot(relation_id)
+        units = snapshot.relation.units
+        return self.compress and bool(units) and all(
+            compression.supports_compression(snapshot.remote(unit))
+            for unit in units)
+
+    def _reencode_requests(self, relation_id):
+        """Rewrite the requests in the encoding all the CA units read.
+
+        :param relation_id: Relation id
+        :type relation_id: int
+        """
+        snapshot = self._get_snapshot(relation_id)
+        sent = {
+            request_type: key
+            for request_type, key in self.REQUEST_KEYS.items()
+            if key and snapshot.local.get(key)}
+        if not sent:
+            return
+        compress = self._compress_requests(relation_id)
+        fields = {}
+        for request_type, key in sent.items():
+            if compression.is_compressed(snapshot.local[key]) == compress:
+                continue
+            fields[key] = compression.encode(
+                snapshot.decode(snapshot.local, key, '{}', request_type),
+                compress)
+        # Also advertises compression to CAs related before it was supported
+        self._set_local_fields(fields, relation_id)
+
+    def _set_local_fields(self, fields, relation_id):
+        """Write the fields of this unit's relation data that change.
+
+        :param fields: Values keyed on field
+        :type fields: Dict[str, str]
+        :param relation_id: Relation id
+        :type relation_id: int
+        """
+        snapshot = self._get_snapshot(relation_id)
         # Explicit set of unit_name needed to support use of
         # this interface in cross model contexts.
-        rel_data['unit_name'] = self.model.unit.name
+        fields = dict(fields, unit_name=self.model.unit.name)
+        if self.compress:
+            fields[compression.ENCODINGS_FIELD] = compression.advertisement()
+        fields = {
+            field: value
+            for field, value in fields.items()
+            if snapshot.local.get(field) != value}
+        if not fields:
+            return
+        self._snapshots.pop(relation_id, None)
+        rel_data = snapshot.relation.data[self.model.unit]
+        for field, value in fields.items():
+            rel_data[field] = value
 
     request_server_certificate = functools.partialmethod(
         request_certificate,
@@ -538,49 +1932,72 @@ class CAClient(Object):
         request_certificate,
         certificate_type='application')
 
-    def _is_certificate_requested(self, request_type):
+    request_server_certificates = functools.partialmethod(
+        request_certificates,
+        certificate_type='server')
+
+    request_client_certificates = functools.partialmethod(
+        request_certificates,
+        certificate_type='client')
+
+    request_application_certificates = functools.partialmethod(
+        request_certificates,
+        certificate_type='application')
+
+    def _is_certificate_requested(self, request_type, relation_id=None):
         """Has a request beed sent of this type.
 
         :param request_type: Certificate type
         :type request_type: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
         :returns: Whether a request has been sent.
         :rtype: bool
         """
-        return bool(self._get_all_requests().get(request_type))
+        return bool(self._get_all_requests(relation_id).get(request_type))
 
-    def _any_certificate_requested(self):
+    def _any_certificate_requested(self, relation_id=None):
         """Have any certificate requests been sent
 
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
         :returns: Whether a request has been sent.
         :rtype: bool
         """
-        return any([i for i in self._get_all_requests().values()])
+        return any([i for i in self._get_all_requests(relation_id).values()])
 
-    def _get_legacy_response(self, remote_data):
+    def _get_legacy_response(self, remote_data, relation_id):
         """Retrieve response from CA using legacy method.
 
-        :param remote_data: Data returned by CA
-        :type remote_data: ops.model.RelationDataContent
+        :param remote_data: Data returned by CA, as returned by
+                            _RelationSnapshot.remote
+        :type remote_data: Dict[str, str]
+        :param relation_id: Relation id
+        :type relation_id: int
         :returns: Dict keyed on cn of key and cert
         :rtype: Dict[str, str]
         """
         certs_data = {}
+        legacy_request_cn = self._get_snapshot(relation_id).legacy_request_cn
         cert = remote_data.get(
             '{}.server.cert'.format(self._munged_name))
         key = remote_data.get(
             '{}.server.key'.format(self._munged_name))
-        if all([self._legacy_request_cn, cert, key]):
+        if all([legacy_request_cn, cert, key]):
             certs_data = {
-                self._legacy_request_cn: {
+                legacy_request_cn: {
                     'key': key,
                     'cert': cert}}
         return certs_data
 
-    def _get_request_response(self, request_type, remote_data):
+    def _get_request_response(self, request_type, remote_data, relation_id):
         """Retrieve response from CA using legacy method.
 
-        :param remote_data: Data returned by CA
-        :type remote_data: ops.model.RelationDataContent
+        :param remote_data: Data returned by CA, as returned by
+                            _RelationSnapshot.remote
+        :type remote_data: Dict[str, str]
+        :param relation_id: Relation id
+        :type relation_id: int
         :returns: Dict keyed on cn of key and cert
         :rtype: Dict[str, str]
         """
@@ -588,52 +2005,462 @@ class CAClient(Object):
         certs_data = {}
         if rq_key:
             field = '{}.{}'.format(self._munged_name, rq_key)
-            json_certs_data = remote_data.get(field)
-            if json_certs_data:
-                certs_data = json.loads(json_certs_data)
+            certs_data = dict(
+                self._get_snapshot(relation_id).decode(
+                    remote_data, field, '{}', request_type))
             # If a server cert was requested by the legacy top level mechanism
             # then make sure it is included in the server certs dict.
             if request_type == 'server':
-                certs_data.update(self._get_legacy_response(remote_data))
+                certs_data.update(
+                    self._get_legacy_response(remote_data, relation_id))
         else:
-            certs_data = self._get_legacy_response(remote_data)
+            certs_data = self._get_legacy_response(remote_data, relation_id)
         return certs_data
 
-    def _store_certificates(self, request_type, crypto_data):
+    def _emit_ready(self, request_type, crypto_data, relation_id):
+        """Emit the ready event of request_type with the changes since the
+        previous ready event of that type and relation.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param crypto_data: Data stored for request_type
+        :type crypto_data: Dict[str, Dict[str, str]]
+        :param relation_id: Relation id
+        :type relation_id: int
+        """
+        state = self._state(relation_id)
+        announced = state['announced'].get(request_type) or {}
+        current = {
+            cn: fingerprint([data['cert'], data['key']])
+            for cn, data in crypto_data.items()}
+        added = sorted(cn for cn in current if cn not in announced)
+        changed = sorted(
+            cn for cn in current
+            if cn in announced and announced[cn] != current[cn])
+        removed = sorted(cn for cn in announced if cn not in current)
+        state['announced'][request_type] = current
+        self.ready_events[request_type].emit(
+            added, changed, removed, relation_id)
+
+    def _response_fields(self, request_type):
+        """Return the CA relation data fields holding a response.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :returns: Field names
+        :rtype: List[str]
+        """
+        fields = []
+        if request_type in ('legacy', 'server'):
+            fields.extend([
+                '{}.server.cert'.format(self._munged_name),
+                '{}.server.key'.format(self._munged_name)])
+        rq_key = self.PROCESSED_KEYS[request_type]
+        if rq_key:
+            fields.append('{}.{}'.format(self._munged_name, rq_key))
+        return fields
+
+    def _response_fingerprint(self, request_type, remote_data, relation_id):
+        """Return a digest of the relation data a response is derived from.
+
+        The digest covers the CA certificate and chain, the response fields
+        for request_type and the request this unit made, so that a changed
+        request is processed even when the response is unchanged.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param remote_data: Data returned by CA, as returned by
+                            _RelationSnapshot.remote
+        :type remote_data: Dict[str, str]
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Hex digest
+        :rtype: str
+        """
+        local_data = self._get_snapshot(relation_id).local
+        local_fields = ['common_name', 'sans', self.REQUEST_KEYS[request_type]]
+        remote_fields = ['ca', 'chain'] + self._response_fields(request_type)
+        return fingerprint(
+            [local_data.get(field) for field in local_fields] +
+            [remote_data.get(field) for field in remote_fields])
+
+    def _store_certificates(self, request_type, crypto_data, relation_id):
         """Store the response from the CA for the given request type.
 
+        A metadata record of every certificate stored is kept in StoredState,
+        keyed on the digest of its PEM text, so that it is only decoded once
+        and later hooks can read it back without parsing.
+
         :param request_type: Certificate type
         :type request_type: str
         :param crypto_data: Data returned by CA for request. Expected to be:
                             crypto_data is in the for {'cn': {'cert': str,
                                                               'key': str}}
         :type crypto_data: Dict[str, Dict[str, str]]
+        :param relation_id: Relation the data was received over
+        :type relation_id: int
+        """
+        state = self._state(relation_id)
+        stored = self._save_material(crypto_data)
+        changed = stored != state[request_type]
+        if changed:
+            # Drop parsed objects, anything still in use is re-parsed once on
+            # its next access.
+            self._parsed.clear()
+        metadata = self._stored.metadata
+        digests = {}
+        for cn, data in crypto_data.items():
+            digest = digests[cn] = _pem_digest(data['cert'])
+            if digest not in metadata:
+                metadata[digest] = self._load_metadata(
+                    data['cert'], request_type)
+        state['digests'][request_type] = digests
+        csr_keys = state['csr_keys'].get(request_type) or {}
+        for cn in [cn for cn in csr_keys if cn in digests]:
+            public_key = metadata[digests[cn]].get('public_key_sha256')
+            if csr_keys[cn]['public_key'] == public_key:
+                # The key is now stored with its certificate.
+                del csr_keys[cn]
+        self._update_expiry_index(request_type, digests, relation_id)
+        self._update_sni_index(request_type, relation_id)
+        state[request_type] = stored
+        self._loaded[(relation_id, request_type)] = crypto_data
+        if changed:
+            self._prune_metadata()
+            self._prune_material()
+
+    def _save_material(self, crypto_data):
+        """Save certificates and keys to the store, if there is one.
+
+        All the texts are saved at once so the store writes them in one go.
+
+        :param crypto_data: Certificates and keys keyed on CN
+        :type crypto_data: Dict[str, Dict[str, str]]
+        :returns: What to keep in StoredState: crypto_data if there is no
+                  store, otherwise the digests of the texts keyed on CN
+        :rtype: Dict[str, Dict[str, str]]
         """
-        setattr(self._stored, request_type, crypto_data)
+        if self._store is None:
+            return crypto_data
+        items = [
+            (cn, name, text)
+            for cn, data in crypto_data.items()
+            for name, text in data.items()]
+        digests = self._store.save([text for _, _, text in items])
+        stored = {cn: {} for cn in crypto_data}
+        for (cn, name, _), text_digest in zip(items, digests):
+            stored[cn][name] = text_digest
+        return stored
+
+    def _material(self, relation_id, request_type):
+        """Return the certificates and keys stored for request_type.
+
+        With a store the texts of each CN are loaded from it once per
+        CAClient, when the CN is first looked up. Texts kept in StoredState
+        before a store was used are returned as they are.
+
+        :param relation_id: Relation id or None if there is no relation
+        :type relation_id: Optional[int]
+        :param request_type: Certificate type
+        :type request_type: str
+        :returns: Certificates and keys keyed on CN or None if nothing is
+                  stored
+        :rtype: Optional[Mapping[str, Dict[str, str]]]
+        """
+        stored = self._stored_value(relation_id, request_type)
+        if self._store is None or not stored:
+            return stored
+        key = (relation_id, request_type)
+        if key not in self._loaded:
+            self._loaded[key] = _StoredMaterial(stored, self._resolve)
+        return self._loaded[key]
+
+    def _resolve(self, ref):
+        """Return the text a value kept in StoredState stands for.
+
+        :param ref: PEM text, or its digest in the store
+        :type ref: str
+        :returns: PEM text
+        :rtype: str
+        :raises: CAClientError
+        """
+        if self._store is None or ref.startswith('-----'):
+            return ref
+        try:
+            return self._store.load(ref)
+        except KeyError as e:
+            raise CAClientError(
+                BlockedStatus,
+                'certificate material {} is missing from the '
+                'store'.format(e.args[0]),
+                self._relation_name)
+
+    def _prune_material(self):
+        """Remove from the store the texts no longer referenced."""
+        if self._store is None:
+            return
+        refs = {
+            ref
+            for state in self._stored.relations.values()
+            for request_type in self.REQUEST_KEYS
+            for data in (state[request_type] or {}).values()
+            for ref in data.values()}
+        refs.update(
+            pending['key']
+            for state in self._stored.relations.values()
+            for csr_keys in state['csr_keys'].values()
+            for pending in csr_keys.values())
+        self._store.retain(refs)
+
+    def _prune_metadata(self):
+        """Drop the metadata records of certificates no longer stored."""
+        used = set()
+        for state in self._stored.relations.values():
+            for digests in state['digests'].values():
+                used.update(digests.values())
+        for digest in [d for d in self._stored.metadata if d not in used]:
+            del self._stored.metadata[digest]
+
+    def _get_metadata(self, txt_cert, request_type=None):
+        """Return the metadata of a certificate, from StoredState if there.
+
+        :param txt_cert: Text of certificate.
+        :type txt_cert: str
+        :param request_type: Certificate type the certificate was issued for
+        :type request_type: Optional[str]
+        :returns: Metadata, see der.certificate_metadata
+        :rtype: Mapping[str, Any]
+        """
+        record = self._stored.metadata.get(_pem_digest(txt_cert))
+        if record is None:
+            record = self._load_metadata(txt_cert, request_type)
+        return record
+
+    def _update_expiry_index(self, request_type, digests, relation_id):
+        """Replace the entries of request_type in the expiry index.
+
+        The index is a binary min-heap of [not-after timestamp, request type,
+        CN, relation id] lists kept in StoredState, shared by all relations.
+        Expiries are read from the stored metadata records.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param digests: Digests of the certificates about to be stored for
+                        request_type, keyed on CN
+        :type digests: Dict[str, str]
+        :param relation_id: Relation the data was received over
+        :type relation_id: int
+        """
+        state = self._state(relation_id)
+        metadata = self._stored.metadata
+        heap = [
+            list(entry) for entry in self._stored.expiry
+            if entry[1] != request_type or entry[3] != relation_id]
+        expiries = {}
+        for cn, digest in digests.items():
+            expiries[cn] = metadata[digest]['not_after']
+            heap.append([expiries[cn], request_type, cn, relation_id])
+        heapq.heapify(heap)
+        self._stored.expiry = heap
+        notified = state['expiry_notified'].get(request_type) or {}
+        state['expiry_notified'][request_type] = {
+            cn: expiry
+            for cn, expiry in notified.items()
+            if expiries.get(cn) == expiry}
+
+    def _update_sni_index(self, request_type, relation_id):
+        """Rebuild the SNI index of a relation for new data of request_type.
+
+        The index is built from the stored metadata records, without
+        parsing, and kept in StoredState so lookups in later hooks do not
+        need to build it.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param relation_id: Relation the data was received over
+        :type relation_id: int
+        """
+        if request_type not in self.SNI_TYPES:
+            return
+        state = self._state(relation_id)
+        metadata = self._stored.metadata
+        digests = {
+            rq_type: state['digests'].get(rq_type) or {}
+            for rq_type in self.SNI_TYPES}
+        state['sni'] = sni.build_index(
+            (_certificate_names(metadata[digests[rq_type][cn]]),
+             [rq_type, cn])
+            for rq_type in self.SNI_TYPES
+            for cn in sorted(digests[rq_type]))
+
+    def certificate_for_hostname(self, hostname, relation_id=None):
+        """Return the issued certificate to present for hostname.
+
+        Server, then application, then legacy certificates are searched for
+        one whose SANs match hostname exactly, or else through a wildcard.
+        The lookup uses an index built when certificates are stored and
+        costs one step per label of hostname.
+
+        :param hostname: Hostname, as sent in the SNI extension, or IP address
+        :type hostname: str
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
+        :returns: Request type, CN and mapping of the cert and key or None if
+                  no certificate matches
+        :rtype: Optional[Tuple[str, str, CertificateEntry]]
+        :raises: TooManyRelatedAppsError
+        """
+        relation_id = self._resolve_relation_id(relation_id)
+        index = self._stored_value(relation_id, 'sni')
+        if not index:
+            return None
+        found = sni.lookup(index, hostname)
+        if found is None:
+            return None
+        request_type, cn = found
+        data = self._material(relation_id, request_type)[cn]
+        return request_type, cn, CertificateEntry(self, data, request_type)
+
+    @property
+    def next_expiry(self):
+        """The issued certificate which expires first.
+
+        :returns: Expiry in seconds since the epoch, request type, CN and
+                  relation id or None if no certificate has been issued.
+        :rtype: Optional[Tuple[int, str, str, int]]
+        """
+        if not self._stored.expiry:
+            return None
+        return tuple(self._stored.expiry[0])
+
+    def _expiring(self, limit):
+        """Return the entries of the expiry index expiring before limit.
+
+        Only the part of the heap holding those entries is visited.
+
+        :param limit: Seconds since the epoch
+        :type limit: int
+        :returns: Entries sorted by expiry
+        :rtype: List[Tuple[int, str, str, int]]
+        """
+        heap = self._stored.expiry
+        expiring = []
+        to_visit = [0]
+        while to_visit:
+            index = to_visit.pop()
+            if index < len(heap) and heap[index][0] <= limit:
+                expiring.append(tuple(heap[index]))
+                to_visit.extend([2 * index + 1, 2 * index + 2])
+        return sorted(expiring)
+
+    @property
+    def renewal_offset(self):
+        """How many seconds before renew_before this unit renews.
 
-    def _get_all_requests(self):
+        The offset is derived from the unit name so it is stable across hooks
+        and spread over renewal_jitter between units.
+
+        :returns: Seconds
+        :rtype: int
+        """
+        if self.renewal_jitter <= 0:
+            return 0
+        digest = hashlib.sha256(self._munged_name.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.renewal_jitter
+
+    def renew_certificates(self):
+        """Request again the certificates due for renewal.
+
+        A certificate is due renew_before plus renewal_offset seconds before
+        it expires. Its request is marked with the expiry being renewed, a
+        change in the request that CAs answer with a new certificate. At most
+        renewals_per_hook certificates, the ones expiring first, are
+        requested again per call, the others are left for later hooks. This
+        is called at the end of every hook.
+
+        Legacy requests and requests over relations which are gone cannot be
+        renewed this way and are skipped.
+
+        :returns: (request type, CN, relation id) requested again
+        :rtype: List[Tuple[str, str, int]]
+        """
+        if self.renew_before is None or not self._stored.expiry:
+            return []
+        limit = _now() + self.renew_before + self.renewal_offset
+        if self._stored.expiry[0][0] > limit:
+            return []
+        renewed = []
+        new_requests = {}
+        for expiry, request_type, cn, relation_id in self._expiring(limit):
+            if len(renewed) >= self.renewals_per_hook:
+                break
+            if self._get_snapshot(relation_id).relation is None:
+                continue
+            request = self._get_all_requests(
+                relation_id).get(request_type) or {}
+            if request_type == 'application':
+                # One certificate answers all the application requests.
+                cns = list(request)
+            else:
+                cns = [cn] if cn in request else []
+            cns = [
+                request_cn for request_cn in cns
+                if request[request_cn].get('renewal') != expiry]
+            if request_type == 'legacy' or not cns:
+                continue
+            new_request = new_requests.setdefault(
+                relation_id, {}).setdefault(request_type, dict(request))
+            for request_cn in cns:
+                new_request[request_cn] = dict(
+                    request[request_cn], renewal=expiry)
+            renewed.append((request_type, cn, relation_id))
+        if renewed:
+            logger.info(
+                'Requesting renewal of certificates: %s',
+                ', '.join('{} {} (relation {})'.format(*r) for r in renewed))
+        for relation_id, rel_requests in sorted(new_requests.items()):
+            compress = self._compress_requests(relation_id)
+            self._set_local_fields({
+                self.REQUEST_KEYS[request_type]: compression.encode(
+                    new_request, compress)
+                for request_type, new_request in rel_requests.items()},
+                relation_id)
+        return renewed
+
+    def check_expiry(self):
+        """Emit certificate_expiring for certificates close to their expiry.
+
+        This is called at the end of every hook. Each certificate is only
+        announced once and when no certificate is close to its expiry only
+        the first entry of the expiry index is looked at.
+        """
+        heap = self._stored.expiry
+        limit = _now() + self.expiry_threshold
+        if not heap or heap[0][0] > limit:
+            return
+        for expiry, request_type, cn, relation_id in self._expiring(limit):
+            expiry_notified = self._state(relation_id)['expiry_notified']
+            notified = expiry_notified.get(request_type)
+            if notified is None:
+                notified = expiry_notified[request_type] = {}
+            if notified.get(cn) == expiry:
+                continue
+            notified[cn] = expiry
+            logger.info('%s certificate %s of relation %s expires at %s',
+                        request_type, cn, relation_id, expiry)
+            self.on.certificate_expiring.emit(
+                request_type, cn, expiry, relation_id)
+
+    def _get_all_requests(self, relation_id=None):
         """Get all the certificate requests this unit has made.
 
+        :param relation_id: Relation id, None for the only relation
+        :type relation_id: Optional[int]
         :returns: Dict keyed on request type
                   {'application': { 'cn': {'cert':, 'key':}...
         :rtype: Dict[str, Dict[str, Dict[str, str]]]
         """
-        requests = {}
-        rel = self.framework.model.get_relation(self._relation_name)
-        if rel is None:
-            return requests
-        unit_data = rel.data[self.framework.model.unit]
-        for request_type, request_key in self.REQUEST_KEYS.items():
-            if request_type == 'legacy':
-                cn = unit_data.get('common_name')
-                if cn:
-                    requests[request_type] = {
-                        cn: {
-                            'sans': json.loads(unit_data.get('sans', '[]'))}}
-            else:
-                requests[request_type] = json.loads(
-                    unit_data.get(request_key, '{}'))
-        return requests
+        return self._get_snapshot(relation_id).requests(self.REQUEST_KEYS)
 
     def _valid_response(self, response):
         """Check if data from CA for request is valid.
@@ -652,36 +2479,262 @@ class CAClient(Object):
         """Check if requests have been processed and emit events accorfdingly.
 
 
-        Check which requests have been processes. If all requests of a
-        particular type have been completed them emit the corresponding event.
+        Check which requests have been processes. Certificates issued since
+        the last call are announced with tls_certificates_issued. If all
+        requests of a particular type have been completed them emit the
+        corresponding event.
+        Request types whose request and response data are unchanged since the
+        last call are skipped.
 
         :raises: CAClientError
         """
-        remote_data = event.relation.data[event.unit]
+        self._invalidate_snapshot()
+        if event.unit is None:
+            return
+        unit_name = event.unit.name
+        relation_id = event.relation.id
+        self._reencode_requests(relation_id)
+        remote_data = self._get_snapshot(relation_id).remote(event.unit)
         ca = remote_data.get('ca')
         if not ca:
             return
-        self._stored.ca_certificate = ca
+        state = self._state(relation_id)
+        state['ca_certificate'] = ca
         chain = remote_data.get('chain')
         if chain:
-            self._stored.root_ca_chain = chain
-        requests = self._get_all_requests()
+            state['root_ca_chain'] = chain
+        if unit_name not in state['fingerprints']:
+            state['fingerprints'][unit_name] = {}
+        fingerprints = state['fingerprints'][unit_name]
+        requests = self._get_all_requests(relation_id)
         for request_type, request in requests.items():
             if not request:
                 continue
-            response = self._get_request_response(request_type, remote_data)
-            if request_type == 'application':
-                req_keys = ['app_data']
+            response_fingerprint = self._response_fingerprint(
+                request_type, remote_data, relation_id)
+            if fingerprints.get(request_type) == response_fingerprint:
+                logger.debug(
+                    'Skipping %s certificates from %s, relation data is '
+                    'unchanged',
+                    request_type,
+                    unit_name)
+                continue
+            fingerprints[request_type] = response_fingerprint
+            issued = self._get_valid_response(
+                request_type, remote_data, relation_id)
+            crypto_data = self._merge_unit_response(
+                request_type, unit_name, issued, relation_id)
+            self._update_certificates(
+                request_type, request, crypto_data, relation_id)
+
+    def _on_relation_departed(self, event):
+        """Forget the responses of a departing CA unit.
+
+        Certificates the departing unit had issued are replaced by the newest
+        ones issued by the remaining units, if any.
+        """
+        self._invalidate_snapshot()
+        unit_name = getattr(event, 'departing_unit', None) or event.unit
+        if unit_name is None:
+            return
+        unit_name = unit_name.name
+        relation_id = event.relation.id
+        state = self._state(relation_id)
+        state['fingerprints'].pop(unit_name, None)
+        if unit_name not in state['unit_index']:
+            return
+        requests = self._get_all_requests(relation_id)
+        for request_type in self.REQUEST_KEYS:
+            crypto_data = self._merge_unit_response(
+                request_type, unit_name, None, relation_id)
+            if requests.get(request_type):
+                self._update_certificates(
+                    request_type, requests[request_type], crypto_data,
+                    relation_id)
+            else:
+                self._store_certificates(
+                    request_type, crypto_data, relation_id)
+        del state['unit_index'][unit_name]
+
+    def _get_valid_response(self, request_type, remote_data, relation_id):
+        """Return the valid entries of a CA unit's response.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param remote_data: Data returned by CA, as returned by
+                            _RelationSnapshot.remote
+        :type remote_data: Dict[str, str]
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Dict keyed on cn of key and cert
+        :rtype: Dict[str, Dict[str, str]]
+        """
+        response = self._get_request_response(
+            request_type, remote_data, relation_id)
+        for cn, data in response.items():
+            if data and data.get('cert') and not data.get('key'):
+                key = self._csr_key(
+                    request_type, cn, data['cert'], relation_id)
+                if key:
+                    response[cn] = dict(data, key=key)
+        return {
+            key: data
+            for key, data in response.items()
+            if self._valid_response(data)}
+
+    def _csr_key(self, request_type, common_name, txt_cert, relation_id):
+        """Return the local key of a certificate issued for a CSR.
+
+        The key is the one generated for the CSR of common_name, or the key
+        already stored for common_name when the certificate is a renewal for
+        the same key, provided the public key of the certificate matches.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param common_name: CN of the request
+        :type common_name: str
+        :param txt_cert: Text of the certificate, without a key
+        :type txt_cert: str
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Text of the key, None if there is none for the certificate
+        :rtype: Optional[str]
+        :raises: CAClientError
+        """
+        try:
+            public_key = self._get_metadata(
+                txt_cert, request_type).get('public_key_sha256')
+        except ValueError as e:
+            logger.warning('Ignoring %s certificate for %s: %s',
+                           request_type, common_name, e)
+            return None
+        csr_keys = self._state(relation_id)['csr_keys']
+        pending = (csr_keys.get(request_type) or {}).get(common_name)
+        if pending and pending['public_key'] == public_key:
+            return self._resolve(pending['key'])
+        stored = (self._material(relation_id, request_type) or {}).get(
+            common_name) or {}
+        if stored.get('key'):
+            if stored['cert'] == txt_cert:
+                return stored['key']
+            stored_key = self._get_metadata(
+                stored['cert'], request_type).get('public_key_sha256')
+            if public_key and stored_key == public_key:
+                return stored['key']
+        logger.warning('No local key matches the %s certificate issued for %s',
+                       request_type, common_name)
+        return None
+
+    def _merge_unit_response(self, request_type, unit_name, issued,
+                             relation_id):
+        """Merge the response of one CA unit with those of the other units.
+
+        A per unit index of the not-before time and digest of each issued
+        certificate is kept in StoredState, together with the unit each
+        stored certificate came from. Only the CNs in the old or new response
+        of unit_name are looked at and, for each, the newest certificate of
+        any unit is kept. Certificates are parsed once, when first seen.
+        Entries of other units whose response no longer has the CN, because
+        their own relation-changed has not run yet, are dropped.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param unit_name: Name of the CA unit whose response changed
+        :type unit_name: str
+        :param issued: Valid entries of the response of unit_name, None if
+                       the unit departed
+        :type issued: Optional[Dict[str, Dict[str, str]]]
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Data to store for request_type
+        :rtype: Dict[str, Dict[str, str]]
+        """
+        state = self._state(relation_id)
+        unit_index = state['unit_index']
+        if unit_name not in unit_index:
+            unit_index[unit_name] = {}
+        old_index = unit_index[unit_name].get(request_type) or {}
+        new_index = {}
+        for cn, data in (issued or {}).items():
+            digest = fingerprint([data['cert'], data['key']])
+            if cn in old_index and old_index[cn][1] == digest:
+                new_index[cn] = list(old_index[cn])
             else:
-                req_keys = request.keys()
-            for key in req_keys:
-                if not self._valid_response(response.get(key)):
-                    message = (
-                        'A CA has not yet processed requests: {}'.format(key))
-                    logger.info(message)
+                new_index[cn] = [
+                    self._get_metadata(
+                        data['cert'], request_type)['not_before'],
+                    digest]
+        unit_index[unit_name][request_type] = new_index
+        stored_data = self._material(relation_id, request_type) or {}
+        crypto_data = {cn: dict(data) for cn, data in stored_data.items()}
+        if request_type not in state['owners']:
+            state['owners'][request_type] = {}
+        owners = state['owners'][request_type]
+        responses = {}
+        for cn in set(old_index) | set(new_index):
+            owner = owners.get(cn)
+            candidates = []
+            for candidate, indexes in unit_index.items():
+                if issued is None and candidate == unit_name:
+                    continue
+                entry = (indexes.get(request_type) or {}).get(cn)
+                if entry is None:
                     continue
+                # Prefer the current owner on a tie to avoid flapping.
+                candidates.append(((entry[0], candidate == owner), candidate))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            for _, candidate in candidates:
+                if candidate == unit_name:
+                    crypto_data[cn] = issued[cn]
+                elif candidate != owner or cn not in crypto_data:
+                    if candidate not in responses:
+                        unit = self.framework.model.get_unit(candidate)
+                        responses[candidate] = self._get_valid_response(
+                            request_type,
+                            self._get_snapshot(relation_id).remote(unit),
+                            relation_id)
+                    data = responses[candidate].get(cn)
+                    if data is None:
+                        # The unit dropped cn since it was indexed and its
+                        # own relation-changed has not run yet.
+                        del unit_index[candidate][request_type][cn]
+                        continue
+                    crypto_data[cn] = data
+                owners[cn] = candidate
+                break
             else:
-                # All requests of this type have completed so emit the
-                # corresponding event
-                self._store_certificates(request_type, response)
-                self.ready_events[request_type].emit()
+                crypto_data.pop(cn, None)
+                owners.pop(cn, None)
+        return crypto_data
+
+    def _update_certificates(self, request_type, request, crypto_data,
+                             relation_id):
+        """Store crypto_data and announce what it changes.
+
+        :param request_type: Certificate type
+        :type request_type: str
+        :param request: Requests of request_type keyed on CN
+        :type request: Dict[str, Dict[str, List[str]]]
+        :param crypto_data: Data to store for request_type
+        :type crypto_data: Dict[str, Dict[str, str]]
+        :param relation_id: Relation id
+        :type relation_id: int
+        """
+        previous = self._material(relation_id, request_type) or {}
+        req_keys = self._request_keys(request_type, request)
+        newly_issued = [
+            key for key in req_keys
+            if key in crypto_data and previous.get(key) != crypto_data[key]]
+        pending = [key for key in req_keys if key not in crypto_data]
+        self._store_certificates(request_type, crypto_data, relation_id)
+        if newly_issued:
+            self.on.tls_certificates_issued.emit(
+                request_type, newly_issued, relation_id)
+        if pending:
+            logger.info(
+                'A CA has not yet processed requests: %s',
+                ', '.join(pending))
+        else:
+            # All requests of this type have completed so emit the
+            # corresponding event
+            self._emit_ready(request_type, crypto_data, relation_id)
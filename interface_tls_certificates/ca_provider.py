@@ -0,0 +1,611 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Implements the provides side handling of the 'tls-certificates' interface.
+
+`CAProvider`_ answers the certificate requests `CAClient` sends, for charms
+acting as a certificate authority. The charm gives it the CA certificate and
+a function signing certificates; CAProvider reads the requests of all units,
+signs what needs signing in batches and writes the responses::
+
+    from ops.charm import CharmBase
+    from interface_tls_certificates.ca_provider import CAProvider
+
+    class MyCACharm(CharmBase):
+
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.ca_provider = CAProvider(self, 'certificates', self._sign)
+            self.framework.observe(self.on.config_changed,
+                                   self._on_config_changed)
+
+        def _on_config_changed(self, event):
+            self.ca_provider.set_ca_certificate(
+                self._ca_certificate(), self._root_ca_chain())
+
+        def _sign(self, requests):
+            return [
+                self._issue(request.request_type, request.common_name,
+                            request.sans)
+                for request in requests]
+
+The signing function receives a list of `SigningRequest`_ and returns, in the
+same order, a dict with the PEM 'cert' and 'key' issued for each. It is given
+at most `batch_size` requests at a time, so that it can sign them in bulk.
+
+Given a `keys.KeyPool`, CAProvider takes the keys of all the certificates to
+sign from it at once, before signing, and passes each in the `key` of its
+request. The signing function then only has to sign a certificate for that
+key and may leave 'key' out of what it returns.
+
+Clients created with `csr=True` keep their private keys and send a
+certificate signing request instead, passed as the PEM text in the `csr` of
+the request. The signing function must then issue the certificate for the
+public key of the CSR; no key is taken from the pool for it and only the
+'cert' is returned to the client.
+
+Requests may name the type of their key, e.g. 'P-256' or 'Ed25519', passed
+in the `key_type` of the request, None for the CA's default. The signing
+function must generate keys of that type, unless the key is given. With a key
+pool, keys of other types than the pool's are generated on demand. Requests
+for key types `keys.check_key_type` does not know are not answered.
+
+A certificate is only signed again when its request changes: a different CN,
+SANs or renewal marker, or a new CA certificate. Fingerprints of the requests
+answered are kept in StoredState and the certificates already issued are read
+back from the relation data. Requests of all the units of a relation are
+decoded in one pass and each relation data field of this unit is written at
+most once per call, only if its value changes.
+
+Requests may be zlib compressed, see `interface_tls_certificates.compression`;
+CAProvider reads both forms, advertises it in its `encodings` field and
+compresses the responses to the units which advertise it too. Pass
+`compress=False` to neither advertise nor compress.
+
+All the application requests of the units of a relation are answered with one
+certificate, whose CN is the lowest sorting CN requested and whose SANs are
+all the CNs and SANs requested.
+"""
+
+import collections
+import json
+import logging
+import re
+
+from ops.framework import (
+    Object,
+    StoredState
+)
+from ops.model import BlockedStatus
+
+from . import compression, keys
+from .ca_client import (
+    CAClient,
+    TLSCertificatesError
+)
+from .hashing import fingerprint
+
+logger = logging.getLogger(__name__)
+
+SigningRequest = collections.namedtuple(
+    'SigningRequest',
+    ['request_type', 'common_name', 'sans', 'key', 'csr', 'key_type'])
+# key, csr and key_type default to None, namedtuple() only takes defaults
+# from Python 3.7
+SigningRequest.__new__.__defaults__ = (None, None, None)
+SigningRequest.__doc__ = """A certificate to sign.
+
+request_type is 'server', 'client' or 'application', legacy requests are
+signed as server certificates. key is the PEM text of the private key to
+issue the certificate for, None when the signer generates it. csr is the PEM
+text of the certificate signing request of the client, None if the client
+did not send one, in which case key is None too. key_type is the type of key
+requested, see keys.check_key_type, None for the default of the signer.
+"""
+
+# Fields of this unit's relation data answering the requests of a unit,
+# after '<unit name with / replaced by _>.'.
+_RESPONSE_FIELD = re.compile(
+    r'^(?P<unit>.+)\.(?:server\.cert|server\.key|processed_requests|'
+    r'processed_client_requests|processed_application_requests)$')
+
+
+class CAProviderError(TLSCertificatesError):
+    """An error specific to the CAProvider class"""
+
+
+class CAProvider(Object):
+    """Provides a CA type that answers the requests of CAClient units.
+
+    It mainly provides:
+
+    * a method to set the CA certificate and chain given to all units;
+    * the signing, in batches, of the certificates requested by all units,
+      only signing again those whose request changed;
+    * the publishing of the issued certificates and keys.
+    """
+
+    _stored = StoredState()
+
+    REQUEST_KEYS = CAClient.REQUEST_KEYS
+    PROCESSED_KEYS = CAClient.PROCESSED_KEYS
+
+    # Sign at most this many certificates in one call to the signer
+    BATCH_SIZE = 100
+
+    # Key of the combined certificate in processed_application_requests
+    APPLICATION_KEY = 'app_data'
+
+    def __init__(self, charm, relation_name, sign, batch_size=BATCH_SIZE,
+                 key_pool=None, compress=True):
+        """
+        :param charm: the charm object to be used as a parent object.
+        :type charm: :class: `ops.charm.CharmBase`
+        :param relation_name: the name of the relation with the clients.
+        :type relation_name: str
+        :param sign: function returning the PEM 'cert' and 'key' issued for
+            each SigningRequest of a list, in the same order.
+        :type sign: Callable[[List[SigningRequest]], List[Dict[str, str]]]
+        :param batch_size: how many certificates to pass to sign at most.
+        :type batch_size: int
+        :param key_pool: where to take the keys of certificates from, None
+            to leave generating them to sign.
+        :type key_pool: Optional[keys.KeyPool]
+        :param compress: whether to advertise that compressed requests are
+            read, and to compress the responses to units which do too.
+        :type compress: bool
+        """
+        super().__init__(charm, relation_name)
+        self.relation_name = relation_name
+        self._sign = sign
+        self.batch_size = batch_size
+        self._key_pool = key_pool
+        self.compress = compress
+        # Fingerprints of the requests answered, keyed on relation id, then
+        # 'units' and the munged unit name, request type and CN, or
+        # 'application'.
+        self._stored.set_default(
+            ca_certificate=None,
+            root_ca_chain=None,
+            relations={})
+        self.framework.observe(charm.on[relation_name].relation_changed,
+                               self._on_relation_changed)
+        self.framework.observe(charm.on[relation_name].relation_departed,
+                               self._on_relation_changed)
+        self.framework.observe(charm.on[relation_name].relation_broken,
+                               self._on_relation_broken)
+
+    @property
+    def is_ready(self):
+        """Whether a CA certificate has been set."""
+        return bool(self._stored.ca_certificate)
+
+    def set_ca_certificate(self, ca_certificate, root_ca_chain=None):
+        """Set the CA certificate and chain and answer all requests.
+
+        When they change, all certificates are signed again.
+
+        :param ca_certificate: PEM text of the CA certificate
+        :type ca_certificate: str
+        :param root_ca_chain: PEM text of the chain up to the root CA
+        :type root_ca_chain: Optional[str]
+        :returns: Certificates signed
+        :rtype: List[SigningRequest]
+        :raises: CAProviderError
+        """
+        self._stored.ca_certificate = ca_certificate
+        self._stored.root_ca_chain = root_ca_chain
+        return self.process_requests()
+
+    def _on_relation_changed(self, event):
+        if not self.is_ready:
+            logger.info('Ignoring requests until a CA certificate is set')
+            return
+        self.process_requests(event.relation.id)
+
+    def _on_relation_broken(self, event):
+        self._stored.relations.pop(str(event.relation.id), None)
+
+    def _state(self, relation_id):
+        """Return what is stored about a relation, creating it if needed.
+
+        :param relation_id: Relation id
+        :type relation_id: int
+        :returns: Stored state of the relation
+        :rtype: ops.framework.StoredDict
+        """
+        key = str(relation_id)
+        if key not in self._stored.relations:
+            self._stored.relations[key] = {'units': {}, 'application': None}
+        return self._stored.relations[key]
+
+    @staticmethod
+    def _decode(data, field, unit_name):
+        """Return the JSON decoded value of field in data.
+
+        The value may be compressed, see compression.decode.
+
+        :param data: Relation data
+        :type data: Dict[str, str]
+        :param field: Key in data
+        :type field: str
+        :param unit_name: Unit the data is about, for logging
+        :type unit_name: str
+        :returns: Decoded value, {} if absent and None if invalid
+        :rtype: Optional[Dict[str, Any]]
+        """
+        try:
+            value = compression.decode(data.get(field) or '{}')
+        except ValueError:
+            logger.warning('Ignoring invalid %s of %s', field, unit_name)
+            return None
+        if not isinstance(value, dict):
+            logger.warning('Ignoring invalid %s of %s', field, unit_name)
+            return None
+        return value
+
+    def _unit_requests(self, data, unit_name):
+        """Return the requests of a unit keyed on request type then CN.
+
+        Request types whose requests cannot be decoded are None.
+
+        :param data: Relation data of the unit
+        :type data: Dict[str, str]
+        :param unit_name: Name of the unit
+        :type unit_name: str
+        :returns: Requests
+        :rtype: Dict[str, Optional[Dict[str, Dict[str, Any]]]]
+        """
+        requests = {}
+        for request_type, request_key in self.REQUEST_KEYS.items():
+            if request_type != 'legacy':
+                requests[request_type] = self._decode(
+                    data, request_key, unit_name)
+                continue
+            requests[request_type] = {}
+            cn = data.get('common_name')
+            if cn:
+                try:
+                    sans = json.loads(data.get('sans') or '[]')
+                except ValueError:
+                    logger.warning('Ignoring invalid sans of %s', unit_name)
+                    requests[request_type] = None
+                    continue
+                requests[request_type] = {cn: {'sans': sans}}
+        return requests
+
+    @staticmethod
+    def _request_fingerprint(ca_digest, request_type, cn, request):
+        """Return a digest of what a certificate is issued from.
+
+        :param ca_digest: Digest of the CA certificate and chain
+        :type ca_digest: str
+        :param request_type: Type the certificate is signed as
+        :type request_type: str
+        :param cn: Common name
+        :type cn: str
+        :param request: Request, with 'sans' and any renewal marker
+        :type request: Dict[str, Any]
+        :returns: Hex digest
+        :rtype: str
+        """
+        return fingerprint([
+            ca_digest, request_type, cn, json.dumps(request, sort_keys=True)])
+
+    @staticmethod
+    def _valid_key_type(request, cn, unit_name):
+        """Check the key type of a request, if any, can be generated.
+
+        :param request: Request
+        :type request: Dict[str, Any]
+        :param cn: Common name of the request, for logging
+        :type cn: str
+        :param unit_name: Unit the request is from, for logging
+        :type unit_name: str
+        :returns: Whether the request can be answered
+        :rtype: bool
+        """
+        key_type = request.get('key_type')
+        if key_type is None:
+            return True
+        try:
+            keys.check_key_type(key_type)
+        except ValueError:
+            logger.warning('Ignoring request of %s for %s with unsupported '
+                           'key type %s', unit_name, cn, key_type)
+            return False
+        return True
+
+    @staticmethod
+    def _application_request(requests):
+        """Combine the application requests of all units into one.
+
+        The key type is that of the request of the CN of the certificate.
+
+        :param requests: Application requests keyed on CN
+        :type requests: Dict[str, Dict[str, Any]]
+        :returns: CN and combined request, or None if there is no request
+        :rtype: Optional[Tuple[str, Dict[str, Any]]]
+        """
+        if not requests:
+            return None
+        sans = set(requests)
+        renewals = set()
+        for request in requests.values():
+            sans.update(request.get('sans') or [])
+            if request.get('renewal') is not None:
+                renewals.add(request['renewal'])
+        cn = min(requests)
+        request = {'sans': sorted(sans)}
+        if renewals:
+            request['renewal'] = max(renewals)
+        if requests[cn].get('key_type') is not None:
+            request['key_type'] = requests[cn]['key_type']
+        return cn, request
+
+    def process_requests(self, relation_id=None):
+        """Answer the requests of all units, signing only what changed.
+
+        :param relation_id: Relation to answer, None for all relations
+        :type relation_id: Optional[int]
+        :returns: Certificates signed
+        :rtype: List[SigningRequest]
+        :raises: CAProviderError
+        """
+        if not self.is_ready:
+            raise CAProviderError(BlockedStatus,
+                                  'a CA certificate has not been set',
+                                  self.relation_name)
+        if relation_id is None:
+            relations = self.model.relations[self.relation_name]
+        else:
+            relation = self.model.get_relation(
+                self.relation_name, relation_id)
+            relations = [relation] if relation else []
+        ca_digest = fingerprint([
+            self._stored.ca_certificate, self._stored.root_ca_chain])
+        # Certificates to sign keyed on (relation id, unit, request type,
+        # CN, fingerprint), each with where to put the issued material.
+        pending = collections.OrderedDict()
+        plans = []
+        for relation in relations:
+            plans.append(self._plan_relation(relation, ca_digest, pending))
+        signed = []
+        items = list(pending.values())
+        if self._key_pool is not None:
+            # Indexes of the requests without a CSR keyed on key type
+            keyless = collections.defaultdict(list)
+            for index, (request, _) in enumerate(items):
+                if request.csr is None:
+                    keyless[request.key_type].append(index)
+            for key_type, indexes in keyless.items():
+                taken = self._key_pool.take(len(indexes), key_type)
+                for index, key in zip(indexes, taken):
+                    request, targets = items[index]
+                    items[index] = (request._replace(key=key), targets)
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            requests = [request for request, _ in batch]
+            issued = self._sign(requests)
+            if len(issued) != len(requests):
+                raise CAProviderError(
+                    BlockedStatus,
+                    'signer returned {} certificates for {} '
+                    'requests'.format(len(issued), len(requests)),
+                    self.relation_name)
+            for (request, targets), data in zip(batch, issued):
+                if request.csr is None:
+                    data = {'cert': data['cert'],
+                            'key': data.get('key') or request.key}
+                else:
+                    # The client has the key.
+                    data = {'cert': data['cert']}
+                for responses, cn in targets:
+                    responses[cn] = data
+            signed.extend(requests)
+        if signed:
+            logger.info('Signed %d certificates', len(signed))
+        for plan in plans:
+            self._publish(*plan)
+        return signed
+
+    def _plan_relation(self, relation, ca_digest, pending):
+        """Work out the responses of a relation, queueing what to sign.
+
+        :param relation: Relation with clients
+        :type relation: ops.model.Relation
+        :param ca_digest: Digest of the CA certificate and chain
+        :type ca_digest: str
+        :param pending: Certificates to sign, added to
+        :type pending: collections.OrderedDict
+        :returns: Arguments of _publish
+        :rtype: Tuple
+        """
+        state = self._state(relation.id)
+        local = dict(relation.data[self.model.unit])
+        # Responses keyed on munged unit name then request type, the new
+        # fingerprints alike. None stands for requests left as they are.
+        responses = {}
+        fingerprints = {}
+        app_requests = {}
+        app_units = []
+        # Munged names of the units reading compressed responses
+        compressed_units = set()
+        for unit in sorted(relation.units, key=lambda u: u.name):
+            data = dict(relation.data[unit])
+            unit_name = data.get('unit_name') or unit.name
+            munged = unit_name.replace('/', '_')
+            if self.compress and compression.supports_compression(data):
+                compressed_units.add(munged)
+            old_fingerprints = state['units'].get(munged) or {}
+            unit_responses = responses[munged] = {}
+            unit_fingerprints = fingerprints[munged] = {}
+            requests = self._unit_requests(data, unit_name)
+            for request_type, type_requests in requests.items():
+                if type_requests is None:
+                    unit_responses[request_type] = None
+                    unit_fingerprints[request_type] = dict(
+                        old_fingerprints.get(request_type) or {})
+                    continue
+                if request_type == 'application':
+                    if type_requests:
+                        app_units.append(munged)
+                        app_requests.update(
+                            (cn, request)
+                            for cn, request in type_requests.items()
+                            if self._valid_key_type(request, cn, unit_name))
+                    continue
+                issued = self._issued(
+                    local, munged, request_type, data.get('common_name'))
+                old = old_fingerprints.get(request_type) or {}
+                type_responses = unit_responses[request_type] = {}
+                type_fingerprints = unit_fingerprints[request_type] = {}
+                # Legacy requests are server certificates too.
+                sign_type = 'client' if request_type == 'client' else 'server'
+                for cn, request in sorted(type_requests.items()):
+                    if not self._valid_key_type(request, cn, unit_name):
+                        continue
+                    request_fingerprint = self._request_fingerprint(
+                        ca_digest, sign_type, cn, request)
+                    type_fingerprints[cn] = request_fingerprint
+                    if old.get(cn) == request_fingerprint and cn in issued:
+                        type_responses[cn] = issued[cn]
+                        continue
+                    key = (relation.id, munged, sign_type, cn,
+                           request_fingerprint)
+                    if key not in pending:
+                        pending[key] = (
+                            SigningRequest(
+                                sign_type, cn,
+                                list(request.get('sans') or []),
+                                csr=request.get('csr'),
+                                key_type=request.get('key_type')),
+                            [])
+                    pending[key][1].append((type_responses, cn))
+        app_responses = {}
+        app_fingerprint = None
+        app_request = self._application_request(app_requests)
+        if app_request:
+            cn, request = app_request
+            app_fingerprint = self._request_fingerprint(
+                ca_digest, 'application', cn, request)
+            issued = {}
+            for munged in app_units:
+                issued.update(self._issued(local, munged, 'application'))
+            unchanged = state['application'] == app_fingerprint
+            if unchanged and self.APPLICATION_KEY in issued:
+                app_responses[self.APPLICATION_KEY] = issued[
+                    self.APPLICATION_KEY]
+            else:
+                key = (relation.id, None, 'application', cn, app_fingerprint)
+                pending[key] = (
+                    SigningRequest('application', cn, request['sans'],
+                                   key_type=request.get('key_type')),
+                    [(app_responses, self.APPLICATION_KEY)])
+        return (relation, local, responses, fingerprints, app_units,
+                app_responses, app_fingerprint, compressed_units)
+
+    def _issued(self, local, munged, request_type, legacy_cn=None):
+        """Return what this unit last published for a unit.
+
+        :param local: Relation data of this unit
+        :type local: Dict[str, str]
+        :param munged: Name of the client unit, / replaced by _
+        :type munged: str
+        :param request_type: Certificate type
+        :type request_type: str
+        :param legacy_cn: CN of the legacy request of the unit, if any
+        :type legacy_cn: Optional[str]
+        :returns: 'cert' and 'key' keyed on CN
+        :rtype: Dict[str, Dict[str, str]]
+        """
+        if request_type == 'legacy':
+            cert = local.get('{}.server.cert'.format(munged))
+            key = local.get('{}.server.key'.format(munged))
+            if not (legacy_cn and cert and key):
+                return {}
+            # Whether it was issued for legacy_cn is covered by the request
+            # fingerprint the caller compares.
+            return {legacy_cn: {'cert': cert, 'key': key}}
+        field = '{}.{}'.format(munged, self.PROCESSED_KEYS[request_type])
+        return self._decode(local, field, munged) or {}
+
+    def _publish(self, relation, local, responses, fingerprints, app_units,
+                 app_responses, app_fingerprint, compressed_units):
+        """Write the responses of a relation and remember what they answer.
+
+        :param relation: Relation with clients
+        :type relation: ops.model.Relation
+        :param local: Relation data of this unit
+        :type local: Dict[str, str]
+        :param responses: Responses keyed on munged unit name, request type
+                          and CN, None for request types left as they are
+        :type responses: Dict[str, Dict[str, Optional[Dict]]]
+        :param fingerprints: Fingerprints of the requests answered, keyed
+                             like responses
+        :type fingerprints: Dict[str, Dict[str, Dict[str, str]]]
+        :param app_units: Munged names of units with application requests
+        :type app_units: List[str]
+        :param app_responses: Response to application requests
+        :type app_responses: Dict[str, Dict[str, str]]
+        :param app_fingerprint: Fingerprint of the application request
+        :type app_fingerprint: Optional[str]
+        :param compressed_units: Munged names of the units reading
+                                 compressed responses
+        :type compressed_units: Set[str]
+        """
+        fields = {
+            'ca': self._stored.ca_certificate,
+            'chain': self._stored.root_ca_chain or ''}
+        if self.compress:
+            fields[compression.ENCODINGS_FIELD] = compression.advertisement()
+        # Drop the responses to units which are gone.
+        for field in local:
+            match = _RESPONSE_FIELD.match(field)
+            if match and match.group('unit') not in responses:
+                fields[field] = ''
+        for munged, unit_responses in responses.items():
+            legacy = unit_responses.get('legacy', {})
+            if legacy is not None:
+                entry = next(iter(legacy.values()), {})
+                for name in ('cert', 'key'):
+                    fields['{}.server.{}'.format(munged, name)] = (
+                        entry.get(name) or '')
+            for request_type in ('server', 'client', 'application'):
+                type_responses = unit_responses.get(request_type, {})
+                if type_responses is None:
+                    # Requests which cannot be decoded are left alone.
+                    continue
+                if request_type == 'application':
+                    type_responses = (
+                        app_responses if munged in app_units else {})
+                field = '{}.{}'.format(
+                    munged, self.PROCESSED_KEYS[request_type])
+                fields[field] = (
+                    compression.encode(
+                        type_responses, munged in compressed_units)
+                    if type_responses else '')
+        changed = {
+            field: value
+            for field, value in fields.items()
+            if local.get(field, '') != value}
+        if changed:
+            logger.debug('Updating %d fields of relation %s',
+                         len(changed), relation.id)
+            rel_data = relation.data[self.model.unit]
+            for field, value in sorted(changed.items()):
+                rel_data[field] = value
+        state = self._state(relation.id)
+        state['units'] = fingerprints
+        state['application'] = app_fingerprint
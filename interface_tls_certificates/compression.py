@@ -0,0 +1,130 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compressed encoding of the JSON values of tls-certificates relation data.
+
+With hundreds of CNs the requests and responses exchanged over the relation
+reach megabytes per unit. A value may instead be written as PREFIX followed
+by the base64 of its zlib compressed JSON. The prefix carries the version of
+the encoding and cannot start a JSON text, so decode() reads both forms.
+
+A unit only writes compressed values for peers which advertise, in the
+ENCODINGS_FIELD of their relation data, that they decode them; values for
+other peers, and values too small to gain from it, are written as plain JSON.
+"""
+
+import base64
+import binascii
+import json
+import zlib
+
+# Name of the encoding, advertised in ENCODINGS_FIELD
+ZLIB = 'zlib1'
+
+# Marker starting compressed values
+PREFIX = ZLIB + ':'
+
+# Relation data field listing, as JSON, the encodings a unit decodes
+ENCODINGS_FIELD = 'encodings'
+
+# Values whose JSON is shorter than this are not compressed
+MIN_SIZE = 1024
+
+# zlib compression level, higher levels gain little on PEM
+LEVEL = 6
+
+# Largest decompressed value read, so that a small value written by a peer
+# cannot expand to exhaust memory
+MAX_SIZE = 64 * 1024 * 1024
+
+
+def advertisement():
+    """Return the value of ENCODINGS_FIELD advertising what decode() reads.
+
+    :returns: JSON list of encodings
+    :rtype: str
+    """
+    return json.dumps([ZLIB])
+
+
+def supports_compression(data):
+    """Return whether a unit advertises that it decodes compressed values.
+
+    :param data: Relation data of the unit
+    :type data: Mapping[str, str]
+    :returns: Whether compressed values can be written for the unit
+    :rtype: bool
+    """
+    try:
+        encodings = json.loads(data.get(ENCODINGS_FIELD) or '[]')
+    except ValueError:
+        return False
+    return isinstance(encodings, list) and ZLIB in encodings
+
+
+def is_compressed(text):
+    """Return whether a relation data value is compressed.
+
+    :param text: Relation data value
+    :type text: str
+    :returns: Whether text starts with PREFIX
+    :rtype: bool
+    """
+    return text.startswith(PREFIX)
+
+
+def encode(value, compress=False, min_size=MIN_SIZE):
+    """Encode a value as JSON, compressed if asked and worth it.
+
+    :param value: Value to encode
+    :type value: Any
+    :param compress: Whether the reader decodes compressed values
+    :type compress: bool
+    :param min_size: Length of JSON below which it is not compressed
+    :type min_size: int
+    :returns: Relation data value
+    :rtype: str
+    """
+    text = json.dumps(value, sort_keys=True)
+    if not compress or len(text) < min_size:
+        return text
+    return PREFIX + base64.b64encode(
+        zlib.compress(text.encode('utf-8'), LEVEL)).decode('ascii')
+
+
+def decode(text):
+    """Decode a value written by encode() or as plain JSON.
+
+    Compressed values expanding to more than MAX_SIZE bytes are rejected.
+
+    :param text: Relation data value
+    :type text: str
+    :returns: Decoded value
+    :rtype: Any
+    :raises: ValueError
+    """
+    if is_compressed(text):
+        decompressor = zlib.decompressobj()
+        try:
+            text = decompressor.decompress(
+                base64.b64decode(text[len(PREFIX):], validate=True),
+                MAX_SIZE)
+        except (binascii.Error, zlib.error) as e:
+            raise ValueError('Invalid compressed value: {}'.format(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError(
+                'Compressed value larger than {} bytes'.format(MAX_SIZE))
+        if not decompressor.eof:
+            raise ValueError('Invalid compressed value: truncated')
+    return json.loads(text)
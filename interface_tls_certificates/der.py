@@ -0,0 +1,253 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Extraction of X.509 certificate metadata straight from DER.
+
+Expiry checks, name indexing and inventory listings only need a few fields
+of a certificate: serial number, validity, subject CN, SANs and the type and
+digest of the public key. certificate_metadata() walks the DER encoding of the
+TBSCertificate to read just those fields. It neither builds cryptography
+objects nor loads OpenSSL, and it does not verify signatures, so it must only
+be used on certificates obtained from a trusted CA.
+"""
+
+import calendar
+import hashlib
+import ipaddress
+
+# Tags of the ASN.1 types used in certificates
+_INTEGER = 0x02
+_BIT_STRING = 0x03
+_OCTET_STRING = 0x04
+_OID = 0x06
+_UTC_TIME = 0x17
+_GENERALIZED_TIME = 0x18
+_SEQUENCE = 0x30
+_VERSION = 0xa0
+_EXTENSIONS = 0xa3
+_DNS_NAME = 0x82
+_IP_ADDRESS = 0x87
+
+# Content octets of the OIDs looked for
+_COMMON_NAME = b'\x55\x04\x03'
+_SUBJECT_ALT_NAME = b'\x55\x1d\x11'
+_RSA_ENCRYPTION = b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+_EC_PUBLIC_KEY = b'\x2a\x86\x48\xce\x3d\x02\x01'
+_CURVES = {
+    b'\x2a\x86\x48\xce\x3d\x03\x01\x07': 'P-256',
+    b'\x2b\x81\x04\x00\x22': 'P-384',
+    b'\x2b\x81\x04\x00\x23': 'P-521'}
+_EDWARDS_CURVES = {
+    b'\x2b\x65\x70': 'Ed25519',
+    b'\x2b\x65\x71': 'Ed448'}
+
+# Decoding of the string types a CN may use, UTF-8 for the others
+_STRING_ENCODINGS = {
+    0x14: 'latin-1',
+    0x1c: 'utf-32-be',
+    0x1e: 'utf-16-be'}
+
+
+def _read(data, offset, expected=None):
+    """Read the tag and length of the DER element at offset.
+
+    :param data: DER data
+    :type data: bytes
+    :param offset: Offset of the element
+    :type offset: int
+    :param expected: Tag the element must have, if any
+    :type expected: Optional[int]
+    :returns: Tag, offset of the content and offset following the element
+    :rtype: Tuple[int, int, int]
+    :raises: ValueError
+    """
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+    except IndexError:
+        raise ValueError('Truncated DER element at {}'.format(offset))
+    if expected is not None and tag != expected:
+        raise ValueError('Expected DER tag {:#x} at {}, got {:#x}'.format(
+            expected, offset, tag))
+    start = offset + 2
+    if length & 0x80:
+        size = length & 0x7f
+        if not 0 < size <= 4:
+            raise ValueError('Unsupported DER length at {}'.format(offset))
+        length = int.from_bytes(data[start:start + size], 'big')
+        start += size
+    end = start + length
+    if end > len(data):
+        raise ValueError('Truncated DER element at {}'.format(offset))
+    return tag, start, end
+
+
+def _children(data, start, end):
+    """Iterate over the elements between start and end.
+
+    :param data: DER data
+    :type data: bytes
+    :param start: Offset of the first element
+    :type start: int
+    :param end: Offset following the last element
+    :type end: int
+    :returns: Tag, offset of the content and offset following each element
+    :rtype: Iterator[Tuple[int, int, int]]
+    :raises: ValueError
+    """
+    while start < end:
+        tag, content, start = _read(data, start)
+        yield tag, content, start
+
+
+def _time(data, tag, start, end):
+    """Decode a UTCTime or GeneralizedTime.
+
+    :returns: Seconds since the epoch
+    :rtype: int
+    :raises: ValueError
+    """
+    text = data[start:end].decode('ascii')
+    if not text.endswith('Z'):
+        raise ValueError('Time is not in UTC: {}'.format(text))
+    if tag == _UTC_TIME:
+        year = int(text[:2])
+        # RFC 5280: UTCTime years from 50 are in the 20th century.
+        text = ('19' if year >= 50 else '20') + text
+    elif tag != _GENERALIZED_TIME:
+        raise ValueError('Unexpected time tag {:#x}'.format(tag))
+    return calendar.timegm((
+        int(text[0:4]), int(text[4:6]), int(text[6:8]),
+        int(text[8:10]), int(text[10:12]), int(text[12:14])))
+
+
+def _common_name(data, start, end):
+    """Return the most specific, i.e. last, CN of a Name.
+
+    :returns: CN or None if the name has none
+    :rtype: Optional[str]
+    """
+    common_name = None
+    for _, rdn_start, rdn_end in _children(data, start, end):
+        for _, atv_start, atv_end in _children(data, rdn_start, rdn_end):
+            _, oid_start, oid_end = _read(data, atv_start, _OID)
+            if data[oid_start:oid_end] != _COMMON_NAME:
+                continue
+            tag, value_start, value_end = _read(data, oid_end)
+            common_name = data[value_start:value_end].decode(
+                _STRING_ENCODINGS.get(tag, 'utf-8'))
+    return common_name
+
+
+def _key_type(data, start, end):
+    """Describe the key of a SubjectPublicKeyInfo.
+
+    :returns: 'RSA-<bits>', the curve name or None if unknown
+    :rtype: Optional[str]
+    """
+    _, alg_start, alg_end = _read(data, start, _SEQUENCE)
+    _, oid_start, oid_end = _read(data, alg_start, _OID)
+    oid = data[oid_start:oid_end]
+    if oid in _EDWARDS_CURVES:
+        return _EDWARDS_CURVES[oid]
+    if oid == _EC_PUBLIC_KEY:
+        if oid_end >= alg_end:
+            return None
+        tag, curve_start, curve_end = _read(data, oid_end)
+        if tag != _OID:
+            return None
+        return _CURVES.get(data[curve_start:curve_end])
+    if oid == _RSA_ENCRYPTION:
+        # The bit string holds RSAPublicKey ::= SEQUENCE {modulus, exponent},
+        # after a byte giving the number of unused bits.
+        _, bits_start, _ = _read(data, alg_end, _BIT_STRING)
+        _, key_start, _ = _read(data, bits_start + 1, _SEQUENCE)
+        _, mod_start, mod_end = _read(data, key_start, _INTEGER)
+        modulus = int.from_bytes(data[mod_start:mod_end], 'big')
+        return 'RSA-{}'.format(modulus.bit_length())
+    return None
+
+
+def _subject_alt_names(data, start, end):
+    """Decode the DNS names and IP addresses of a SubjectAltName value.
+
+    :returns: DNS names and IP addresses
+    :rtype: Tuple[List[str], List[str]]
+    """
+    dns_names = []
+    ip_addresses = []
+    _, names_start, names_end = _read(data, start, _SEQUENCE)
+    for tag, name_start, name_end in _children(data, names_start, names_end):
+        if tag == _DNS_NAME:
+            dns_names.append(data[name_start:name_end].decode('ascii'))
+        elif tag == _IP_ADDRESS:
+            ip_addresses.append(str(
+                ipaddress.ip_address(data[name_start:name_end])))
+    return dns_names, ip_addresses
+
+
+def certificate_metadata(data):
+    """Return the metadata of a DER encoded certificate.
+
+    :param data: DER encoded X.509 certificate
+    :type data: bytes
+    :returns: 'serial' (int), 'not_before' and 'not_after' (seconds since the
+              epoch), 'common_name' (last subject CN or None), 'dns_names'
+              and 'ip_addresses' (SANs, None if the certificate has no SAN
+              extension) and 'key_type' ('RSA-<bits>', 'P-256', 'P-384',
+              'P-521', 'Ed25519', 'Ed448' or None) and 'public_key_sha256'
+              (hex SHA-256 of the DER SubjectPublicKeyInfo)
+    :rtype: Dict[str, Any]
+    :raises: ValueError
+    """
+    data = bytes(data)
+    _, cert_start, _ = _read(data, 0, _SEQUENCE)
+    _, tbs_start, tbs_end = _read(data, cert_start, _SEQUENCE)
+    fields = list(_children(data, tbs_start, tbs_end))
+    if fields and fields[0][0] == _VERSION:
+        fields = fields[1:]
+    # serialNumber, signature, issuer, validity, subject and
+    # subjectPublicKeyInfo, then the optional unique ids and extensions.
+    if len(fields) < 6 or fields[0][0] != _INTEGER:
+        raise ValueError('Not a DER encoded certificate')
+    (_, serial_start, serial_end), _, _, validity, subject, spki = fields[:6]
+    not_before, not_after = list(_children(data, *validity[1:]))[:2]
+    metadata = {
+        'serial': int.from_bytes(
+            data[serial_start:serial_end], 'big', signed=True),
+        'not_before': _time(data, *not_before),
+        'not_after': _time(data, *not_after),
+        'common_name': _common_name(data, *subject[1:]),
+        'dns_names': None,
+        'ip_addresses': None,
+        'key_type': _key_type(data, *spki[1:]),
+        # The SubjectPublicKeyInfo starts where the subject ends.
+        'public_key_sha256': hashlib.sha256(
+            data[subject[2]:spki[2]]).hexdigest()}
+    for tag, start, end in fields[6:]:
+        if tag != _EXTENSIONS:
+            continue
+        _, exts_start, exts_end = _read(data, start, _SEQUENCE)
+        for _, ext_start, ext_end in _children(data, exts_start, exts_end):
+            _, oid_start, oid_end = _read(data, ext_start, _OID)
+            if data[oid_start:oid_end] != _SUBJECT_ALT_NAME:
+                continue
+            # Skip the optional critical flag to reach the OCTET STRING.
+            for tag, value_start, value_end in _children(
+                    data, oid_end, ext_end):
+                if tag == _OCTET_STRING:
+                    (metadata['dns_names'],
+                     metadata['ip_addresses']) = _subject_alt_names(
+                        data, value_start, value_end)
+    return metadata
@@ -0,0 +1,111 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Atomic writing of certificate material to disk."""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def _file_digest(path):
+    """Return the digest of the content of path.
+
+    :param path: Path of a file
+    :type path: str
+    :returns: Hex digest or None if the file does not exist
+    :rtype: Optional[str]
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _fsync_path(path):
+    """Flush the content of a file, or the entries of a directory, to disk.
+
+    :param path: Path of a file or directory
+    :type path: str
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files(files, dir_mode=0o700, fsync=True):
+    """Atomically write files whose content differs from what is on disk.
+
+    Each file is written to a temporary file in the target directory, which
+    is closed straight away so that only one file is open at a time. Once
+    all of them are written, the temporary files are flushed, so that the
+    kernel writes back the whole batch rather than one file per flush, then
+    renamed over their targets, and each directory is flushed once after
+    all renames. Files whose content already matches are left untouched
+    apart from their permissions.
+
+    :param files: (content, mode) keyed on path
+    :type files: Dict[str, Tuple[bytes, int]]
+    :param dir_mode: Permissions of directories that need creating
+    :type dir_mode: int
+    :param fsync: Whether to flush files and directories to disk
+    :type fsync: bool
+    :returns: Sorted paths that were written
+    :rtype: List[str]
+    """
+    pending = []
+    try:
+        for path, (content, mode) in sorted(files.items()):
+            if _file_digest(path) == hashlib.sha256(content).hexdigest():
+                if os.stat(path).st_mode & 0o777 != mode:
+                    os.chmod(path, mode)
+                continue
+            directory = os.path.dirname(path) or '.'
+            os.makedirs(directory, mode=dir_mode, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=directory,
+                prefix='.{}.'.format(os.path.basename(path)))
+            pending.append((tmp_path, path))
+            try:
+                os.fchmod(fd, mode)
+                view = memoryview(content)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        if fsync:
+            for tmp_path, _ in pending:
+                _fsync_path(tmp_path)
+        for tmp_path, path in pending:
+            os.rename(tmp_path, path)
+    except Exception:
+        for tmp_path, _ in pending:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+        raise
+    written = [path for _, path in pending]
+    if fsync:
+        for directory in sorted({os.path.dirname(p) or '.' for p in written}):
+            _fsync_path(directory)
+    if written:
+        logger.debug('Wrote %d files: %s', len(written), ', '.join(written))
+    return written
@@ -0,0 +1,48 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Digests of PEM texts and of relation data values.
+
+Both the client and the provider compare what they last handled with what is
+in relation data by these digests, and stores name texts after them.
+"""
+
+import hashlib
+
+
+def digest(text):
+    """Return the digest a text is stored under.
+
+    :param text: PEM text
+    :type text: str
+    :returns: Hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def fingerprint(values):
+    """Return a digest identifying a sequence of relation data values.
+
+    :param values: Relation data values, None for missing values
+    :type values: Iterable[Optional[str]]
+    :returns: Hex digest
+    :rtype: str
+    """
+    values_digest = hashlib.sha256()
+    for value in values:
+        data = (value or '').encode('utf-8')
+        values_digest.update(str(len(data)).encode('ascii') + b':')
+        values_digest.update(data)
+    return values_digest.hexdigest()
@@ -0,0 +1,394 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generation of the private keys of issued certificates.
+
+Key types are named as der.certificate_metadata() names them. Only those in
+KEY_TYPES are generated: 'RSA-2048', 'RSA-3072' and 'RSA-4096', the NIST
+curves 'P-256', 'P-384' and 'P-521', and 'Ed25519' and 'Ed448'. Key types
+come from relation data, so the list is closed to keep a peer from asking
+for weak keys or for RSA keys so large that generating them hangs the hook.
+Elliptic curve keys are much cheaper to generate, smaller in relation data
+and faster to load and use in handshakes than RSA keys.
+
+Generating RSA keys costs far more than signing certificates, so a CA
+answering many requests at once spends most of its time on keys.
+generate_keys() spreads the work over a pool of processes, one per core by
+default. `KeyPool`_ keeps keys generated ahead of time in StoredState, or in
+a `store.MaterialStore`, and refills itself in update-status hooks, so that
+a burst of requests only pays for signing::
+
+    self.key_pool = KeyPool(self, 'key-pool', size=200)
+    self.ca_provider = CAProvider(self, 'certificates', self._sign,
+                                  key_pool=self.key_pool)
+
+Clients which keep their keys to themselves generate them together with a
+certificate signing request with generate_csrs(), in parallel as well.
+"""
+
+import concurrent.futures
+import hashlib
+import ipaddress
+import logging
+import os
+
+from ops.framework import (
+    Object,
+    StoredState
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEY_TYPE = 'RSA-2048'
+
+# Public exponent of generated RSA keys
+_RSA_EXPONENT = 65537
+
+# Sizes of the RSA key types
+_RSA_BITS = {
+    'RSA-2048': 2048,
+    'RSA-3072': 3072,
+    'RSA-4096': 4096}
+
+# Names of the cryptography curves of elliptic curve key types
+_CURVES = {
+    'P-256': 'SECP256R1',
+    'P-384': 'SECP384R1',
+    'P-521': 'SECP521R1'}
+
+# Key types signing without a separate hash algorithm
+_EDWARDS_KEY_TYPES = ('Ed25519', 'Ed448')
+
+# Hash algorithms signing CSRs, by key type, SHA256 for the others
+_HASHES = {
+    'P-384': 'SHA384',
+    'P-521': 'SHA512'}
+
+# Key types which can be generated
+KEY_TYPES = tuple(_RSA_BITS) + tuple(_CURVES) + _EDWARDS_KEY_TYPES
+
+
+def check_key_type(key_type):
+    """Check a key type is one of KEY_TYPES.
+
+    :param key_type: Key type, e.g. 'RSA-2048', 'P-256' or 'Ed25519'
+    :type key_type: str
+    :raises: ValueError
+    """
+    if key_type not in KEY_TYPES:
+        raise ValueError('Unsupported key type {}'.format(key_type))
+
+
+def _private_key(key_type):
+    """Generate a private key object.
+
+    cryptography is imported on first use, so that charms which never
+    generate keys do not load OpenSSL.
+
+    :param key_type: Key type, see check_key_type
+    :type key_type: str
+    :returns: Key
+    :rtype: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
+    :raises: ValueError
+    """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import (
+        ec, ed448, ed25519, rsa)
+    check_key_type(key_type)
+    if key_type in _CURVES:
+        return ec.generate_private_key(
+            getattr(ec, _CURVES[key_type])(), default_backend())
+    if key_type == 'Ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    if key_type == 'Ed448':
+        return ed448.Ed448PrivateKey.generate()
+    return rsa.generate_private_key(
+        _RSA_EXPONENT, _RSA_BITS[key_type], default_backend())
+
+
+def _signature_hash(key_type):
+    """Return the hash algorithm to sign with a key of key_type.
+
+    :param key_type: Key type, see check_key_type
+    :type key_type: str
+    :returns: Hash algorithm, None for Edwards curve keys
+    :rtype: Optional[cryptography.hazmat.primitives.hashes.HashAlgorithm]
+    """
+    from cryptography.hazmat.primitives import hashes
+    if key_type in _EDWARDS_KEY_TYPES:
+        return None
+    return getattr(hashes, _HASHES.get(key_type, 'SHA256'))()
+
+
+def _key_pem(key):
+    """Return the PEM text of a private key in PKCS#8 format.
+
+    PKCS#8 is the one format holding keys of every type.
+
+    :param key: Key
+    :type key: cryptography.hazmat.primitives.asymmetric.types.PrivateKeyTypes
+    :returns: PEM text
+    :rtype: str
+    """
+    from cryptography.hazmat.primitives import serialization
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+
+def _general_name(name):
+    """Return the SAN entry of a DNS name or IP address.
+
+    :param name: DNS name or IP address
+    :type name: str
+    :returns: SAN entry
+    :rtype: cryptography.x509.GeneralName
+    """
+    from cryptography import x509
+    try:
+        return x509.IPAddress(ipaddress.ip_address(name))
+    except ValueError:
+        return x509.DNSName(name)
+
+
+def public_key_digest(public_key):
+    """Return the digest identifying a public key.
+
+    It matches the 'public_key_sha256' der.certificate_metadata() returns
+    for certificates of the key.
+
+    :param public_key: Public key
+    :type public_key: cryptography.hazmat.primitives.asymmetric.types.\
+        PublicKeyTypes
+    :returns: Hex SHA-256 of the DER SubjectPublicKeyInfo
+    :rtype: str
+    """
+    from cryptography.hazmat.primitives import serialization
+    return hashlib.sha256(public_key.public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo)).hexdigest()
+
+
+def generate_key(key_type=DEFAULT_KEY_TYPE):
+    """Generate a private key.
+
+    :param key_type: Key type, see check_key_type
+    :type key_type: str
+    :returns: PEM text of the key in PKCS#8 format
+    :rtype: str
+    :raises: ValueError
+    """
+    return _key_pem(_private_key(key_type))
+
+
+def generate_csr(common_name, sans, key_type=DEFAULT_KEY_TYPE):
+    """Generate a private key and a certificate signing request for it.
+
+    :param common_name: Subject CN
+    :type common_name: str
+    :param sans: DNS names and IP addresses
+    :type sans: List[str]
+    :param key_type: Type of the key, see generate_key
+    :type key_type: str
+    :returns: PEM text of the 'key' and 'csr', and the 'public_key' digest
+    :rtype: Dict[str, str]
+    :raises: ValueError
+    """
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.x509.oid import NameOID
+    key = _private_key(key_type)
+    builder = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+    if sans:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName(
+                [_general_name(san) for san in sans]),
+            critical=False)
+    csr = builder.sign(key, _signature_hash(key_type), default_backend())
+    return {
+        'key': _key_pem(key),
+        'csr': csr.public_bytes(serialization.Encoding.PEM).decode('utf-8'),
+        'public_key': public_key_digest(key.public_key())}
+
+
+def _map(func, args, processes):
+    """Call func on each tuple of args, in a pool of processes if useful.
+
+    :param func: Function to call, which must be picklable
+    :type func: Callable
+    :param args: Arguments of each call
+    :type args: List[Tuple]
+    :param processes: Number of processes to use, None for one per core
+    :type processes: Optional[int]
+    :returns: Results in the order of args
+    :rtype: List
+    """
+    if not args:
+        return []
+    processes = min(processes or os.cpu_count() or 1, len(args))
+    if processes == 1:
+        return [func(*call_args) for call_args in args]
+    logger.debug('Running %d %s calls in %d processes',
+                 len(args), func.__name__, processes)
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(
+            func, *zip(*args),
+            chunksize=max(1, len(args) // (processes * 4))))
+
+
+def generate_csrs(requests, key_type=DEFAULT_KEY_TYPE, processes=None):
+    """Generate private keys and CSRs, in parallel when there are several.
+
+    :param requests: (common name, list of SANs) pairs
+    :type requests: List[Tuple[str, List[str]]]
+    :param key_type: Type of the keys, see generate_key
+    :type key_type: str
+    :param processes: Number of processes to use, None for one per core
+    :type processes: Optional[int]
+    :returns: What generate_csr returns for each request
+    :rtype: List[Dict[str, str]]
+    :raises: ValueError
+    """
+    return _map(
+        generate_csr,
+        [(cn, list(sans), key_type) for cn, sans in requests],
+        processes)
+
+
+def generate_keys(count, key_type=DEFAULT_KEY_TYPE, processes=None):
+    """Generate private keys, in parallel when there are several.
+
+    :param count: Number of keys
+    :type count: int
+    :param key_type: Type of the keys, see generate_key
+    :type key_type: str
+    :param processes: Number of processes to use, None for one per core
+    :type processes: Optional[int]
+    :returns: PEM text of the keys
+    :rtype: List[str]
+    :raises: ValueError
+    """
+    return _map(generate_key, [(key_type,)] * max(count, 0), processes)
+
+
+class KeyPool(Object):
+    """Private keys generated ahead of time.
+
+    Keys are taken from the pool first and generated on demand when it runs
+    out. The pool is refilled up to its size in every update-status hook, or
+    by calling refill(). With a size of 0 it only generates keys on demand,
+    in parallel.
+    """
+
+    _stored = StoredState()
+
+    # Keys generated ahead of time
+    SIZE = 50
+
+    def __init__(self, charm, key, size=SIZE, key_type=DEFAULT_KEY_TYPE,
+                 processes=None, store=None):
+        """
+        :param charm: the charm object to be used as a parent object.
+        :type charm: :class: `ops.charm.CharmBase`
+        :param key: key of the pool among the objects of the charm.
+        :type key: str
+        :param size: how many keys to keep ready.
+        :type size: int
+        :param key_type: type of the keys, see generate_key.
+        :type key_type: str
+        :param processes: number of processes generating keys, None for one
+            per core.
+        :type processes: Optional[int]
+        :param store: where to keep the keys, None to keep them in the
+            stored state. The pool removes any other text from the store, so
+            it needs one of its own.
+        :type store: Optional[store.MaterialStore]
+        """
+        super().__init__(charm, key)
+        self.size = size
+        self.key_type = key_type
+        self.processes = processes
+        self._store = store
+        # PEM text of the keys, or their digests with a store, oldest first
+        self._stored.set_default(keys=[], key_type=key_type)
+        if self._stored.key_type != key_type:
+            self._stored.keys = []
+            self._stored.key_type = key_type
+        self.framework.observe(charm.on.update_status, self._on_update_status)
+
+    @property
+    def available(self):
+        """Number of keys ready to be taken."""
+        return len(self._stored.keys)
+
+    def _on_update_status(self, event):
+        self.refill()
+
+    def refill(self, limit=None):
+        """Generate keys until the pool is full.
+
+        :param limit: how many keys to generate at most, None for no limit
+        :type limit: Optional[int]
+        :returns: Number of keys generated
+        :rtype: int
+        """
+        count = self.size - len(self._stored.keys)
+        if limit is not None:
+            count = min(count, limit)
+        if count <= 0:
+            return 0
+        keys = generate_keys(count, self.key_type, self.processes)
+        if self._store is not None:
+            keys = self._store.save(keys)
+        self._stored.keys = list(self._stored.keys) + keys
+        logger.info('Added %d keys to the key pool', count)
+        return count
+
+    def take(self, count, key_type=None):
+        """Return keys, from the pool first.
+
+        Keys of another type than the pool's are generated on demand.
+
+        :param count: Number of keys
+        :type count: int
+        :param key_type: Type of the keys, None for the type of the pool
+        :type key_type: Optional[str]
+        :returns: PEM text of the keys
+        :rtype: List[str]
+        :raises: ValueError
+        """
+        if key_type is not None and key_type != self.key_type:
+            return generate_keys(count, key_type, self.processes)
+        stored = list(self._stored.keys)
+        taken, remaining = stored[:count], stored[count:]
+        if taken:
+            self._stored.keys = remaining
+        if self._store is not None:
+            loaded = []
+            for text_digest in taken:
+                try:
+                    loaded.append(self._store.load(text_digest))
+                except KeyError:
+                    logger.warning('Key %s missing from the key pool store',
+                                   text_digest)
+            taken = loaded
+            self._store.retain(set(remaining))
+        if len(taken) < count:
+            logger.info('Key pool short of %d keys', count - len(taken))
+            taken.extend(generate_keys(
+                count - len(taken), self.key_type, self.processes))
+        return taken
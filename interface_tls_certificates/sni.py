@@ -0,0 +1,113 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Selection of a certificate by hostname, as done for TLS SNI.
+
+DNS names are held in a trie of their labels in reverse order, so that a
+lookup visits one node per label of the hostname whatever the number of
+certificates. A wildcard only stands for the whole leftmost label. IP
+addresses are matched exactly. Indexes are made of plain dicts, lists and
+strings so they can be kept in StoredState.
+"""
+
+import ipaddress
+
+# Key of the value of a trie node, labels are never empty.
+_VALUE = ''
+_WILDCARD = '*'
+
+
+def _ip_address(name):
+    """Return the normalised form of name if it is an IP address.
+
+    :param name: Hostname or IP address
+    :type name: str
+    :returns: IP address or None
+    :rtype: Optional[str]
+    """
+    try:
+        return str(ipaddress.ip_address(name.strip('[]')))
+    except ValueError:
+        return None
+
+
+def _labels(name):
+    """Return the labels of a DNS name from the top level domain down.
+
+    :param name: DNS name
+    :type name: str
+    :returns: Labels
+    :rtype: List[str]
+    """
+    return name.lower().rstrip('.').split('.')[::-1]
+
+
+def build_index(entries):
+    """Build an index of certificates by name.
+
+    When several certificates have the same name the first one wins, so
+    entries should be given in order of preference.
+
+    :param entries: (names, value) pairs. Each name is a DNS name, whose
+                    leftmost label may be a wildcard, or an IP address.
+    :type entries: Iterable[Tuple[List[str], Any]]
+    :returns: Index
+    :rtype: Dict[str, Dict]
+    """
+    trie = {}
+    addresses = {}
+    for names, value in entries:
+        for name in names:
+            address = _ip_address(name)
+            if address is not None:
+                addresses.setdefault(address, value)
+                continue
+            labels = _labels(name)
+            if '' in labels:
+                continue
+            node = trie
+            for label in labels:
+                node = node.setdefault(label, {})
+            node.setdefault(_VALUE, value)
+    return {'dns': trie, 'ip': addresses}
+
+
+def lookup(index, hostname):
+    """Return the value of the certificate matching hostname.
+
+    An exact match is preferred over a wildcard match.
+
+    :param index: Index returned by build_index
+    :type index: Mapping[str, Mapping]
+    :param hostname: Hostname or IP address
+    :type hostname: str
+    :returns: Value given to build_index or None if nothing matches
+    :rtype: Any
+    """
+    address = _ip_address(hostname)
+    if address is not None:
+        return index['ip'].get(address)
+    labels = _labels(hostname)
+    if '' in labels:
+        return None
+    node = index['dns']
+    wildcard = None
+    for position, label in enumerate(labels):
+        if position and position == len(labels) - 1:
+            wildcard = (node.get(_WILDCARD) or {}).get(_VALUE)
+        node = node.get(label)
+        if node is None:
+            return wildcard
+    exact = node.get(_VALUE)
+    return wildcard if exact is None else exact
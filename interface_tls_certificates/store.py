@@ -0,0 +1,137 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stores of issued certificates and keys kept outside StoredState.
+
+The ops framework writes the whole stored state of a charm at the end of
+every hook, so keeping the PEM text of many certificates and keys in it
+makes each hook slower. A store keeps that text elsewhere under its digest,
+and only the digests are kept in StoredState.
+"""
+
+import abc
+import logging
+import os
+
+from .files import write_files
+from .hashing import digest
+
+logger = logging.getLogger(__name__)
+
+
+class MaterialStore(abc.ABC):
+    """Interface of a store of PEM texts keyed on their digest."""
+
+    @abc.abstractmethod
+    def save(self, texts):
+        """Store texts.
+
+        :param texts: PEM texts
+        :type texts: Iterable[str]
+        :returns: Digests of texts, in the same order
+        :rtype: List[str]
+        """
+
+    @abc.abstractmethod
+    def load(self, text_digest):
+        """Return a stored text.
+
+        :param text_digest: Digest returned by save
+        :type text_digest: str
+        :returns: PEM text
+        :rtype: str
+        :raises: KeyError
+        """
+
+    @abc.abstractmethod
+    def retain(self, digests):
+        """Remove the texts whose digest is not in digests.
+
+        :param digests: Digests of the texts to keep
+        :type digests: Set[str]
+        """
+
+
+class DirectoryStore(MaterialStore):
+    """Store keeping each text in a file named after its digest.
+
+    The directory is only accessible to the owner of the charm process and
+    files are written atomically, only if they do not already exist.
+    """
+
+    def __init__(self, directory, fsync=True):
+        """
+        :param directory: Path of the directory, created if needed
+        :type directory: str
+        :param fsync: Whether to flush files to disk when saving them
+        :type fsync: bool
+        """
+        self.directory = directory
+        self.fsync = fsync
+
+    def _path(self, text_digest):
+        return os.path.join(self.directory, text_digest)
+
+    def save(self, texts):
+        """Store texts.
+
+        :param texts: PEM texts
+        :type texts: Iterable[str]
+        :returns: Digests of texts, in the same order
+        :rtype: List[str]
+        """
+        digests = []
+        files = {}
+        for text in texts:
+            text_digest = digest(text)
+            digests.append(text_digest)
+            path = self._path(text_digest)
+            if path not in files and not os.path.exists(path):
+                files[path] = (text.encode('utf-8'), 0o600)
+        if files:
+            write_files(files, dir_mode=0o700, fsync=self.fsync)
+        return digests
+
+    def load(self, text_digest):
+        """Return a stored text.
+
+        :param text_digest: Digest returned by save
+        :type text_digest: str
+        :returns: PEM text
+        :rtype: str
+        :raises: KeyError
+        """
+        try:
+            with open(self._path(text_digest), 'rb') as f:
+                text = f.read().decode('utf-8')
+        except FileNotFoundError:
+            raise KeyError(text_digest)
+        if digest(text) != text_digest:
+            raise KeyError(text_digest)
+        return text
+
+    def retain(self, digests):
+        """Remove the texts whose digest is not in digests.
+
+        :param digests: Digests of the texts to keep
+        :type digests: Set[str]
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name not in digests and not name.startswith('.'):
+                logger.debug('Removing %s from %s', name, self.directory)
+                os.unlink(self._path(name))
@@ -12,8 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.x509.oid import NameOID
 
 from ops.charm import CharmBase
 from ops import testing
@@ -21,6 +34,9 @@ from ops import model
 from ops import framework
 
 import interface_tls_certificates.ca_client as ca_client
+import interface_tls_certificates.compression as compression
+import interface_tls_certificates.keys as keys
+import interface_tls_certificates.store as store
 
 from test.ca_client_test_data import (
     TEST_RELATION_DATA,
@@ -28,6 +44,40 @@ from test.ca_client_test_data import (
     get_multi_rq_relation_data_client)
 
 
+class _CSRSigner:
+    """A CA signing CSRs, with a fast P-256 key."""
+
+    def __init__(self):
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.name = x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, 'test CA')])
+        self.ca = self.certificate(self.name, self.key.public_key(), 1)
+
+    def certificate(self, subject, public_key, day, extensions=()):
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(self.name)
+            .public_key(public_key)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(datetime.datetime(2020, 1, day))
+            .not_valid_after(datetime.datetime(2030, 1, 1)))
+        for extension in extensions:
+            builder = builder.add_extension(
+                extension.value, extension.critical)
+        return builder.sign(self.key, hashes.SHA256(), default_backend())
+
+    def pem(self, cert):
+        return cert.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+    def sign(self, txt_csr, day, public_key=None):
+        csr = x509.load_pem_x509_csr(txt_csr.encode('utf-8'),
+                                     default_backend())
+        return self.pem(self.certificate(
+            csr.subject, public_key or csr.public_key(), day,
+            csr.extensions))
+
+
 class TestCAClient(unittest.TestCase):
 
     def setUp(self):
@@ -127,6 +177,40 @@ class TestCAClient(unittest.TestCase):
         self.assertEqual(server_data['unit_name'],
                          self.harness.charm.model.unit.name)
 
+    def test_request_server_certificates(self):
+        relation_id = self.harness.add_relation('ca-client', 'easyrsa')
+        self.harness.add_relation_unit(relation_id, 'easyrsa/0')
+        self.ca_client.request_server_certificate('server0', ['server0'])
+        rel = self.harness.charm.model.get_relation('ca-client')
+        server_data = rel.data[self.harness.charm.model.unit]
+
+        requests = [('server{}'.format(i), ['alt{}'.format(i)])
+                    for i in range(1, 100)]
+        backend = self.harness._backend
+        with mock.patch.object(
+                backend, 'update_relation_data',
+                wraps=backend.update_relation_data) as relation_set:
+            self.ca_client.request_server_certificates(requests)
+            # cert_requests, common_name and sans, unit_name is unchanged.
+            self.assertEqual(relation_set.call_count, 3)
+            relation_set.reset_mock()
+            self.ca_client.request_server_certificates(requests)
+            relation_set.assert_not_called()
+
+        cert_requests = json.loads(server_data['cert_requests'])
+        self.assertEqual(len(cert_requests), 100)
+        self.assertEqual(cert_requests['server0'], {'sans': ['server0']})
+        self.assertEqual(cert_requests['server42'], {'sans': ['alt42']})
+        self.assertEqual(server_data['common_name'], 'server99')
+        self.assertEqual(server_data['sans'], json.dumps(['alt99']))
+
+        self.ca_client.request_client_certificates(
+            {'client1': ['c1'], 'client2': ['c2']}.items())
+        self.assertEqual(
+            json.loads(server_data['client_cert_requests']),
+            {'client1': {'sans': ['c1']}, 'client2': {'sans': ['c2']}})
+        self.assertEqual(server_data['common_name'], 'server99')
+
     def prepare_on_relation_changed_test(self, client_data, server_data):
 
         class TestReceiver(framework.Object):
@@ -138,6 +222,14 @@ class TestCAClient(unittest.TestCase):
                     'server': [],
                     'application': [],
                     'client': []}
+                self.issued_events = []
+                self.expiring_events = []
+
+            def on_tls_certificates_issued(self, event):
+                self.issued_events.append(event)
+
+            def on_certificate_expiring(self, event):
+                self.expiring_events.append(event)
 
             def on_tls_config_ready(self, event):
                 self.observed_events['legacy'].append(event)
@@ -159,11 +251,17 @@ class TestCAClient(unittest.TestCase):
             self.ca_client.on.tls_app_config_ready,
             self.receiver.on_tls_app_config_ready)
         self.harness.framework.observe(
-            self.ca_client.on.tls_client_config_ready,
+            self.ca_client.on.tls_server_config_ready,
             self.receiver.on_tls_server_config_ready)
         self.harness.framework.observe(
-            self.ca_client.on.tls_server_config_ready,
+            self.ca_client.on.tls_client_config_ready,
             self.receiver.on_tls_client_config_ready)
+        self.harness.framework.observe(
+            self.ca_client.on.tls_certificates_issued,
+            self.receiver.on_tls_certificates_issued)
+        self.harness.framework.observe(
+            self.ca_client.on.certificate_expiring,
+            self.receiver.on_certificate_expiring)
 
         self.relation_id = self.harness.add_relation('ca-client', 'easyrsa')
         self.harness.update_relation_data(
@@ -292,6 +390,824 @@ class TestCAClient(unittest.TestCase):
             certs['client2']['cert'].serial_number,
             554251068938213429919465619370496662368340363424)
 
+    def test_parsed_objects_cached(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        with mock.patch.object(ca_client, '_load_pem_private_key',
+                               wraps=ca_client._load_pem_private_key) as load:
+            self.ca_client.server_key
+            self.ca_client.server_key
+            self.ca_client.server_certs['server1']['key']
+            self.ca_client.server_certs['server2']['key']
+            # server1 and server2 keys are each parsed once.
+            self.assertEqual(load.call_count, 2)
+            # Storing new data drops the parsed objects.
+            state = self.ca_client._state(self.relation_id)
+            server1 = dict(state['server']['server1'])
+            self.ca_client._store_certificates(
+                'server', {'server1': server1}, self.relation_id)
+            self.ca_client.server_key
+            self.assertEqual(load.call_count, 3)
+
+    def test_server_certs_lazy(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        with mock.patch.object(ca_client, '_load_pem_private_key',
+                               wraps=ca_client._load_pem_private_key) as load:
+            certs = self.ca_client.server_certs
+            self.assertEqual(sorted(certs), ['default', 'server1', 'server2'])
+            self.assertEqual(len(certs), 3)
+            self.assertIn('server2', certs)
+            load.assert_not_called()
+            self.assertEqual(
+                certs['server2']['cert'].serial_number,
+                500144078276114303654132221008280693054965976604)
+            load.assert_not_called()
+            certs['default']['key']
+            self.assertEqual(load.call_count, 1)
+        self.assertEqual(
+            certs['default']['cert'].serial_number,
+            certs['server1']['cert'].serial_number)
+        with self.assertRaises(TypeError):
+            certs['server3'] = certs['server1']
+
+    def test_relation_snapshot(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        with mock.patch.object(ca_client.json, 'loads',
+                               wraps=json.loads) as loads:
+            self.assertTrue(self.ca_client.is_server_cert_ready)
+            self.assertTrue(self.ca_client.is_client_cert_ready)
+            self.ca_client.server_certs['server1']['cert']
+            self.ca_client.client_certificate
+            loads.assert_not_called()
+
+        # A new request discards the snapshot.
+        self.ca_client.request_server_certificate('server3', ['server3'])
+        self.assertEqual(
+            self.ca_client._get_all_requests()['server']['server3'],
+            {'sans': ['server3']})
+        self.assertEqual(self.ca_client._legacy_request_cn, 'server3')
+
+        # So does the end of the dispatch.
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/0', {'common_name': 'server4'})
+        self.assertEqual(self.ca_client._legacy_request_cn, 'server3')
+        self.harness.framework.commit()
+        self.assertEqual(self.ca_client._legacy_request_cn, 'server4')
+
+    def test__on_relation_changed_unchanged_data(self):
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        self.assertEqual(len(self.receiver.observed_events['server']), 1)
+        self.assertEqual(len(self.receiver.observed_events['client']), 1)
+
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/0', {'ingress-address': '192.0.2.3'})
+        self.assertEqual(len(self.receiver.observed_events['server']), 1)
+        self.assertEqual(len(self.receiver.observed_events['client']), 1)
+        self.assertEqual(
+            len(self.receiver.observed_events['application']), 1)
+
+        # Only the server certificates are processed again when they change.
+        processed = json.loads(server_data['myserver_0.processed_requests'])
+        processed['server1'] = json.loads(
+            server_data['myserver_1.processed_requests'])['server1']
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/0',
+            {'myserver_0.processed_requests': json.dumps(processed)})
+        self.assertEqual(len(self.receiver.observed_events['server']), 2)
+        self.assertEqual(len(self.receiver.observed_events['client']), 1)
+        first, second = self.receiver.observed_events['server']
+        self.assertEqual(first.added, ['server1', 'server2'])
+        self.assertEqual(first.changed, [])
+        self.assertEqual(second.added, [])
+        self.assertEqual(second.changed, ['server1'])
+        self.assertEqual(second.removed, [])
+        self.assertEqual(
+            len(self.receiver.observed_events['application']), 1)
+        self.assertEqual(
+            self.ca_client.server_certs['server1']['cert'].serial_number,
+            self.ca_client._load_cert(processed['server1']['cert'])
+            .serial_number)
+
+    def test__on_relation_changed_partially_issued(self):
+        client_data = get_multi_rq_relation_data_client()
+        cert_requests = json.loads(client_data['cert_requests'])
+        cert_requests['server3'] = {'sans': ['serveralt3']}
+        client_data['cert_requests'] = json.dumps(cert_requests)
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(client_data, server_data)
+        issued_events = self.receiver.issued_events
+
+        self.assertEqual(self.receiver.observed_events['server'], [])
+        self.assertEqual(len(self.receiver.observed_events['client']), 1)
+        self.assertFalse(self.ca_client.is_server_cert_ready)
+        self.assertEqual(self.ca_client.pending_requests('server'),
+                         ['server3'])
+        self.assertEqual(
+            {(e.request_type, tuple(e.common_names)) for e in issued_events},
+            {('legacy', ('server2',)),
+             ('server', ('server1', 'server2')),
+             ('client', ('client1', 'client2')),
+             ('application', ('app_data',))})
+        self.assertEqual(
+            self.ca_client.server_certs['server2']['cert'].serial_number,
+            500144078276114303654132221008280693054965976604)
+
+        del issued_events[:]
+        processed = json.loads(server_data['myserver_0.processed_requests'])
+        processed['server3'] = processed['server1']
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/0',
+            {'myserver_0.processed_requests': json.dumps(processed)})
+        self.assertEqual(len(issued_events), 1)
+        self.assertEqual(issued_events[0].request_type, 'server')
+        self.assertEqual(issued_events[0].common_names, ['server3'])
+        self.assertEqual(len(self.receiver.observed_events['server']), 1)
+        self.assertTrue(self.ca_client.is_server_cert_ready)
+        self.assertEqual(self.ca_client.pending_requests('server'), [])
+
+    def test_write_certificates(self):
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            written = self.ca_client.write_certificates(tmp_dir, 'server')
+            self.assertEqual(
+                [os.path.relpath(path, tmp_dir) for path in written],
+                ['ca.crt', 'chain.crt', 'server/server1.crt',
+                 'server/server1.key', 'server/server2.crt',
+                 'server/server2.key'])
+            with open(os.path.join(tmp_dir, 'server', 'server2.key')) as f:
+                self.assertEqual(f.read(),
+                                 server_data['myserver_0.server.key'])
+            self.assertEqual(
+                os.stat(os.path.join(tmp_dir, 'server', 'server2.key'))
+                .st_mode & 0o777,
+                0o600)
+            self.assertEqual(
+                self.ca_client.write_certificates(tmp_dir, 'server'), [])
+            written = self.ca_client.write_certificates(tmp_dir)
+            self.assertIn(os.path.join(tmp_dir, 'application', 'app_data.crt'),
+                          written)
+            self.assertIn(os.path.join(tmp_dir, 'client', 'client2.key'),
+                          written)
+
+    def test_certificate_and_key_bytes(self):
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        with mock.patch.object(ca_client, '_load_pem_private_key') as load:
+            self.assertEqual(
+                self.ca_client.key_bytes('server', 'server2'),
+                server_data['myserver_0.server.key'].encode('utf-8'))
+            key_der = self.ca_client.key_bytes(
+                'server', encoding=self.ca_client.ENCODING_DER)
+            load.assert_not_called()
+        self.assertEqual(
+            key_der,
+            self.ca_client.server_key.private_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                encryption_algorithm=serialization.NoEncryption()))
+        self.assertEqual(
+            self.ca_client.certificate_bytes(
+                'client', 'client2', encoding='der'),
+            self.ca_client.client_certs['client2']['cert'].public_bytes(
+                serialization.Encoding.DER))
+        self.assertEqual(
+            self.ca_client.ca_certificate_bytes(encoding='der'),
+            self.ca_client.ca_certificate.public_bytes(
+                serialization.Encoding.DER))
+        self.assertEqual(
+            self.ca_client.root_ca_chain_bytes(),
+            server_data['chain'].encode('utf-8'))
+        with self.assertRaises(ValueError):
+            self.ca_client.certificate_bytes('server', encoding='txt')
+
+    def test_import_does_not_load_cryptography(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, interface_tls_certificates.ca_client; '
+             'print("cryptography" in sys.modules)'],
+            universal_newlines=True)
+        self.assertEqual(output.strip(), 'False')
+
+    def test_instrumentation(self):
+        self.assertFalse(self.ca_client.instrumentation.enabled)
+        self.ca_client.instrumentation.enabled = True
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        stats = self.ca_client.instrumentation.as_dict()
+        self.assertEqual(stats['json']['server']['count'], 2)
+        self.assertEqual(stats['json']['application']['count'], 2)
+        self.assertIn('all', stats['relation_read'])
+
+        self.ca_client.instrumentation.reset()
+        self.ca_client.server_key
+        self.ca_client.server_key
+        self.ca_client.client_key
+        self.ca_client.ca_certificate
+        stats = self.ca_client.instrumentation.as_dict()
+        self.assertEqual(stats['parse']['server']['count'], 1)
+        self.assertEqual(stats['parse']['client']['count'], 1)
+        self.assertEqual(stats['parse']['ca']['count'], 1)
+        self.assertGreater(stats['parse']['server']['seconds'], 0)
+        self.assertNotIn('json', stats)
+
+        with self.assertLogs(ca_client.logger, 'INFO') as logs:
+            self.harness.framework.commit()
+        self.assertIn('CAClient ca-client costs: {"parse"', logs.output[-1])
+        self.assertEqual(self.ca_client.instrumentation.as_dict(), {})
+
+    def test_certificate_expiring(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        expiries = []
+        for request_type in ('legacy', 'server', 'client', 'application'):
+            state = self.ca_client._state(self.relation_id)
+            for cn, data in state[request_type].items():
+                cert = self.ca_client._load_cert(data['cert'])
+                expiries.append((
+                    calendar.timegm(cert.not_valid_after.utctimetuple()),
+                    request_type,
+                    cn,
+                    self.relation_id))
+        self.assertEqual(len(expiries), 6)
+        self.assertEqual(self.ca_client.next_expiry, min(expiries))
+
+        with mock.patch.object(ca_client, '_load_pem_x509_certificate') as \
+                load, mock.patch.object(ca_client, '_now') as now:
+            # A month and a day before the first certificate expires.
+            now.return_value = min(expiries)[0] - 31 * 24 * 60 * 60
+            self.harness.framework.commit()
+            self.assertEqual(self.receiver.expiring_events, [])
+
+            now.return_value = max(expiries)[0] - 24 * 60 * 60
+            self.harness.framework.commit()
+            self.assertEqual(
+                sorted((e.expiry, e.request_type, e.common_name,
+                        e.relation_id)
+                       for e in self.receiver.expiring_events),
+                sorted(expiries))
+
+            self.harness.framework.commit()
+            self.assertEqual(len(self.receiver.expiring_events), 6)
+            load.assert_not_called()
+
+    def test_renew_certificates(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        rel = self.harness.charm.model.get_relation('ca-client')
+        unit_data = rel.data[self.harness.charm.model.unit]
+        self.assertEqual(self.ca_client.renew_certificates(), [])
+
+        day = 24 * 60 * 60
+        self.ca_client.renew_before = 10 * day
+        self.ca_client.renewals_per_hook = 2
+        offset = self.ca_client.renewal_offset
+        self.assertTrue(0 <= offset < self.ca_client.RENEWAL_JITTER)
+        self.assertEqual(offset, self.ca_client.renewal_offset)
+        first_expiry = self.ca_client.next_expiry[0]
+
+        with mock.patch.object(ca_client, '_now') as now:
+            now.return_value = first_expiry - 10 * day - offset - 1
+            self.assertEqual(self.ca_client.renew_certificates(), [])
+
+            now.return_value = first_expiry + 365 * day
+            self.harness.framework.commit()
+            renewed = json.loads(unit_data['cert_requests'])
+            self.assertEqual(
+                renewed['server1'],
+                {'sans': ['serveralt1', '172.0.0.3'],
+                 'renewal': self.ca_client.next_expiry[0]})
+            self.assertIn('renewal', renewed['server2'])
+            self.assertNotIn('renewal', unit_data['client_cert_requests'])
+
+            # Renewals already requested are not counted again.
+            self.assertEqual(
+                self.ca_client.renew_certificates(),
+                [('client', 'client1', self.relation_id),
+                 ('client', 'client2', self.relation_id)])
+            self.assertEqual(
+                self.ca_client.renew_certificates(),
+                [('application', 'app_data', self.relation_id)])
+            self.assertIn('renewal',
+                          unit_data['application_cert_requests'])
+            self.assertEqual(self.ca_client.renew_certificates(), [])
+
+        # Requesting the same certificate again keeps the renewal marker.
+        self.ca_client.request_server_certificate(
+            'server1', ['serveralt1', '172.0.0.3'])
+        self.assertIn(
+            'renewal', json.loads(unit_data['cert_requests'])['server1'])
+
+    def test__on_relation_changed_multiple_ca_units(self):
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        unit0_server1 = json.loads(
+            server_data['myserver_0.processed_requests'])['server1']
+        # A second CA unit answering with a more recent certificate.
+        unit1_server1 = json.loads(
+            server_data['myserver_1.processed_requests'])['server1']
+
+        def server1_cert():
+            return self.ca_client.certificate_bytes(
+                'server', 'server1').decode('utf-8')
+
+        self.assertEqual(server1_cert(), unit0_server1['cert'])
+        self.harness.add_relation_unit(self.relation_id, 'easyrsa/1')
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/1', {
+                'ca': server_data['ca'],
+                'chain': server_data['chain'],
+                'myserver_0.processed_requests': json.dumps(
+                    {'server1': unit1_server1})})
+        self.assertEqual(server1_cert(), unit1_server1['cert'])
+        self.assertEqual(
+            self.ca_client.server_certs['server2']['cert'].serial_number,
+            500144078276114303654132221008280693054965976604)
+        state = self.ca_client._state(self.relation_id)
+        self.assertEqual(state['owners']['server']['server2'], 'easyrsa/0')
+
+        # The older certificate of the first unit does not win back.
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/0', {'ingress-address': '192.0.2.3'})
+        processed = json.loads(server_data['myserver_0.processed_requests'])
+        processed['server1'] = dict(unit0_server1)
+        processed['extra'] = dict(unit0_server1)
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/0',
+            {'myserver_0.processed_requests': json.dumps(processed)})
+        self.assertEqual(server1_cert(), unit1_server1['cert'])
+
+        self.harness.remove_relation_unit(self.relation_id, 'easyrsa/1')
+        self.assertEqual(server1_cert(), unit0_server1['cert'])
+        self.assertNotIn('easyrsa/1', state['unit_index'])
+        self.assertEqual(len(self.receiver.observed_events['server']), 4)
+        self.assertEqual(
+            self.receiver.observed_events['server'][-1].changed,
+            ['server1'])
+
+    def _prepare_stale_unit_index(self):
+        """Have easyrsa/1 own server1 and easyrsa/0 silently drop it.
+
+        :returns: Processed server requests of easyrsa/0
+        :rtype: Dict[str, Dict[str, str]]
+        """
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        unit1_server1 = json.loads(
+            server_data['myserver_1.processed_requests'])['server1']
+        self.harness.add_relation_unit(self.relation_id, 'easyrsa/1')
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/1', {
+                'ca': server_data['ca'],
+                'chain': server_data['chain'],
+                'myserver_0.processed_requests': json.dumps(
+                    {'server1': unit1_server1})})
+        state = self.ca_client._state(self.relation_id)
+        self.assertEqual(state['owners']['server']['server1'], 'easyrsa/1')
+        # The relation-changed of easyrsa/0 has not run yet.
+        processed = json.loads(server_data['myserver_0.processed_requests'])
+        del processed['server1']
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(
+                self.relation_id, 'easyrsa/0',
+                {'myserver_0.processed_requests': json.dumps(processed)})
+        self.assertIn(
+            'server1', state['unit_index']['easyrsa/0']['server'])
+        return state
+
+    def test_stale_unit_index_departed(self):
+        state = self._prepare_stale_unit_index()
+        self.harness.remove_relation_unit(self.relation_id, 'easyrsa/1')
+        self.assertNotIn('server1', self.ca_client.server_certs)
+        self.assertIn('server2', self.ca_client.server_certs)
+        self.assertNotIn('server1', state['owners']['server'])
+        self.assertNotIn(
+            'server1', state['unit_index']['easyrsa/0']['server'])
+
+    def test_stale_unit_index_changed(self):
+        state = self._prepare_stale_unit_index()
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/1',
+            {'myserver_0.processed_requests': json.dumps({})})
+        self.assertNotIn('server1', self.ca_client.server_certs)
+        self.assertIn('server2', self.ca_client.server_certs)
+        self.assertNotIn('server1', state['owners']['server'])
+        self.assertNotIn(
+            'server1', state['unit_index']['easyrsa/0']['server'])
+
+    def test_multiple_relations(self):
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        unit1_server1 = json.loads(
+            server_data['myserver_1.processed_requests'])['server1']
+        vault_id = self.harness.add_relation('ca-client', 'vault')
+        self.harness.add_relation_unit(vault_id, 'vault/0')
+        self.assertEqual(self.ca_client.relation_ids,
+                         sorted([self.relation_id, vault_id]))
+        self.ca_client.request_server_certificate(
+            'server1', ['serveralt1', '172.0.0.3'], relation_id=vault_id)
+        rel = self.harness.charm.model.get_relation('ca-client', vault_id)
+        self.assertEqual(
+            json.loads(rel.data[self.harness.charm.model.unit][
+                'cert_requests']),
+            {'server1': {'sans': ['serveralt1', '172.0.0.3']}})
+        self.harness.update_relation_data(vault_id, 'vault/0', {
+            'ca': server_data['ca'],
+            'chain': server_data['chain'],
+            'myserver_0.processed_requests': json.dumps(
+                {'server1': unit1_server1})})
+
+        event = self.receiver.observed_events['server'][-1]
+        self.assertEqual(event.relation_id, vault_id)
+        self.assertEqual(event.added, ['server1'])
+        self.assertEqual(
+            self.receiver.observed_events['server'][0].relation_id,
+            self.relation_id)
+        # Each relation keeps its own material.
+        self.assertEqual(
+            self.ca_client.certificate_bytes(
+                'server', 'server1', relation_id=vault_id).decode('utf-8'),
+            unit1_server1['cert'])
+        self.assertEqual(
+            sorted(self.ca_client.certs('server', self.relation_id)),
+            ['default', 'server1', 'server2'])
+        self.assertEqual(
+            sorted(self.ca_client.certs('server', vault_id)),
+            ['default', 'server1'])
+        self.assertTrue(self.ca_client.is_cert_ready('server', vault_id))
+        self.assertFalse(self.ca_client.is_cert_ready('client', vault_id))
+        with self.assertRaises(model.TooManyRelatedAppsError):
+            self.ca_client.server_certs
+
+        self.harness.remove_relation(vault_id)
+        self.assertEqual(self.ca_client.relation_ids, [self.relation_id])
+        self.assertNotIn(str(vault_id), self.ca_client._stored.relations)
+        self.assertEqual(
+            {entry[3] for entry in self.ca_client._stored.expiry},
+            {self.relation_id})
+        self.assertEqual(
+            sorted(self.ca_client.server_certs),
+            ['default', 'server1', 'server2'])
+
+    def test_certificate_for_hostname(self):
+        self.assertIsNone(self.ca_client.certificate_for_hostname('server1'))
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        with mock.patch.object(ca_client, '_load_pem_x509_certificate',
+                               wraps=ca_client._load_pem_x509_certificate) \
+                as load:
+            request_type, cn, entry = self.ca_client.certificate_for_hostname(
+                'ServerAlt1')
+            self.assertEqual((request_type, cn), ('server', 'server1'))
+            self.assertEqual(
+                self.ca_client.certificate_for_hostname('172.0.0.4')[:2],
+                ('server', 'server2'))
+            self.assertEqual(
+                self.ca_client.certificate_for_hostname('appunit2')[:2],
+                ('application', 'app_data'))
+            self.assertIsNone(
+                self.ca_client.certificate_for_hostname('client1'))
+            load.assert_not_called()
+        self.assertEqual(entry['cert'].serial_number,
+                         self.ca_client.server_certs['server1'][
+                             'cert'].serial_number)
+
+    def test_certificate_metadata(self):
+        with mock.patch.object(ca_client, '_load_pem_x509_certificate',
+                               wraps=ca_client._load_pem_x509_certificate) \
+                as load:
+            self.prepare_on_relation_changed_test(
+                get_multi_rq_relation_data_client(),
+                get_multi_rq_relation_data_server())
+            metadata = self.ca_client.certificate_metadata(
+                'server', 'server1')
+            # Storing and indexing certificates does not parse them fully.
+            load.assert_not_called()
+        self.assertEqual(
+            metadata['serial'],
+            self.ca_client.server_certs['server1']['cert'].serial_number)
+        self.assertEqual(metadata['common_name'], 'server1')
+        self.assertEqual(metadata['dns_names'], ['server1', 'serveralt1'])
+        self.assertEqual(metadata['ip_addresses'], ['172.0.0.3'])
+        self.assertEqual(metadata['key_type'], 'RSA-2048')
+
+    def test_stored_metadata(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        state = self.ca_client._state(self.relation_id)
+        self.assertEqual(
+            set(self.ca_client._stored.metadata),
+            {digest
+             for digests in state['digests'].values()
+             for digest in digests.values()})
+        # A new hook only has what is in StoredState.
+        self.ca_client._parsed.clear()
+        self.ca_client._invalidate_snapshot()
+        with mock.patch.object(ca_client, '_load_pem_x509_certificate') \
+                as load_cert, \
+                mock.patch.object(ca_client, '_load_pem_metadata') \
+                as load_metadata:
+            self.assertTrue(self.ca_client.is_cert_ready('server'))
+            self.assertEqual(self.ca_client.next_expiry[1:3],
+                             ('server', 'server1'))
+            self.assertEqual(
+                self.ca_client.certificate_for_hostname('server2')[:2],
+                ('server', 'server2'))
+            self.assertEqual(
+                self.ca_client.certificate_metadata(
+                    'client', 'client1')['common_name'],
+                'client1')
+            load_cert.assert_not_called()
+            load_metadata.assert_not_called()
+        # Records of certificates no longer stored are dropped.
+        self.harness.remove_relation(self.relation_id)
+        self.assertEqual(dict(self.ca_client._stored.metadata), {})
+
+    def test_store(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.ca_client._store = store.DirectoryStore(tmp_dir.name, fsync=False)
+        server_data = get_multi_rq_relation_data_server()
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            server_data)
+        # Only digests are kept in StoredState.
+        state = self.ca_client._state(self.relation_id)
+        self.assertEqual(
+            state['server']['server2'],
+            {'cert': store.digest(server_data['myserver_0.server.cert']),
+             'key': store.digest(server_data['myserver_0.server.key'])})
+        self.assertEqual(
+            set(os.listdir(tmp_dir.name)),
+            {ref
+             for rq_type in ('legacy', 'server', 'client', 'application')
+             for data in state[rq_type].values()
+             for ref in data.values()})
+        # A new hook loads the material of the CNs looked up from the store.
+        self.ca_client._loaded.clear()
+        with mock.patch.object(self.ca_client._store, 'load',
+                               wraps=self.ca_client._store.load) as load:
+            self.assertEqual(
+                self.ca_client.key_bytes('server', 'server2'),
+                server_data['myserver_0.server.key'].encode('utf-8'))
+            self.assertEqual(load.call_count, 2)
+            self.assertEqual(sorted(self.ca_client.client_certs),
+                             ['client1', 'client2', 'default'])
+            self.assertEqual(load.call_count, 2)
+        self.ca_client._loaded.clear()
+        key_ref = state['client']['client1']['key']
+        key = self.ca_client._store.load(key_ref)
+        os.unlink(os.path.join(tmp_dir.name, key_ref))
+        self.assertTrue(self.ca_client.client_certs['client2']['key'])
+        with self.assertRaises(ca_client.CAClientError) as cm:
+            self.ca_client.client_certs['client1']
+        self.assertIsInstance(cm.exception.status, model.BlockedStatus)
+        self.ca_client._store.save([key])
+        self.harness.remove_relation(self.relation_id)
+        self.assertEqual(os.listdir(tmp_dir.name), [])
+
+    def test_csr(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.ca_client._store = store.DirectoryStore(tmp_dir.name, fsync=False)
+        self.ca_client.csr = True
+        self.ca_client.key_type = 'P-256'
+        self.ca_client.processes = 1
+        relation_id = self.harness.add_relation('ca-client', 'easyrsa')
+        self.harness.add_relation_unit(relation_id, 'easyrsa/0')
+        self.ca_client.request_server_certificates([
+            ('server1', ['server1.example', '10.0.0.1']),
+            ('server2', [])])
+        local_data = self.harness.get_relation_data(
+            relation_id, 'myserver/0')
+        requests = json.loads(local_data['cert_requests'])
+        self.assertEqual(sorted(requests), ['server1', 'server2'])
+        self.assertNotIn('common_name', local_data)
+        self.assertNotIn('key', json.dumps(requests))
+        csr = x509.load_pem_x509_csr(
+            requests['server1']['csr'].encode('utf-8'), default_backend())
+        self.assertEqual(
+            csr.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(
+                    x509.DNSName),
+            ['server1.example'])
+        state = self.ca_client._state(relation_id)
+        self.assertEqual(sorted(state['csr_keys']['server']),
+                         ['server1', 'server2'])
+        # Repeating the requests keeps the CSRs, whatever the type of the
+        # SANs.
+        with mock.patch.object(keys, 'generate_csrs') as generate_csrs:
+            self.ca_client.request_server_certificates([
+                ('server1', ['server1.example', '10.0.0.1'])])
+            self.ca_client.request_server_certificates([
+                ('server1', ('server1.example', '10.0.0.1'))])
+            generate_csrs.assert_not_called()
+
+        # The CA only sends certificates, paired with the local keys.
+        signer = _CSRSigner()
+
+        def respond(day, **public_keys):
+            self.harness.update_relation_data(
+                relation_id, 'easyrsa/0', {
+                    'ca': signer.pem(signer.ca),
+                    'myserver_0.processed_requests': json.dumps({
+                        cn: {'cert': signer.sign(
+                            request['csr'], day, public_keys.get(cn))}
+                        for cn, request in requests.items()})})
+
+        respond(2)
+        server_certs = self.ca_client.server_certs
+        self.assertEqual(sorted(server_certs),
+                         ['default', 'server1', 'server2'])
+        for cn in ('server1', 'server2'):
+            self.assertEqual(
+                keys.public_key_digest(server_certs[cn]['key'].public_key()),
+                keys.public_key_digest(server_certs[cn]['cert'].public_key()))
+        self.assertEqual(dict(state['csr_keys']['server']), {})
+        self.assertEqual(
+            set(os.listdir(tmp_dir.name)),
+            {ref for data in state['server'].values()
+             for ref in data.values()})
+
+        # A renewal for the same CSR uses the stored key.
+        key = self.ca_client.key_bytes('server', 'server1')
+        respond(3)
+        self.assertEqual(
+            self.ca_client.certificate_metadata('server', 'server1')[
+                'not_before'],
+            calendar.timegm((2020, 1, 3, 0, 0, 0)))
+        self.assertEqual(self.ca_client.key_bytes('server', 'server1'), key)
+
+        # A certificate for another key is not paired with a local key.
+        other_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        with self.assertLogs(ca_client.logger, 'WARNING'):
+            respond(4, server2=other_key.public_key())
+        self.assertEqual(sorted(self.ca_client.server_certs),
+                         ['default', 'server1'])
+
+    def test_key_type(self):
+        relation_id = self.harness.add_relation('ca-client', 'easyrsa')
+        self.harness.add_relation_unit(relation_id, 'easyrsa/0')
+        with self.assertRaises(ValueError):
+            self.ca_client.request_server_certificate(
+                'server1', [], key_type='DSA')
+        self.ca_client.request_server_certificates(
+            [('server1', ['server1'])], key_type='P-256')
+        local_data = self.harness.get_relation_data(
+            relation_id, 'myserver/0')
+        self.assertEqual(
+            json.loads(local_data['cert_requests']),
+            {'server1': {'sans': ['server1'], 'key_type': 'P-256'}})
+        # The legacy fields cannot carry a key type.
+        self.assertNotIn('common_name', local_data)
+
+        # With csr keys of the requested types are generated locally.
+        self.ca_client.csr = True
+        self.ca_client.key_type = 'P-384'
+        self.ca_client.request_server_certificates([('server1', ['server1'])])
+        self.ca_client.request_server_certificate(
+            'server2', ['server2'], key_type='Ed25519')
+        local_data = self.harness.get_relation_data(
+            relation_id, 'myserver/0')
+        requests = json.loads(local_data['cert_requests'])
+        self.assertNotIn('key_type', requests['server1'])
+        signer = _CSRSigner()
+        self.harness.update_relation_data(
+            relation_id, 'easyrsa/0', {
+                'ca': signer.pem(signer.ca),
+                'myserver_0.processed_requests': json.dumps({
+                    cn: {'cert': signer.sign(request['csr'], 2)}
+                    for cn, request in requests.items()})})
+        server_certs = self.ca_client.server_certs
+        self.assertIsInstance(server_certs['server1']['key'],
+                              ec.EllipticCurvePrivateKey)
+        self.assertIsInstance(server_certs['server2']['key'],
+                              ed25519.Ed25519PrivateKey)
+        self.assertEqual(
+            self.ca_client.certificate_metadata('server', 'server1')[
+                'key_type'],
+            'P-384')
+        self.assertEqual(
+            self.ca_client.certificate_metadata('server', 'server2')[
+                'key_type'],
+            'Ed25519')
+        self.assertEqual(
+            self.ca_client.key_bytes('server', 'server2', encoding='der'),
+            server_certs['server2']['key'].private_bytes(
+                serialization.Encoding.DER,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()))
+
+        # Changing the key type of a request causes a new key and CSR.
+        self.ca_client.request_server_certificate(
+            'server2', ['server2'], key_type='P-256')
+        new_requests = json.loads(self.harness.get_relation_data(
+            relation_id, 'myserver/0')['cert_requests'])
+        self.assertEqual(new_requests['server1'], requests['server1'])
+        self.assertNotEqual(new_requests['server2']['csr'],
+                            requests['server2']['csr'])
+        self.assertEqual(new_requests['server2']['key_type'], 'P-256')
+
+    def test_compression(self):
+        plain_data = get_multi_rq_relation_data_server()
+        server_data = dict(plain_data)
+        server_data[compression.ENCODINGS_FIELD] = compression.advertisement()
+        for field in ('myserver_0.processed_requests',
+                      'myserver_0.processed_client_requests'):
+            server_data[field] = compression.encode(
+                json.loads(plain_data[field]), compress=True)
+            self.assertTrue(compression.is_compressed(server_data[field]))
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(), server_data)
+        self.assertEqual(
+            self.ca_client.certificate_bytes('client', 'client1'),
+            json.loads(plain_data['myserver_0.processed_client_requests'])[
+                'client1']['cert'].encode('utf-8'))
+        local_data = self.harness.get_relation_data(
+            self.relation_id, 'myserver/0')
+        self.assertEqual(local_data[compression.ENCODINGS_FIELD],
+                         compression.advertisement())
+
+        # Large requests are compressed as the only CA unit reads them.
+        # They include server1 and server2.
+        requests = [
+            ('server{}'.format(i), ['server{}.example.com'.format(i)])
+            for i in range(100)]
+        self.ca_client.request_server_certificates(requests)
+        local_data = self.harness.get_relation_data(
+            self.relation_id, 'myserver/0')
+        self.assertTrue(
+            compression.is_compressed(local_data['cert_requests']))
+        self.assertEqual(
+            sorted(compression.decode(local_data['cert_requests'])),
+            sorted(cn for cn, _ in requests))
+
+        # Renewals keep them compressed.
+        self.ca_client.renew_before = 10 * 24 * 60 * 60
+        with mock.patch.object(ca_client, '_now') as now:
+            now.return_value = self.ca_client.next_expiry[0] + 1
+            self.assertIn(('server', 'server1', self.relation_id),
+                          self.ca_client.renew_certificates())
+        cert_requests = self.harness.get_relation_data(
+            self.relation_id, 'myserver/0')['cert_requests']
+        self.assertTrue(compression.is_compressed(cert_requests))
+        self.assertIn('renewal', compression.decode(cert_requests)['server1'])
+
+        # They are sent as plain JSON again once a CA unit does not.
+        self.harness.add_relation_unit(self.relation_id, 'easyrsa/1')
+        self.harness.update_relation_data(
+            self.relation_id, 'easyrsa/1', {'ingress-address': '192.0.2.3'})
+        cert_requests = self.harness.get_relation_data(
+            self.relation_id, 'myserver/0')['cert_requests']
+        self.assertFalse(compression.is_compressed(cert_requests))
+        self.assertEqual(
+            sorted(json.loads(cert_requests)),
+            sorted(cn for cn, _ in requests))
+
+    def test_migrate_stored(self):
+        self.prepare_on_relation_changed_test(
+            get_multi_rq_relation_data_client(),
+            get_multi_rq_relation_data_server())
+        state = self.ca_client._state(self.relation_id)
+        server = {cn: dict(data) for cn, data in state['server'].items()}
+        ca_certificate = state['ca_certificate']
+        # Material stored by a version supporting a single relation.
+        del self.ca_client._stored.relations[str(self.relation_id)]
+        self.ca_client._stored.expiry = []
+        self.ca_client._stored.ca_certificate = ca_certificate
+        self.ca_client._stored.server = server
+        self.ca_client._migrate_stored()
+        self.assertIsNone(self.ca_client._stored.server)
+        self.assertIsNone(self.ca_client._stored.ca_certificate)
+        self.assertEqual(self.ca_client.ca_certificate_bytes(),
+                         ca_certificate.encode('utf-8'))
+        self.assertEqual(sorted(self.ca_client.server_certs),
+                         ['default', 'server1', 'server2'])
+        self.assertEqual(len(self.ca_client._stored.expiry), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,308 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from unittest import mock
+
+from ops.charm import CharmBase
+from ops import testing
+from ops import model
+
+import interface_tls_certificates.ca_provider as ca_provider
+import interface_tls_certificates.compression as compression
+import interface_tls_certificates.keys as keys
+
+
+class TestCAProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.harness = testing.Harness(CharmBase, meta='''
+            name: easyrsa
+            provides:
+              certificates:
+                interface: tls-certificates
+        ''')
+        self.harness.begin()
+        self.signed = []
+        self.ca_provider = ca_provider.CAProvider(
+            self.harness.charm, 'certificates', self.sign, batch_size=3)
+        self.relation_id = self.harness.add_relation(
+            'certificates', 'myserver')
+        self.harness.add_relation_unit(self.relation_id, 'myserver/0')
+        self.harness.add_relation_unit(self.relation_id, 'myserver/1')
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/0', {
+                'unit_name': 'myserver/0',
+                'common_name': 'server1',
+                'sans': json.dumps(['alt1']),
+                'cert_requests': json.dumps({
+                    'server1': {'sans': ['alt1']},
+                    'server2': {'sans': ['alt2']}}),
+                'client_cert_requests': json.dumps({
+                    'client1': {'sans': []}}),
+                'application_cert_requests': json.dumps({
+                    'app1': {'sans': ['10.0.0.1']}})})
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {
+                'unit_name': 'myserver/1',
+                'cert_requests': json.dumps({
+                    'server3': {'sans': ['alt3']}}),
+                'application_cert_requests': json.dumps({
+                    'app2': {'sans': ['10.0.0.2']}})})
+
+    def sign(self, requests):
+        self.signed.append(list(requests))
+        return [
+            {'cert': 'cert {} {} {}'.format(
+                request.request_type, request.common_name,
+                ','.join(request.sans)),
+             'key': 'key {} {}'.format(len(self.signed), index)}
+            for index, request in enumerate(requests)]
+
+    def local_data(self):
+        return self.harness.get_relation_data(
+            self.relation_id, self.harness.charm.unit.name)
+
+    def test_not_ready(self):
+        self.assertFalse(self.ca_provider.is_ready)
+        self.assertEqual(self.signed, [])
+        self.assertEqual(dict(self.local_data()), {})
+        with self.assertRaises(ca_provider.CAProviderError) as cm:
+            self.ca_provider.process_requests()
+        self.assertIsInstance(cm.exception.status, model.BlockedStatus)
+
+    def test_process_requests(self):
+        signed = self.ca_provider.set_ca_certificate('ca', 'chain')
+        # The legacy request is the same as the server1 request.
+        self.assertEqual(len(signed), 5)
+        self.assertEqual([len(batch) for batch in self.signed], [3, 2])
+        self.assertIn(
+            ca_provider.SigningRequest(
+                'application', 'app1', ['10.0.0.1', '10.0.0.2', 'app1',
+                                        'app2']),
+            signed)
+        data = self.local_data()
+        self.assertEqual(data['ca'], 'ca')
+        self.assertEqual(data['chain'], 'chain')
+        server = json.loads(data['myserver_0.processed_requests'])
+        self.assertEqual(sorted(server), ['server1', 'server2'])
+        self.assertEqual(server['server1']['cert'], 'cert server server1 alt1')
+        self.assertEqual(data['myserver_0.server.cert'],
+                         server['server1']['cert'])
+        self.assertEqual(data['myserver_0.server.key'],
+                         server['server1']['key'])
+        self.assertEqual(
+            json.loads(data['myserver_0.processed_client_requests'])[
+                'client1']['cert'],
+            'cert client client1 ')
+        self.assertEqual(
+            data['myserver_0.processed_application_requests'],
+            data['myserver_1.processed_application_requests'])
+        self.assertEqual(
+            sorted(json.loads(data['myserver_1.processed_requests'])),
+            ['server3'])
+        self.assertNotIn('myserver_1.server.cert', data)
+        self.assertNotIn('myserver_1.processed_client_requests', data)
+
+    def test_only_changed_requests_signed(self):
+        self.ca_provider.set_ca_certificate('ca', 'chain')
+        data = dict(self.local_data())
+        self.signed = []
+        backend = self.harness._backend
+        with mock.patch.object(
+                backend, 'update_relation_data',
+                wraps=backend.update_relation_data) as relation_set:
+            self.assertEqual(self.ca_provider.process_requests(), [])
+            relation_set.assert_not_called()
+        self.assertEqual(dict(self.local_data()), data)
+
+        # A renewal marker and new SANs cause new certificates.
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/0', {
+                'cert_requests': json.dumps({
+                    'server1': {'sans': ['alt1']},
+                    'server2': {'sans': ['alt2'], 'renewal': 1234}})})
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {
+                'cert_requests': json.dumps({
+                    'server3': {'sans': ['alt3', 'alt4']}})})
+        self.assertEqual(
+            [[request.common_name for request in batch]
+             for batch in self.signed],
+            [['server2'], ['server3']])
+        new_data = self.local_data()
+        server = json.loads(new_data['myserver_0.processed_requests'])
+        self.assertEqual(
+            server['server1'],
+            json.loads(data['myserver_0.processed_requests'])['server1'])
+        self.assertNotEqual(
+            server['server2'],
+            json.loads(data['myserver_0.processed_requests'])['server2'])
+        self.assertEqual(
+            new_data['myserver_0.processed_application_requests'],
+            data['myserver_0.processed_application_requests'])
+
+        # A new CA certificate causes all certificates to be signed again.
+        self.signed = []
+        self.assertEqual(
+            len(self.ca_provider.set_ca_certificate('ca2', None)), 5)
+        self.assertNotIn('chain', self.local_data())
+
+    def test_invalid_requests(self):
+        self.ca_provider.set_ca_certificate('ca', 'chain')
+        data = dict(self.local_data())
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {'cert_requests': '{'})
+        self.assertEqual(dict(self.local_data()), data)
+
+    def test_departed_unit(self):
+        self.ca_provider.set_ca_certificate('ca', 'chain')
+        self.signed = []
+        self.harness.remove_relation_unit(self.relation_id, 'myserver/1')
+        data = self.local_data()
+        self.assertEqual(
+            sorted(field for field in data if field.startswith('myserver_')),
+            ['myserver_0.processed_application_requests',
+             'myserver_0.processed_client_requests',
+             'myserver_0.processed_requests',
+             'myserver_0.server.cert',
+             'myserver_0.server.key'])
+        # The application certificate no longer covers myserver/1.
+        self.assertEqual(
+            [[tuple(request) for request in batch] for batch in self.signed],
+            [[('application', 'app1', ['10.0.0.1', 'app1'], None, None,
+               None)]])
+        self.harness.remove_relation(self.relation_id)
+        self.assertEqual(dict(self.ca_provider._stored.relations), {})
+
+    def test_key_pool(self):
+        key_pool = keys.KeyPool(
+            self.harness.charm, 'key-pool', size=2, key_type='P-256',
+            processes=1)
+        self.harness.charm.on.update_status.emit()
+        pooled = list(key_pool._stored.keys)
+        self.ca_provider._key_pool = key_pool
+
+        def sign(requests):
+            self.signed.append(list(requests))
+            return [{'cert': 'cert for ' + request.key}
+                    for request in requests]
+
+        self.ca_provider._sign = sign
+        self.ca_provider.set_ca_certificate('ca', 'chain')
+        self.assertEqual(key_pool.available, 0)
+        requests = [request for batch in self.signed for request in batch]
+        self.assertEqual([request.key for request in requests[:2]], pooled)
+        self.assertEqual(len({request.key for request in requests}), 5)
+        server = json.loads(
+            self.local_data()['myserver_0.processed_requests'])
+        self.assertEqual(server['server2']['cert'],
+                         'cert for ' + server['server2']['key'])
+
+    def test_key_type(self):
+        key_pool = keys.KeyPool(
+            self.harness.charm, 'key-pool', size=5, key_type='P-256',
+            processes=1)
+        key_pool.refill()
+        self.ca_provider._key_pool = key_pool
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/0', {
+                'application_cert_requests': json.dumps({
+                    'app1': {'sans': ['10.0.0.1'], 'key_type': 'Ed25519'}})})
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {
+                'cert_requests': json.dumps({
+                    'server3': {'sans': ['alt3'], 'key_type': 'P-384'},
+                    'server4': {'sans': ['alt4'], 'key_type': 'DSA'}})})
+        with self.assertLogs(ca_provider.logger, 'WARNING'):
+            self.ca_provider.set_ca_certificate('ca', 'chain')
+        requests = {
+            request.common_name: request
+            for batch in self.signed for request in batch}
+        self.assertEqual(sorted(requests),
+                         ['app1', 'client1', 'server1', 'server2', 'server3'])
+        self.assertEqual(requests['app1'].key_type, 'Ed25519')
+        self.assertEqual(requests['server3'].key_type, 'P-384')
+        self.assertIsNone(requests['server1'].key_type)
+        # Pooled keys only go to requests of the type of the pool.
+        self.assertEqual(key_pool.available, 2)
+        self.assertIn('BEGIN PRIVATE KEY', requests['server3'].key)
+        self.assertNotIn(requests['server3'].key, key_pool.take(2))
+        self.assertNotIn(
+            'server4',
+            json.loads(self.local_data()['myserver_1.processed_requests']))
+
+    def test_compression(self):
+        server_requests = {
+            'server{}'.format(i): {'sans': ['alt{}'.format(i)]}
+            for i in range(100)}
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/0', {
+                compression.ENCODINGS_FIELD: compression.advertisement(),
+                'cert_requests': compression.encode(
+                    server_requests, compress=True)})
+        # myserver/1 sends compressed requests without reading them.
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {
+                'cert_requests': compression.encode(
+                    {'server3': {'sans': ['alt3']}}, compress=True,
+                    min_size=0)})
+        self.ca_provider.set_ca_certificate('ca', 'chain')
+        data = self.local_data()
+        self.assertEqual(data[compression.ENCODINGS_FIELD],
+                         compression.advertisement())
+        processed = data['myserver_0.processed_requests']
+        self.assertTrue(compression.is_compressed(processed))
+        self.assertEqual(sorted(compression.decode(processed)),
+                         sorted(server_requests))
+        # Small responses and responses to units which do not advertise
+        # compression are plain JSON.
+        self.assertEqual(
+            json.loads(data['myserver_0.processed_client_requests'])[
+                'client1']['cert'],
+            'cert client client1 ')
+        self.assertEqual(
+            json.loads(data['myserver_1.processed_requests'])['server3'][
+                'cert'],
+            'cert server server3 alt3')
+
+        # Nothing is signed again when the requests are read back.
+        self.signed = []
+        self.assertEqual(self.ca_provider.process_requests(), [])
+
+    def test_csr(self):
+        key_pool = keys.KeyPool(
+            self.harness.charm, 'key-pool', size=0, key_type='P-256',
+            processes=1)
+        self.ca_provider._key_pool = key_pool
+        self.harness.update_relation_data(
+            self.relation_id, 'myserver/1', {
+                'cert_requests': json.dumps({
+                    'server3': {'sans': ['alt3'], 'csr': 'csr server3'}})})
+        with mock.patch.object(keys, 'generate_keys',
+                               wraps=keys.generate_keys) as generate_keys:
+            self.ca_provider.set_ca_certificate('ca', 'chain')
+        # Keys are generated for all the requests but the CSR.
+        generate_keys.assert_called_once_with(4, 'P-256', 1)
+        requests = {
+            request.common_name: request
+            for batch in self.signed for request in batch}
+        self.assertEqual(requests['server3'].csr, 'csr server3')
+        self.assertIsNone(requests['server3'].key)
+        self.assertIsNone(requests['server1'].csr)
+        server = json.loads(
+            self.local_data()['myserver_1.processed_requests'])
+        self.assertEqual(
+            server, {'server3': {'cert': 'cert server server3 alt3'}})
@@ -0,0 +1,65 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from unittest import mock
+
+import interface_tls_certificates.compression as compression
+
+from test.ca_client_test_data import get_multi_rq_relation_data_server
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_encode_and_decode(self):
+        value = json.loads(
+            get_multi_rq_relation_data_server()[
+                'myserver_0.processed_requests'])
+        text = compression.encode(value, compress=True)
+        self.assertTrue(compression.is_compressed(text))
+        self.assertLess(len(text), len(json.dumps(value)))
+        self.assertEqual(compression.decode(text), value)
+        # Plain JSON is read as it is.
+        plain = compression.encode(value)
+        self.assertEqual(plain, json.dumps(value, sort_keys=True))
+        self.assertEqual(compression.decode(plain), value)
+        # Small values are not worth compressing.
+        self.assertEqual(
+            compression.encode({'server1': {'sans': []}}, compress=True),
+            '{"server1": {"sans": []}}')
+
+    def test_decode_invalid(self):
+        for text in ('{', compression.PREFIX + '!!',
+                     compression.PREFIX + 'aGVsbG8='):
+            with self.assertRaises(ValueError):
+                compression.decode(text)
+        # Truncated values are invalid too.
+        text = compression.encode(['x' * 2048], compress=True)
+        with self.assertRaises(ValueError):
+            compression.decode(text[:len(compression.PREFIX) + 8])
+
+    def test_decode_max_size(self):
+        text = compression.encode(['x' * 2048], compress=True)
+        self.assertEqual(compression.decode(text), ['x' * 2048])
+        with mock.patch.object(compression, 'MAX_SIZE', 2048):
+            with self.assertRaises(ValueError):
+                compression.decode(text)
+
+    def test_supports_compression(self):
+        self.assertTrue(compression.supports_compression(
+            {compression.ENCODINGS_FIELD: compression.advertisement()}))
+        for data in ({}, {'encodings': '["zlib2"]'}, {'encodings': '{'},
+                     {'encodings': '"zlib1"'}):
+            self.assertFalse(compression.supports_compression(data))
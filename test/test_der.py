@@ -0,0 +1,126 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+import hashlib
+import ipaddress
+import json
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.x509.oid import NameOID
+
+import interface_tls_certificates.der as der
+
+from test.ca_client_test_data import (
+    TEST_RELATION_DATA,
+    get_multi_rq_relation_data_server)
+
+
+def _self_signed(key, common_name, sans, not_after, algorithm):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(2 ** 150 + 7)
+        .not_valid_before(datetime.datetime(2020, 1, 1))
+        .not_valid_after(not_after))
+    if sans is not None:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName(sans), critical=True)
+    return builder.sign(key, algorithm, default_backend())
+
+
+class TestCertificateMetadata(unittest.TestCase):
+
+    def assertMatches(self, cert, key_type):
+        metadata = der.certificate_metadata(
+            cert.public_bytes(serialization.Encoding.DER))
+        self.assertEqual(metadata['serial'], cert.serial_number)
+        self.assertEqual(
+            metadata['not_before'],
+            calendar.timegm(cert.not_valid_before.utctimetuple()))
+        self.assertEqual(
+            metadata['not_after'],
+            calendar.timegm(cert.not_valid_after.utctimetuple()))
+        common_names = cert.subject.get_attributes_for_oid(
+            NameOID.COMMON_NAME)
+        self.assertEqual(metadata['common_name'], common_names[-1].value)
+        try:
+            sans = cert.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value
+        except x509.ExtensionNotFound:
+            self.assertIsNone(metadata['dns_names'])
+            self.assertIsNone(metadata['ip_addresses'])
+        else:
+            self.assertEqual(metadata['dns_names'],
+                             sans.get_values_for_type(x509.DNSName))
+            self.assertEqual(
+                metadata['ip_addresses'],
+                [str(ip) for ip in sans.get_values_for_type(x509.IPAddress)])
+        self.assertEqual(metadata['key_type'], key_type)
+        self.assertEqual(
+            metadata['public_key_sha256'],
+            hashlib.sha256(cert.public_key().public_bytes(
+                serialization.Encoding.DER,
+                serialization.PublicFormat.SubjectPublicKeyInfo)).hexdigest())
+        return metadata
+
+    def test_fixtures(self):
+        pems = [
+            TEST_RELATION_DATA['ca'],
+            TEST_RELATION_DATA['myserver_0.server.cert']]
+        for field, value in get_multi_rq_relation_data_server().items():
+            if 'processed' in field:
+                pems.extend(
+                    data['cert'] for data in json.loads(value).values())
+            elif field.endswith('.cert'):
+                pems.append(value)
+        for pem in pems:
+            self.assertMatches(
+                x509.load_pem_x509_certificate(
+                    pem.encode('utf-8'), default_backend()),
+                'RSA-2048')
+
+    def test_key_types(self):
+        sans = [
+            x509.DNSName('www.example.com'),
+            x509.IPAddress(ipaddress.ip_address('2001:db8::1'))]
+        # GeneralizedTime is used from 2050.
+        not_after = datetime.datetime(2051, 2, 3, 4, 5, 6)
+        cert = _self_signed(
+            ec.generate_private_key(ec.SECP384R1(), default_backend()),
+            'ec', sans, not_after, hashes.SHA256())
+        metadata = self.assertMatches(cert, 'P-384')
+        self.assertEqual(metadata['ip_addresses'], ['2001:db8::1'])
+        cert = _self_signed(
+            ed25519.Ed25519PrivateKey.generate(), 'ed', None,
+            datetime.datetime(2030, 1, 1), None)
+        self.assertMatches(cert, 'Ed25519')
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            der.certificate_metadata(b'\x30\x82\x01')
+        with self.assertRaises(ValueError):
+            der.certificate_metadata(b'\x30\x03\x02\x01\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import resource
+import tempfile
+import unittest
+from unittest import mock
+
+import interface_tls_certificates.files as files
+
+
+class TestWriteFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.key_path = os.path.join(self.tmp_dir.name, 'sub', 'a.key')
+        self.cert_path = os.path.join(self.tmp_dir.name, 'a.crt')
+
+    def test_write_files(self):
+        written = files.write_files({
+            self.key_path: (b'key', 0o600),
+            self.cert_path: (b'cert', 0o644)})
+        self.assertEqual(written, sorted([self.key_path, self.cert_path]))
+        with open(self.key_path, 'rb') as f:
+            self.assertEqual(f.read(), b'key')
+        self.assertEqual(os.stat(self.key_path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(self.cert_path).st_mode & 0o777, 0o644)
+        self.assertEqual(
+            os.stat(os.path.dirname(self.key_path)).st_mode & 0o777, 0o700)
+
+        # Unchanged content is not written again, permissions are fixed.
+        os.chmod(self.cert_path, 0o666)
+        written = files.write_files({
+            self.key_path: (b'key2', 0o600),
+            self.cert_path: (b'cert', 0o644)})
+        self.assertEqual(written, [self.key_path])
+        self.assertEqual(os.stat(self.cert_path).st_mode & 0o777, 0o644)
+        with open(self.key_path, 'rb') as f:
+            self.assertEqual(f.read(), b'key2')
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.key_path))), ['a.key'])
+
+    def test_write_many_files(self):
+        # More files than the process may have open at once.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+        self.addCleanup(
+            resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+        paths = {
+            os.path.join(self.tmp_dir.name, 'many', str(i)): (
+                str(i).encode('ascii'), 0o600)
+            for i in range(300)}
+        written = files.write_files(paths, fsync=False)
+        self.assertEqual(written, sorted(paths))
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.tmp_dir.name, 'many'))), 300)
+
+    def test_write_files_fsync(self):
+        # Files are only flushed once all of them are written.
+        paths = {
+            os.path.join(self.tmp_dir.name, str(i)): (b'x', 0o600)
+            for i in range(3)}
+        flushed = []
+
+        def fsync(fd):
+            flushed.append(len(os.listdir(self.tmp_dir.name)))
+
+        with mock.patch.object(files.os, 'fsync', side_effect=fsync):
+            files.write_files(paths)
+        # Three temporary files, then the directory.
+        self.assertEqual(flushed, [3, 3, 3, 3])
+
+    def test_write_files_failure(self):
+        files.write_files({self.cert_path: (b'cert', 0o644)})
+        with mock.patch.object(files.os, 'rename',
+                               side_effect=OSError('boom')):
+            with self.assertRaises(OSError):
+                files.write_files({self.cert_path: (b'cert2', 0o644)})
+        with open(self.cert_path, 'rb') as f:
+            self.assertEqual(f.read(), b'cert')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['a.crt'])
+
+
+if __name__ == "__main__":
+    unittest.main()
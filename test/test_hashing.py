@@ -0,0 +1,33 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import interface_tls_certificates.hashing as hashing
+
+
+class TestHashing(unittest.TestCase):
+
+    def test_digest(self):
+        self.assertEqual(
+            hashing.digest('cert'),
+            '06298432e8066b29e2223bcc23aa9504b56ae508fabf3435508869b9c3190e22')
+
+    def test_fingerprint(self):
+        self.assertEqual(hashing.fingerprint(['a', None]),
+                         hashing.fingerprint(['a', '']))
+        self.assertNotEqual(hashing.fingerprint(['ab', 'c']),
+                            hashing.fingerprint(['a', 'bc']))
+        self.assertNotEqual(hashing.fingerprint(['a']),
+                            hashing.fingerprint(['a', '']))
@@ -0,0 +1,139 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import ipaddress
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from ops.charm import CharmBase
+from ops import testing
+
+import interface_tls_certificates.keys as keys
+import interface_tls_certificates.store as store
+
+
+class TestGenerateKeys(unittest.TestCase):
+
+    def test_generate_key(self):
+        key = load_pem_private_key(
+            keys.generate_key('RSA-2048').encode('utf-8'), None)
+        self.assertEqual(key.key_size, 2048)
+        with self.assertRaises(ValueError):
+            keys.generate_key('DSA-1024')
+
+    def test_key_types(self):
+        for key_type, key_class, curve in (
+                ('RSA-2048', rsa.RSAPrivateKey, None),
+                ('P-256', ec.EllipticCurvePrivateKey, ec.SECP256R1),
+                ('P-384', ec.EllipticCurvePrivateKey, ec.SECP384R1),
+                ('Ed25519', ed25519.Ed25519PrivateKey, None)):
+            key = load_pem_private_key(
+                keys.generate_key(key_type).encode('utf-8'), None)
+            self.assertIsInstance(key, key_class)
+            if curve is not None:
+                self.assertIsInstance(key.curve, curve)
+        for key_type in ('RSA-512', 'RSA-1024', 'RSA-100000', 'RSA', 'P-192',
+                         'ed25519', None):
+            with self.assertRaises(ValueError):
+                keys.check_key_type(key_type)
+
+    def test_generate_keys(self):
+        self.assertEqual(keys.generate_keys(0), [])
+        generated = keys.generate_keys(3, 'P-256', processes=2)
+        self.assertEqual(len(set(generated)), 3)
+
+    def test_generate_csrs(self):
+        generated = keys.generate_csrs(
+            [('server1', ['server1.example', '10.0.0.1']), ('server2', [])],
+            'P-256', processes=2)
+        self.assertEqual(len(generated), 2)
+        csr = x509.load_pem_x509_csr(generated[0]['csr'].encode('utf-8'))
+        self.assertTrue(csr.is_signature_valid)
+        self.assertEqual(
+            csr.subject.get_attributes_for_oid(
+                x509.NameOID.COMMON_NAME)[0].value,
+            'server1')
+        sans = csr.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName).value
+        self.assertEqual(sans.get_values_for_type(x509.DNSName),
+                         ['server1.example'])
+        self.assertEqual(sans.get_values_for_type(x509.IPAddress),
+                         [ipaddress.ip_address('10.0.0.1')])
+        key = load_pem_private_key(generated[0]['key'].encode('utf-8'), None)
+        self.assertEqual(keys.public_key_digest(csr.public_key()),
+                         keys.public_key_digest(key.public_key()))
+        self.assertEqual(generated[0]['public_key'],
+                         keys.public_key_digest(key.public_key()))
+        csr = x509.load_pem_x509_csr(generated[1]['csr'].encode('utf-8'))
+        self.assertEqual(len(csr.extensions), 0)
+
+    def test_generate_csr_key_types(self):
+        for key_type, algorithm in (('P-384', hashes.SHA384),
+                                    ('Ed25519', type(None))):
+            generated = keys.generate_csr('server1', ['server1'], key_type)
+            csr = x509.load_pem_x509_csr(generated['csr'].encode('utf-8'))
+            self.assertTrue(csr.is_signature_valid)
+            self.assertIsInstance(csr.signature_hash_algorithm, algorithm)
+            self.assertEqual(generated['public_key'],
+                             keys.public_key_digest(csr.public_key()))
+
+
+class TestKeyPool(unittest.TestCase):
+
+    def setUp(self):
+        self.harness = testing.Harness(CharmBase, meta='''
+            name: easyrsa
+        ''')
+        self.harness.begin()
+
+    def test_key_pool(self):
+        key_pool = keys.KeyPool(self.harness.charm, 'key-pool', size=3,
+                                key_type='P-256', processes=1)
+        self.assertEqual(key_pool.available, 0)
+        self.assertEqual(key_pool.refill(limit=1), 1)
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(key_pool.available, 3)
+        pooled = list(key_pool._stored.keys)
+        self.assertEqual(key_pool.take(2), pooled[:2])
+        self.assertEqual(key_pool.available, 1)
+        taken = key_pool.take(3)
+        self.assertEqual(taken[0], pooled[2])
+        self.assertEqual(len(set(taken)), 3)
+        self.assertEqual(key_pool.available, 0)
+        # Keys of other types are not pooled.
+        key_pool.refill()
+        key = load_pem_private_key(
+            key_pool.take(1, 'P-384')[0].encode('utf-8'), None)
+        self.assertIsInstance(key.curve, ec.SECP384R1)
+        self.assertEqual(key_pool.available, 3)
+
+    def test_key_pool_store(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        key_pool = keys.KeyPool(
+            self.harness.charm, 'key-pool', size=2, key_type='P-256',
+            processes=1,
+            store=store.DirectoryStore(tmp_dir.name, fsync=False))
+        key_pool.refill()
+        digests = list(key_pool._stored.keys)
+        self.assertEqual(sorted(os.listdir(tmp_dir.name)), sorted(digests))
+        key = key_pool.take(1)[0]
+        self.assertEqual(store.digest(key), digests[0])
+        self.assertEqual(os.listdir(tmp_dir.name), digests[1:])
@@ -0,0 +1,52 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import interface_tls_certificates.sni as sni
+
+
+class TestSNI(unittest.TestCase):
+
+    def setUp(self):
+        self.index = sni.build_index([
+            (['www.example.com', '10.0.0.1'], 'www'),
+            (['*.example.com', 'example.com'], 'wildcard'),
+            (['www.example.com', '*.api.example.com', '2001:DB8::1'], 'api'),
+            (['*'], 'everything'),
+        ])
+
+    def test_lookup(self):
+        self.assertEqual(sni.lookup(self.index, 'www.example.com'), 'www')
+        # Names are case insensitive and may be fully qualified.
+        self.assertEqual(sni.lookup(self.index, 'WWW.Example.com.'), 'www')
+        self.assertEqual(sni.lookup(self.index, 'example.com'), 'wildcard')
+        self.assertEqual(sni.lookup(self.index, 'mail.example.com'),
+                         'wildcard')
+        self.assertEqual(sni.lookup(self.index, 'v1.api.example.com'), 'api')
+        # A wildcard only stands for one label.
+        self.assertIsNone(sni.lookup(self.index, 'a.b.www.example.com'))
+        self.assertIsNone(sni.lookup(self.index, 'example.org'))
+        self.assertIsNone(sni.lookup(self.index, 'localhost'))
+        self.assertIsNone(sni.lookup(self.index, 'www..example.com'))
+
+    def test_lookup_ip_address(self):
+        self.assertEqual(sni.lookup(self.index, '10.0.0.1'), 'www')
+        self.assertEqual(sni.lookup(self.index, '2001:db8:0::1'), 'api')
+        self.assertEqual(sni.lookup(self.index, '[2001:db8::1]'), 'api')
+        self.assertIsNone(sni.lookup(self.index, '10.0.0.2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright 2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import interface_tls_certificates.store as store
+
+
+class TestMaterialStore(unittest.TestCase):
+
+    def test_abstract(self):
+        class SaveOnlyStore(store.MaterialStore):
+
+            def save(self, texts):
+                return [store.digest(text) for text in texts]
+
+        with self.assertRaises(TypeError):
+            store.MaterialStore()
+        with self.assertRaises(TypeError):
+            SaveOnlyStore()
+
+
+class TestDirectoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.directory = os.path.join(self.tmp_dir.name, 'material')
+        self.store = store.DirectoryStore(self.directory, fsync=False)
+
+    def test_save_and_load(self):
+        digests = self.store.save(['cert', 'key', 'cert'])
+        self.assertEqual(digests[0], store.digest('cert'))
+        self.assertEqual(digests[0], digests[2])
+        self.assertEqual(self.store.load(digests[1]), 'key')
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o700)
+        self.assertEqual(
+            os.stat(os.path.join(self.directory, digests[1])).st_mode & 0o777,
+            0o600)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(digests[:2]))
+
+        # A file which does not match its name is not returned.
+        with open(os.path.join(self.directory, digests[1]), 'w') as f:
+            f.write('other')
+        with self.assertRaises(KeyError):
+            self.store.load(digests[1])
+        with self.assertRaises(KeyError):
+            self.store.load(store.digest('missing'))
+
+    def test_retain(self):
+        self.store.retain(set())
+        digests = self.store.save(['cert', 'key'])
+        self.store.retain({digests[0]})
+        self.assertEqual(os.listdir(self.directory), [digests[0]])
+        self.assertEqual(self.store.load(digests[0]), 'cert')